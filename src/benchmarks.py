@@ -0,0 +1,365 @@
+import os
+import re
+import sys
+import time
+import pickle
+import difflib
+from typing import Callable, List
+
+import numpy as np
+import torch
+
+sys.path.append('.')
+from src.data_processing import SequenceDataset, SequenceDataLoader, text_cleaner_raw, tweet_tokenizer, \
+    default_text_cleaner, clean_many
+from src.regex_tokenizers import regex_tweet_tokenize, regex_word_tokenize, regex_sent_tokenize
+
+class PerItemDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset : SequenceDataset):
+        """Reproduces the former SequenceDataset.__getitem__, creating one tensor
+        per row, for comparison purposes.
+
+        :param dataset: the dataset to wrap
+        :type dataset: SequenceDataset
+        """
+        self.dataset = dataset
+
+    def __getitem__(self, idx):
+        return torch.tensor(self.dataset.tokens[idx]).to(self.dataset.device)
+
+    def __len__(self):
+        return len(self.dataset)
+
+def synthetic_dataset(
+    num_sequences : int = 20000,
+    max_seq_length : int = 20,
+    vocab_size : int = 10000,
+    device : str = 'cpu',
+    seed : int = 0
+) -> SequenceDataset:
+    """Generates a dataset of random token ids without going through tokenization
+
+    :param num_sequences: number of rows, defaults to 20000
+    :type num_sequences: int, optional
+    :param max_seq_length: length of the rows, defaults to 20
+    :type max_seq_length: int, optional
+    :param vocab_size: ids are drawn in [2, vocab_size), defaults to 10000
+    :type vocab_size: int, optional
+    :param device: device of the dataset, defaults to 'cpu'
+    :type device: str, optional
+    :param seed: numpy seed, defaults to 0
+    :type seed: int, optional
+    :return: the dataset
+    :rtype: SequenceDataset
+    """
+    rng = np.random.RandomState(seed)
+    dataset = SequenceDataset.__new__(SequenceDataset)
+    dataset.device = device
+    dataset.max_seq_length = max_seq_length
+    dataset.tensor = None
+    dataset.counts = None
+    dataset.cache_file = None
+    dataset.tokens = rng.randint(2, vocab_size, size = (num_sequences, max_seq_length)).astype(np.int64)
+    return dataset
+
+def batches_per_second(make_iterator : Callable, num_repeats : int = 3) -> float:
+    """Iterates num_repeats times over the iterator returned by make_iterator and
+    returns the best number of batches per second. Only the loading is timed: every
+    batch is summed so that it is read, but no model is run on it.
+
+    :param make_iterator: returns a new iterable over batches
+    :type make_iterator: Callable
+    :param num_repeats: number of timed passes, defaults to 3
+    :type num_repeats: int, optional
+    :rtype: float
+    """
+    best = 0
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        num_batches = 0
+        for batch in make_iterator():
+            batch.sum()
+            num_batches += 1
+        best = max(best, num_batches / (time.perf_counter() - start))
+    return best
+
+def benchmark_loader(batch_size : int = 32, device : str = 'cpu', **kwargs):
+    """Compares the loading throughput, in batches/s, of the torch DataLoader over
+    per-row tensors and of the SequenceDataLoader
+
+    :param batch_size: batch size, defaults to 32
+    :type batch_size: int, optional
+    :param device: device of the dataset, defaults to 'cpu'
+    :type device: str, optional
+    """
+    dataset = synthetic_dataset(device = device, **kwargs)
+    legacy = PerItemDataset(dataset)
+    for shuffle in [False, True]:
+        before = batches_per_second(lambda: torch.utils.data.DataLoader(
+            legacy, batch_size = batch_size, shuffle = shuffle, drop_last = True
+        ))
+        after = batches_per_second(lambda: SequenceDataLoader(
+            dataset, batch_size = batch_size, shuffle = shuffle, drop_last = True
+        ))
+        print(f'shuffle={shuffle} | DataLoader: {before:.0f} batches/s | SequenceDataLoader: {after:.0f} batches/s | x{after / before:.1f}')
+
+def sequential_default_text_cleaner(string : str) -> str:
+    """Former default_text_cleaner, one re.sub per step, for comparison purposes"""
+    string = re.sub(r'-\n', '', string)
+    string = re.sub(r"""[*#@&%£ö'ä$ü¨~^)('.+°¢=/><$\[\]`\-,:!?]""", '', string)
+    string = re.sub(r'[0-9]', '', string)
+    string = re.sub(' unk ', ' ', string)
+    string = re.sub(' pad ', ' ', string)
+    return string
+
+def sequential_text_cleaner_raw(string) -> str:
+    """Former text_cleaner_raw, one re.sub per step, for comparison purposes"""
+    string = re.sub(r'-\n', '', string)
+    string = re.sub(r'\n+', ' ', string)
+    string = re.sub(r"""[*#@&%£ö'ä$ü¨~^)('+°¢=/><$\[\]`\-,:!?`]""", '', string)
+    string = re.sub(r'[0-9]', '', string)
+    string = re.sub(' unk ', ' ', string)
+    string = re.sub(' pad ', ' ', string)
+    string = re.sub(r' {2,}', '', string)
+    return string
+
+def random_texts(num_texts : int = 20000, seed : int = 0) -> List[str]:
+    """Generates short texts mixing words with the characters handled by the cleaners
+
+    :param num_texts: number of texts, defaults to 20000
+    :type num_texts: int, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :rtype: List[str]
+    """
+    rng = np.random.RandomState(seed)
+    pieces = np.array([
+        'the', 'model', 'unk', 'pad', 'word', 'é', ' ', ' ', ' ', '  ', '\n', '\n\n', '-\n', '-', '.', ',',
+        "'", '@user', '#tag', '2016', '3.5', '!', '?', ':', '(', ')', '[', ']', '`', '£', 'ö', '°'
+    ])
+    return [''.join(rng.choice(pieces, size = rng.randint(1, 60))) for _ in range(num_texts)]
+
+def benchmark_cleaners(num_texts : int = 20000):
+    """Checks that the cleaners give the same output as their former implementation
+    and compares their speed, text by text and with clean_many.
+
+    :param num_texts: number of texts, defaults to 20000
+    :type num_texts: int, optional
+    """
+    texts = random_texts(num_texts)
+    for cleaner, sequential in [
+        (default_text_cleaner, sequential_default_text_cleaner),
+        (text_cleaner_raw, sequential_text_cleaner_raw)
+    ]:
+        timings = []
+        for clean in [
+            lambda: [sequential(text) for text in texts],
+            lambda: [cleaner(text) for text in texts],
+            lambda: clean_many(texts, cleaner)
+        ]:
+            start = time.perf_counter()
+            cleaned = clean()
+            timings.append(time.perf_counter() - start)
+            assert cleaned == [sequential(text) for text in texts]
+        print(
+            f'{cleaner.__name__} | identical outputs | re.sub: {num_texts / timings[0]:.0f} texts/s | '
+            f'single pass: {num_texts / timings[1]:.0f} texts/s (x{timings[0] / timings[1]:.1f}) | '
+            f'clean_many: {num_texts / timings[2]:.0f} texts/s (x{timings[0] / timings[2]:.1f})'
+        )
+
+def token_agreement(references : List[List[str]], candidates : List[List[str]]) -> float:
+    """Token-level agreement rate between two tokenizations of the same texts: twice
+    the number of tokens in the longest matching blocks over the total number of tokens.
+
+    :param references: the reference tokens of every text
+    :type references: List[List[str]]
+    :param candidates: the candidate tokens of every text
+    :type candidates: List[List[str]]
+    :rtype: float
+    """
+    matches, total = 0, 0
+    for reference, candidate in zip(references, candidates):
+        matcher = difflib.SequenceMatcher(None, reference, candidate, autojunk = False)
+        matches += sum(block.size for block in matcher.get_matching_blocks())
+        total += len(reference) + len(candidate)
+    return 2 * matches / max(total, 1)
+
+def compare_tokenizers(name : str, texts : List[str], reference : Callable, candidate : Callable):
+    """Prints the agreement and the throughput in tokens/sec of two tokenizers
+
+    :param name: name of the comparison
+    :type name: str
+    :param texts: the texts to tokenize
+    :type texts: List[str]
+    :param reference: the NLTK tokenizer
+    :type reference: Callable
+    :param candidate: the regex tokenizer
+    :type candidate: Callable
+    """
+    results = []
+    for tokenizer in [reference, candidate]:
+        start = time.perf_counter()
+        try:
+            tokens = [tokenizer(text) for text in texts]
+        except LookupError:
+            print(f'{name} | skipped, the nltk data it needs is not installed')
+            return
+        duration = time.perf_counter() - start
+        results.append((tokens, sum(len(x) for x in tokens) / duration))
+    (reference_tokens, reference_speed), (candidate_tokens, candidate_speed) = results
+    exact = sum(a == b for a, b in zip(reference_tokens, candidate_tokens)) / max(len(texts), 1)
+    print(
+        f'{name} | agreement: {token_agreement(reference_tokens, candidate_tokens):.4f} | identical texts: {exact:.4f} | '
+        f'nltk: {reference_speed:.0f} tokens/s | regex: {candidate_speed:.0f} tokens/s | x{candidate_speed / reference_speed:.1f}'
+    )
+
+def benchmark_tokenizers(
+    tweets_path : str = os.path.join('data', 'train_2.pickle'),
+    wiki_path : str = os.path.join('data', 'wikitext-3', 'train_103.pickle'),
+    num_texts : int = 2000
+):
+    """Equivalence report and throughput of the regex tokenizers against the NLTK
+    ones, on the first num_texts tweets and articles of the pretraining sets. The
+    articles are cleaned with text_cleaner_raw before word tokenization, as for the
+    WikiText vocabulary and datasets.
+
+    :param tweets_path: pickle of the tweets, defaults to data/train_2.pickle
+    :type tweets_path: str, optional
+    :param wiki_path: pickle of the articles, defaults to data/wikitext-3/train_103.pickle
+    :type wiki_path: str, optional
+    :param num_texts: number of texts compared, defaults to 2000
+    :type num_texts: int, optional
+    """
+    import nltk
+    if os.path.exists(tweets_path):
+        with open(tweets_path, 'rb') as f:
+            tweets = pickle.load(f)[:num_texts]
+        compare_tokenizers('tweets | tweet tokenizer', tweets, tweet_tokenizer(), regex_tweet_tokenize)
+    else:
+        print(f'{tweets_path} not found, tweets skipped')
+    if os.path.exists(wiki_path):
+        with open(wiki_path, 'rb') as f:
+            articles = pickle.load(f)[:num_texts]
+        compare_tokenizers('wikitext | sentence splitter', articles, nltk.sent_tokenize, regex_sent_tokenize)
+        articles = [text_cleaner_raw(article) for article in articles]
+        compare_tokenizers('wikitext | word tokenizer', articles, nltk.word_tokenize, regex_word_tokenize)
+    else:
+        print(f'{wiki_path} not found, wikitext skipped')
+
+def benchmark_prefix_cache(
+    num_sessions : int = 200,
+    session_length : int = 20,
+    vocab_size : int = 10000,
+    seed : int = 0
+):
+    """Simulates keyboard sessions, where the next words are suggested after every
+    typed word, and compares the PrefixCache with running every prefix from scratch.
+    Half of the sessions start with the same opener. The suggestions are checked to
+    be the same.
+
+    :param num_sessions: number of typed texts, defaults to 200
+    :type num_sessions: int, optional
+    :param session_length: number of words of every text, defaults to 20
+    :type session_length: int, optional
+    :param vocab_size: vocabulary size of the untrained model, defaults to 10000
+    :type vocab_size: int, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    """
+    from src.models import NextWordPredictorModel
+    from src.inference import PrefixCache
+
+    torch.manual_seed(seed)
+    rng = np.random.RandomState(seed)
+    model = NextWordPredictorModel('GRU', 256, vocab_size, 2, 200, 0.5, 'cpu')
+    model.eval()
+    opener = list(rng.randint(2, vocab_size, size = session_length // 2))
+    sessions = [
+        (opener if i % 2 == 0 else []) + list(rng.randint(2, vocab_size, size = session_length))
+        for i in range(num_sessions)
+    ]
+    prefixes = [session[:length] for session in sessions for length in range(1, len(session) + 1)]
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        reference = [torch.topk(model.run_prompts([prefix])[0][0], 3)[1].tolist() for prefix in prefixes]
+    duration = time.perf_counter() - start
+
+    cache = PrefixCache(model)
+    start = time.perf_counter()
+    suggestions = [cache.suggest(prefix, 3) for prefix in prefixes]
+    cached_duration = time.perf_counter() - start
+    assert suggestions == reference
+    stats = cache.stats()
+    print(
+        f'{len(prefixes)} queries | identical suggestions | no cache: {len(prefixes) / duration:.0f} queries/s | '
+        f'cache: {len(prefixes) / cached_duration:.0f} queries/s (x{duration / cached_duration:.1f})'
+    )
+    print(
+        f'hit rate: {stats["hit_rate"]:.3f} | partial hit rate: {stats["partial_hit_rate"]:.3f} | '
+        f'tokens run: {stats["tokens_run_fraction"]:.3f} | p50: {stats["p50_ms"]:.2f}ms | '
+        f'p90: {stats["p90_ms"]:.2f}ms | p99: {stats["p99_ms"]:.2f}ms'
+    )
+
+def benchmark_server(num_requests : int = 2000, concurrency : int = 64, port : int = 8765):
+    """Serves an untrained GRU with a vocabulary built from random texts and measures
+    the throughput and latency of the SuggestionServer without batching (batches of 1)
+    and with micro-batching, using the load generator.
+
+    :param num_requests: number of requests per run, defaults to 2000
+    :type num_requests: int, optional
+    :param concurrency: number of concurrent clients, defaults to 64
+    :type concurrency: int, optional
+    :param port: the local port, defaults to 8765
+    :type port: int, optional
+    """
+    import asyncio
+    from src.data_processing import FromTweetsVocabulary
+    from src.models import NextWordPredictorModel
+    from src.server import SuggestionServer
+    from src.load_generator import generate_load, DEFAULT_TEXTS
+
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    words = ' '.join(DEFAULT_TEXTS).split(' ') + [f'word{i}' for i in range(10000)]
+    vocabulary = FromTweetsVocabulary(
+        tweets = [' '.join(rng.choice(words, size = 20)) for _ in range(20000)],
+        tokenizer = str.split,
+        text_cleaner = None,
+        max_voc_size = 10000,
+        min_word_occ = 1
+    )
+    model = NextWordPredictorModel('GRU', 256, vocabulary.get_vocab_size(), 2, 200, 0.5, 'cpu')
+
+    async def run(max_batch_size):
+        server = SuggestionServer({'general' : model}, vocabulary, max_batch_size = max_batch_size)
+        tcp_server = await server.start(port = port)
+        stats = await generate_load(port = port, num_requests = num_requests, concurrency = concurrency)
+        tcp_server.close()
+        server.batcher.cancel()
+        return stats, server.num_requests / server.num_batches
+
+    for max_batch_size in [1, 64]:
+        stats, mean_batch_size = asyncio.run(run(max_batch_size))
+        print(
+            f'max batch size {max_batch_size} | mean batch size {mean_batch_size:.1f} | '
+            f'{stats["requests_per_second"]:.0f} requests/s | p50: {stats["p50_ms"]:.1f}ms | p99: {stats["p99_ms"]:.1f}ms'
+        )
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python src/benchmarks.py <loader|cleaners|tokenizers|prefix_cache|server> [args]')
+        sys.exit(1)
+    if sys.argv[1] == 'loader':
+        benchmark_loader()
+    elif sys.argv[1] == 'cleaners':
+        benchmark_cleaners()
+    elif sys.argv[1] == 'tokenizers':
+        benchmark_tokenizers(*sys.argv[2:4])
+    elif sys.argv[1] == 'prefix_cache':
+        benchmark_prefix_cache()
+    elif sys.argv[1] == 'server':
+        benchmark_server()
+    else:
+        print('unknown benchmark')
+        sys.exit(1)
@@ -1,11 +1,18 @@
 import re
 import gc
 import os
+import hashlib
 import logging
 import pickle
 import sys
 import json
-from typing import List, Union, Callable
+import math
+import warnings
+import itertools
+import struct
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union, Callable, Tuple, Iterator, Iterable
 
 from tqdm import tqdm
 import pandas as pd
@@ -16,6 +23,14 @@ import torchtext
 
 sys.path.append('.')
 from src.utils import make_dir_if_not_exists
+from src.regex_tokenizers import regex_tweet_tokenize, regex_word_tokenize, regex_sent_tokenize
+
+# characters removed by the cleaners, digits included. A character class is
+# faster than str.translate with non-ascii characters in the table
+DEFAULT_CLEANER_RE = re.compile(r"""-\n|[*#@&%£ö'ä$ü¨~^)('.+°¢=/><$\[\]`\-,:!?0-9]""")
+RAW_CLEANER_RE = re.compile(r"""[*#@&%£ö'ä$ü¨~^)('+°¢=/><$\[\]`\-,:!?`0-9]""")
+NEWLINES_RE = re.compile(r'\n+')
+SPACES_RE = re.compile(r' {2,}')
 
 def default_text_cleaner(string : str) -> str:
     """Cleans a given string.
@@ -25,12 +40,10 @@ def default_text_cleaner(string : str) -> str:
     :return: the cleaned string
     :rtype: str
     """    
-    string = re.sub(r'-\n', '', string)
-    string = re.sub(r"""[*#@&%£ö'ä$ü¨~^)('.+°¢=/><$\[\]`\-,:!?]""", '', string)
-    string = re.sub(r'[0-9]', '', string)
-    string = re.sub(' unk ', ' ', string)
-    string = re.sub(' pad ', ' ', string)
-    return string
+    # removing the '-\n' in the same pass as the other characters is equivalent,
+    # since the dashes are removed anyway
+    string = DEFAULT_CLEANER_RE.sub('', string)
+    return string.replace(' unk ', ' ').replace(' pad ', ' ')
 
 def text_cleaner_raw(string) -> str:
     """Cleans a given string. The difference with
@@ -43,36 +56,144 @@ def text_cleaner_raw(string) -> str:
     :return: the cleaned string
     :rtype: str
     """  
-    string = re.sub(r'-\n', '', string)
-    string = re.sub(r'\n+', ' ', string)
-    string = re.sub(r"""[*#@&%£ö'ä$ü¨~^)('+°¢=/><$\[\]`\-,:!?`]""", '', string)
-    string = re.sub(r'[0-9]', '', string)
-    string = re.sub(' unk ', ' ', string)
-    string = re.sub(' pad ', ' ', string)
-    string = re.sub(r' {2,}', '', string)
+    string = string.replace('-\n', '')
+    if '\n' in string:
+        string = NEWLINES_RE.sub(' ', string)
+    string = RAW_CLEANER_RE.sub('', string).replace(' unk ', ' ').replace(' pad ', ' ')
+    if '  ' in string:
+        string = SPACES_RE.sub('', string)
     return string
 
+def clean_many(
+    texts : List[str],
+    text_cleaner : Callable[[str], str],
+    batch_size : int = 1000
+) -> List[str]:
+    """Cleans a list of texts. The texts given to default_text_cleaner and
+    text_cleaner_raw are joined by batches with a null character, that no step
+    of these cleaners matches or removes, and each batch is cleaned in a single call.
+
+    :param texts: the texts to clean
+    :type texts: List[str]
+    :param text_cleaner: the cleaning function
+    :type text_cleaner: str -> str
+    :param batch_size: number of texts joined together, defaults to 1000
+    :type batch_size: int, optional
+    :return: the cleaned texts, in the same order
+    :rtype: List[str]
+    """
+    if text_cleaner not in (default_text_cleaner, text_cleaner_raw):
+        return [text_cleaner(text) for text in texts]
+    cleaned = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        joined = '\0'.join(batch)
+        # texts containing null characters would be split in several parts
+        if joined.count('\0') == len(batch) - 1:
+            cleaned.extend(text_cleaner(joined).split('\0'))
+        else:
+            cleaned.extend(text_cleaner(text) for text in batch)
+    return cleaned
+
+def tweet_tokenizer() -> Callable[[str], List[str]]:
+    """Returns the tokenizer used for the tweets
+
+    :rtype: str -> list[str]
+    """
+    return nltk.tokenize.TweetTokenizer(
+        preserve_case = False,
+        strip_handles = True, #removes things like: @bob ...,
+        reduce_len = True #more than 3 times same characters are limited waaaaayyyy -> waaayyy
+    ).tokenize
+
+# tokenizers and cleaners a Vocabulary can be saved with, by name
+TOKENIZERS = {
+    'tweet' : tweet_tokenizer,
+    'word' : lambda: nltk.word_tokenize,
+    'sent' : lambda: nltk.sent_tokenize,
+    'regex_tweet' : lambda: regex_tweet_tokenize,
+    'regex_word' : lambda: regex_word_tokenize
+}
+TEXT_CLEANERS = {
+    'default' : default_text_cleaner,
+    'raw' : text_cleaner_raw
+}
+# sentence splitters used by SequenceDataset on raw text
+SENTENCE_SPLITTERS = {
+    'nltk' : nltk.sent_tokenize,
+    'regex' : regex_sent_tokenize
+}
+
+def get_tokenizer(name : str) -> Callable[[str], List[str]]:
+    """Returns the tokenizer registered under name in TOKENIZERS
+
+    :param name: the tokenizer name
+    :type name: str
+    :raises ValueError: if the name is unknown
+    :rtype: str -> list[str]
+    """
+    if name not in TOKENIZERS:
+        raise ValueError(f'unknown tokenizer {name}, available tokenizers are {list(TOKENIZERS)}')
+    return TOKENIZERS[name]()
+
+def tokenizer_name(tokenizer : Callable[[str], List[str]]) -> str:
+    """Returns the name of a tokenizer in TOKENIZERS
+
+    :param tokenizer: the tokenizer
+    :type tokenizer: str -> list[str]
+    :return: its name, None if it is not registered
+    :rtype: str
+    """
+    for name in ['word', 'sent', 'regex_tweet', 'regex_word']:
+        if tokenizer is TOKENIZERS[name]():
+            return name
+    instance = getattr(tokenizer, '__self__', None)
+    if isinstance(instance, nltk.tokenize.TweetTokenizer) and tokenizer.__name__ == 'tokenize' \
+        and (instance.preserve_case, instance.strip_handles, instance.reduce_len) == (False, True, True):
+        return 'tweet'
+    return None
+
+def text_cleaner_name(text_cleaner : Callable[[str], str]) -> str:
+    """Returns the name of a text cleaner in TEXT_CLEANERS
+
+    :param text_cleaner: the cleaning function
+    :type text_cleaner: str -> str
+    :return: its name, None if it is not registered
+    :rtype: str
+    """
+    names = [name for name, cleaner in TEXT_CLEANERS.items() if cleaner is text_cleaner]
+    return names[0] if len(names) > 0 else None
+
 class Vocabulary():
     def __init__(
         self,
-        tokenizer : Callable[[str], List[str]],
-        text_cleaner,
+        tokenizer : Union[str, Callable[[str], List[str]]],
+        text_cleaner : Union[str, Callable[[str], str]],
         max_voc_size : int = 10000,
-        min_word_occ : int = 2
+        min_word_occ : int = 2,
+        sentence_splitter : str = 'nltk'
     ):
         """Vocabulary generated around textual data. Serves to
         convert ids to words and conversely.
 
+        The words are stored as numpy arrays: the sorted tokens, their ids and
+        their number of occurrences. The dictionaries word_to_idx, idx_to_word and
+        vocab are built from them at first access.
+
         :param tokenizer: a tokenizer that, given raw textual data will
-        generate a sequence of tokens
+        generate a sequence of tokens, or its name in TOKENIZERS. Only
+        named tokenizers can be saved with Vocabulary.save
         :type tokenizer: str -> list[str]
-        :param text_cleaner: cleaning function
+        :param text_cleaner: cleaning function or its name in TEXT_CLEANERS
         :type text_cleaner: str ->  str
         :param max_voc_size: maximum vocabulary size, defaults to 10000
         :type max_voc_size: int, optional
         :param min_word_occ: minimum number of times a wird most occur 
         to be taken into acount in the vocabulary, defaults to 2
         :type min_word_occ: int, optional
+        :param sentence_splitter: name in SENTENCE_SPLITTERS of the function splitting
+        raw text into sentences in SequenceDataset, defaults to 'nltk'
+        :type sentence_splitter: str, optional
         :raises NotImplementedError: raises an exception if instantiated
         """    
         if self.__class__ == Vocabulary:
@@ -83,14 +204,24 @@ class Vocabulary():
         or the FromTweetsVocabulary class
         """)
         
-        if tokenizer is not None:
+        if tokenizer is None:
+            tokenizer = 'sent'
+        if isinstance(tokenizer, str):
+            self.tokenizer_name = tokenizer
+            self.tokenizer = get_tokenizer(tokenizer)
+        else:
+            self.tokenizer_name = tokenizer_name(tokenizer)
             self.tokenizer = tokenizer
+        if text_cleaner is None:
+            text_cleaner = 'default'
+        if isinstance(text_cleaner, str):
+            self.text_cleaner_name = text_cleaner
+            self.text_cleaner = TEXT_CLEANERS[text_cleaner]
         else:
-            self.tokenizer = nltk.sent_tokenize
-        if text_cleaner is not None:
+            self.text_cleaner_name = text_cleaner_name(text_cleaner)
             self.text_cleaner = text_cleaner
-        else:
-            self.text_cleaner = default_text_cleaner
+        self.sentence_splitter_name = sentence_splitter
+        self.sentence_splitter = SENTENCE_SPLITTERS[sentence_splitter]
         
         self.padding_token, self.padding_idx = 'pad', 0
         self.unknown_token, self.unknown_idx = 'unk', 1
@@ -104,79 +235,345 @@ class Vocabulary():
         :param vocab: dictionary of words and their occurrences
         :type vocab: dict
         """
-        # sort voc and remove words not occuring enough
-        self.vocab = {
-            k: v 
-            for (k, v) in sorted(vocab.items(), key=lambda item: -item[1])
-            if v >= self.min_word_occ
-        }
+        # remove words not occuring enough and keep only the top words, the
+        # words with the same occurrences staying in their order of insertion
+        words = list(vocab.keys())
+        counts = np.fromiter(vocab.values(), dtype = np.int64, count = len(words))
+        selected = np.flatnonzero(counts >= self.min_word_occ)
+        top = max(self.max_voc_size - 2, 0)
+        if 0 < top < len(selected):
+            # partial selection of the candidates, ties with the last kept word included
+            threshold = np.partition(counts[selected], len(selected) - top)[len(selected) - top]
+            selected = selected[counts[selected] >= threshold]
+        selected = selected[np.argsort(-counts[selected], kind = 'stable')][:top]
+        vocab = {words[i] : int(counts[i]) for i in selected}
         logging.info('vocabulary sorted')
-        # keep only top words
-        self.vocab = {
-            k : v for i, (k,v) in enumerate(self.vocab.items()) if i < (self.max_voc_size - 2)
-        }
         
-        self.word_to_idx = {k : (i+2) for i,(k,_) in enumerate(self.vocab.items())}
-        self.word_to_idx[self.padding_token] = self.padding_idx
-        self.vocab[self.padding_token] = 1
-        self.word_to_idx[self.unknown_token] = self.unknown_idx
-        self.vocab[self.unknown_token] = 1
-        self.idx_to_word = {v : k for k, v in self.word_to_idx.items()}
+        word_to_idx = {k : (i+2) for i,(k,_) in enumerate(vocab.items())}
+        word_to_idx[self.padding_token] = self.padding_idx
+        vocab[self.padding_token] = 1
+        word_to_idx[self.unknown_token] = self.unknown_idx
+        vocab[self.unknown_token] = 1
+        self.set_words(word_to_idx, vocab)
 
         logging.info('vocabulary built')
 
+    def set_words(self, word_to_idx : dict, vocab : dict):
+        """Stores the vocabulary words as arrays sorted by token: self.tokens, their
+        ids self.ids and occurrences self.counts. self.order holds the positions in
+        self.tokens of the words in the order of vocab.
+
+        :param word_to_idx: words to ids mapping
+        :type word_to_idx: dict
+        :param vocab: words to occurrences mapping, with the same keys
+        :type vocab: dict
+        """
+        words = np.array(list(vocab.keys()), dtype = str)
+        sort = np.argsort(words, kind = 'stable')
+        self.tokens = words[sort]
+        self.ids = np.array([word_to_idx[word] for word in vocab], dtype = np.int64)[sort]
+        self.counts = np.array(list(vocab.values()), dtype = np.int64)[sort]
+        self.order = np.argsort(sort)
+        self.clear_lookups()
+
+    def clear_lookups(self):
+        """Removes the dictionaries and the fingerprint built from the arrays"""
+        self._word_to_idx, self._idx_to_word, self._vocab = None, None, None
+        self._fingerprint = None
+
+    @property
+    def word_to_idx(self) -> dict:
+        if self._word_to_idx is None:
+            self._word_to_idx = dict(zip(self.tokens[self.order].tolist(), self.ids[self.order].tolist()))
+        return self._word_to_idx
+
+    @property
+    def idx_to_word(self) -> dict:
+        if self._idx_to_word is None:
+            self._idx_to_word = {v : k for k, v in self.word_to_idx.items()}
+        return self._idx_to_word
+
+    @property
+    def vocab(self) -> dict:
+        if self._vocab is None:
+            self._vocab = dict(zip(self.tokens[self.order].tolist(), self.counts[self.order].tolist()))
+        return self._vocab
+
+    def encode(self, token_lists : List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps lists of tokens to their ids in bulk, unknown tokens being mapped to
+        the padding id. The ids of list i are ids[offsets[i]:offsets[i+1]].
+
+        :param token_lists: the lists of tokens
+        :type token_lists: List[List[str]]
+        :return: the flat int32 array of ids and the int64 offsets array
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        lengths = np.fromiter(map(len, token_lists), dtype = np.int64, count = len(token_lists))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        tokens = itertools.chain.from_iterable(token_lists)
+        ids = np.fromiter(
+            map(self.word_to_idx.get, tokens, itertools.repeat(self.padding_idx)),
+            dtype = np.int32,
+            count = offsets[-1]
+        )
+        return ids, offsets
+
     def get_vocab_size(self) -> int:
         """Returns the length of the Vocabulary
 
         :rtype: int
         """
-        return len(self.word_to_idx)
+        return len(self.tokens)
+
+    def fingerprint(self) -> str:
+        """Hash of the word to id mapping and of the names of the tokenizer, cleaner and
+        sentence splitter used. Two vocabularies with the same fingerprint encode texts
+        the same way. It is computed once, until the words change.
+
+        :return: the hexadecimal sha1 digest, None if the tokenizer or the text cleaner
+            is not registered, as its configuration is then unknown
+        :rtype: str
+        """
+        if self.tokenizer_name is None or self.text_cleaner_name is None:
+            return None
+        if getattr(self, '_fingerprint', None) is None:
+            digest = hashlib.sha1()
+            for name in (self.tokenizer_name, self.text_cleaner_name, self.sentence_splitter_name):
+                digest.update(f'{name}\n'.encode())
+            for idx, word in sorted(self.idx_to_word.items()):
+                digest.update(f'{idx}\t{word}\n'.encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def save(self, path : str):
+        """Saves the vocabulary in the folder path, without pickle: the arrays as
+        .npy files and the other attributes in a json file. A .pickle extension
+        is removed from path, as done by load_vocabulary.
+
+        :param path: the vocabulary folder
+        :type path: str
+        :raises ValueError: if the tokenizer or the text cleaner is not registered
+        """
+        if self.tokenizer_name is None or self.text_cleaner_name is None:
+            raise ValueError('only vocabularies with a named tokenizer and text cleaner can be saved')
+        path = re.sub(r'\.pickle$', '', path)
+        make_dir_if_not_exists(path)
+        for name in VOCABULARY_ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'vocabulary.json'), 'w') as f:
+            json.dump({
+                'class' : self.__class__.__name__,
+                'tokenizer' : self.tokenizer_name,
+                'text_cleaner' : self.text_cleaner_name,
+                'sentence_splitter' : self.sentence_splitter_name,
+                'max_voc_size' : self.max_voc_size,
+                'min_word_occ' : self.min_word_occ
+            }, f, indent = 4)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_word_to_idx = None, _idx_to_word = None, _vocab = None, _fingerprint = None)
+        return state
+
+    def __setstate__(self, state):
+        if 'word_to_idx' in state:
+            # vocabulary pickled before the arrays were introduced
+            word_to_idx, vocab = state.pop('word_to_idx'), state.pop('vocab')
+            state.pop('idx_to_word', None)
+            state['tokenizer_name'] = tokenizer_name(state['tokenizer'])
+            state['text_cleaner_name'] = text_cleaner_name(state['text_cleaner'])
+            state['sentence_splitter_name'] = 'nltk'
+            state['sentence_splitter'] = SENTENCE_SPLITTERS['nltk']
+            self.__dict__.update(state)
+            self.set_words(word_to_idx, vocab)
+        else:
+            self.__dict__.update(state)
+
+def count_shard_tokens(
+    texts : List[str],
+    tokenizer : Callable[[str], List[str]],
+    text_cleaner : Callable[[str], str] = None,
+    alpha_only : bool = False
+) -> Counter:
+    """Counts the tokens of a list of texts
+
+    :param texts: the texts
+    :type texts: List[str]
+    :param tokenizer: the tokenizer
+    :type tokenizer: str -> list[str]
+    :param text_cleaner: cleaning function applied before tokenizing, defaults to None
+    :type text_cleaner: str -> str, optional
+    :param alpha_only: whether to only count alphabetic tokens, defaults to False
+    :type alpha_only: bool, optional
+    :return: the occurrences of the tokens, in their order of first occurrence
+    :rtype: Counter
+    """
+    counts = Counter()
+    if text_cleaner is not None:
+        texts = clean_many(texts, text_cleaner)
+    for text in texts:
+        tokens = tokenizer(text)
+        counts.update([token for token in tokens if token.isalpha()] if alpha_only else tokens)
+    return counts
+
+def count_tokens(
+    texts : Iterable[str],
+    tokenizer : Callable[[str], List[str]],
+    text_cleaner : Callable[[str], str] = None,
+    alpha_only : bool = False,
+    num_workers : int = 0,
+    shard_size : int = 10000,
+    with_tqdm : bool = False
+) -> Counter:
+    """Counts the tokens of the texts. With num_workers > 0, the texts are split in
+    shards of shard_size texts counted by a pool of processes, at most 2 * num_workers
+    shards being in memory at once. The shard counts are merged in order, so the
+    result, order of first occurrence included, is the same as with num_workers = 0.
+
+    :param texts: the texts, possibly a generator
+    :type texts: Iterable[str]
+    :param tokenizer: the tokenizer, must be picklable when num_workers > 0
+    :type tokenizer: str -> list[str]
+    :param text_cleaner: cleaning function applied before tokenizing, defaults to None
+    :type text_cleaner: str -> str, optional
+    :param alpha_only: whether to only count alphabetic tokens, defaults to False
+    :type alpha_only: bool, optional
+    :param num_workers: number of processes, defaults to 0 (counted in this process)
+    :type num_workers: int, optional
+    :param shard_size: number of texts per shard, defaults to 10000
+    :type shard_size: int, optional
+    :param with_tqdm: Displays the number of texts counted, defaults to False
+    :type with_tqdm: bool, optional
+    :return: the occurrences of the tokens, in their order of first occurrence
+    :rtype: Counter
+    """
+    texts = iter(texts)
+    shards = iter(lambda: list(itertools.islice(texts, shard_size)), [])
+    progress = tqdm(unit = 'texts', disable = not with_tqdm)
+    counts = Counter()
+    if num_workers == 0:
+        for shard in shards:
+            counts.update(count_shard_tokens(shard, tokenizer, text_cleaner, alpha_only))
+            progress.update(len(shard))
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            pending = deque()
+            for shard in itertools.chain(shards, [None]):
+                if shard is not None:
+                    pending.append((len(shard), executor.submit(count_shard_tokens, shard, tokenizer, text_cleaner, alpha_only)))
+                while len(pending) > 0 and (shard is None or len(pending) >= 2 * num_workers):
+                    num_texts, future = pending.popleft()
+                    counts.update(future.result())
+                    progress.update(num_texts)
+    progress.close()
+    return counts
 
 class FromRawTextVocabulary(Vocabulary):
     def __init__(
         self,
-        text : str,
+        text : Union[str, Iterable[str]],
+        num_workers : int = 0,
         **kwargs
     ):
-        """Vocabulary builder from raw textual data
+        """Vocabulary builder from raw textual data. The text can also be given as
+        an iterable of texts, for instance the articles, in which case each of them
+        is cleaned and tokenized separately (the tokens spanning two texts of the
+        joined text are not counted) and they can be counted in parallel.
 
-        :param text: input textual data
-        :type text: str
+        :param text: input textual data, or an iterable of texts
+        :type text: Union[str, Iterable[str]]
+        :param num_workers: number of processes counting the texts, defaults to 0
+        :type num_workers: int, optional
         """
         super(FromRawTextVocabulary, self).__init__(**kwargs)
-        text = self.text_cleaner(text)
-        tokens = self.tokenizer(text)
-        vocab = {}
-        for token in tokens:
-            if token in vocab.keys():
-                vocab[token] += 1
-            else:
-                vocab[token] = 1
+        if isinstance(text, str):
+            vocab = Counter(self.tokenizer(self.text_cleaner(text)))
+        else:
+            vocab = count_tokens(
+                text,
+                tokenizer = self.tokenizer,
+                text_cleaner = self.text_cleaner,
+                num_workers = num_workers,
+                shard_size = 100,
+                with_tqdm = True
+            )
         self.build_vocab(vocab)
 
 class FromTweetsVocabulary(Vocabulary):
     def __init__(
         self,
-        tweets : List[str],
+        tweets : Iterable[str],
+        num_workers : int = 0,
         **kwargs
     ):
         """Vocabulary builder from list of texts
 
         :param tweets: list of textual inputs
-        :type tweets: List[str]
+        :type tweets: Iterable[str]
+        :param num_workers: number of processes counting the tweets, defaults to 0
+        :type num_workers: int, optional
         """    
         super(FromTweetsVocabulary, self).__init__(**kwargs)
-        vocab = {}
-        for tweet in tqdm(tweets):
-            for token in self.tokenizer(tweet):
-                if token.isalpha():
-                    if token in vocab.keys():
-                        vocab[token] += 1
-                    else:
-                        vocab[token] = 1
+        vocab = count_tokens(
+            tweets,
+            tokenizer = self.tokenizer,
+            alpha_only = True,
+            num_workers = num_workers,
+            with_tqdm = True
+        )
         self.build_vocab(vocab)
         
 
+# arrays saved by Vocabulary.save
+VOCABULARY_ARRAYS = ['tokens', 'ids', 'counts', 'order']
+
+def load_vocabulary(path : str) -> Vocabulary:
+    """Loads a vocabulary saved with Vocabulary.save, its arrays being
+    memory-mapped. If path is not a folder, or ends with .pickle and the
+    folder without the extension does not exist, the vocabulary is unpickled.
+
+    :param path: the vocabulary folder or pickle file
+    :type path: str
+    :raises FileNotFoundError: if no vocabulary is found
+    :rtype: Vocabulary
+    """
+    folder = re.sub(r'\.pickle$', '', path)
+    if not os.path.isdir(folder):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    with open(os.path.join(folder, 'vocabulary.json'), 'r') as f:
+        meta = json.load(f)
+    classes = {cls.__name__ : cls for cls in [FromRawTextVocabulary, FromTweetsVocabulary]}
+    vocabulary = classes[meta['class']].__new__(classes[meta['class']])
+    Vocabulary.__init__(vocabulary, **{k : v for k, v in meta.items() if k != 'class'})
+    for name in VOCABULARY_ARRAYS:
+        setattr(vocabulary, name, np.load(os.path.join(folder, f'{name}.npy'), mmap_mode = 'r'))
+    vocabulary.clear_lookups()
+    return vocabulary
+
+def encode_texts(
+    texts : List[str],
+    vocabulary : Vocabulary,
+    with_tqdm : bool = False
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Cleans, tokenizes and encodes texts with a vocabulary. The ids of text i
+    are ids[offsets[i]:offsets[i+1]].
+
+    :param texts: the texts to encode
+    :type texts: List[str]
+    :param vocabulary: the vocabulary
+    :type vocabulary: Vocabulary
+    :param with_tqdm: Disaplays the encoding progress, defaults to False
+    :type with_tqdm: bool, optional
+    :return: the flat int32 array of token ids and the int64 offsets array
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    tokenizer = vocabulary.tokenizer
+    texts = clean_many(texts, vocabulary.text_cleaner)
+    token_lists = [tokenizer(text) for text in (tqdm(texts) if with_tqdm else texts)]
+    return vocabulary.encode(token_lists)
+
 class SequenceDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -185,9 +582,26 @@ class SequenceDataset(torch.utils.data.Dataset):
         min_seq_length : int,
         max_seq_length : int,
         device : str,
-        with_tqdm = True
+        with_tqdm = True,
+        cache_folder : str = None,
+        num_workers : int = 0,
+        packed : bool = False,
+        separator_idx : int = None,
+        repeats : int = 1
     ):
         """Dataset class containing sequences of token ids each of same length.
+        If a cache folder is given, the token matrix is stored there as a .npy file
+        and memory-mapped by the next datasets built from the same text, vocabulary
+        and sequence lengths instead of tokenizing the text again. Only vocabularies
+        with a registered tokenizer and text cleaner (see Vocabulary.fingerprint)
+        can be cached.
+        With num_workers > 0, the sentences are tokenized by chunks in a pool of
+        processes, giving the same token matrix.
+        When packed, the sentences are concatenated into a single stream, separated
+        by separator_idx, and cut into full rows (see pack), so that only the last
+        row is padded.
+        With repeats > 1, the dataset is the one of text * repeats, but the text is
+        only tokenized once and its ids are tiled (see encode_repeated).
 
         :param vocabulary: A vocabulary to map words to ids
         :type vocabulary: Vocabulary
@@ -202,56 +616,348 @@ class SequenceDataset(torch.utils.data.Dataset):
         :type device: str
         :param with_tqdm: Disaplays the sequence creation progress, defaults to True
         :type with_tqdm: bool, optional
+        :param cache_folder: where to cache the token matrix, defaults to None (no cache)
+        :type cache_folder: str, optional
+        :param num_workers: number of tokenizing processes, defaults to 0 (tokenized in this process)
+        :type num_workers: int, optional
+        :param packed: whether to pack the sentences instead of padding each of them, defaults to False
+        :type packed: bool, optional
+        :param separator_idx: the id inserted between two packed sentences, defaults to
+            None (the unknown token id, the unknown token being removed by the text cleaners)
+        :type separator_idx: int, optional
+        :param repeats: number of times the text is repeated, defaults to 1
+        :type repeats: int, optional
         """
-        self.vocabulary = vocabulary
-        self.max_seq_length = max_seq_length
-        self.device = device
-        if isinstance(text, str):
-            text = re.sub(r'\n', ' ', text)
-            text = re.sub(r' {2,}', ' ', text)
-            text = nltk.sent_tokenize(text)
-        elif isinstance(text, List):
+        self.set_parameters(vocabulary, min_seq_length, max_seq_length, device, packed, separator_idx, repeats)
+        if cache_folder is not None and vocabulary.fingerprint() is None:
+            logging.warning('the tokenizer or the text cleaner of the vocabulary is not registered, the dataset is not cached')
+            cache_folder = None
+        if cache_folder is not None:
+            cache_file = os.path.join(cache_folder, f'{self.cache_key(text)}.npy')
+            if os.path.exists(cache_file):
+                self.load_tokens(cache_file)
+                self.cache_file = cache_file
+                return
+
+        if isinstance(text, List):
             if not isinstance(text[0], str):
                 print("text should be either a list of str or a str")
-        else:
+        elif not isinstance(text, str):
             print("text should be either a list of str or a str") 
         
-        tokens = [
-            [self.get_idx(w) for w in vocabulary.tokenizer(vocabulary.text_cleaner(sentence))]
-            for sentence in (tqdm(text) if with_tqdm else text)
-        ]
-        self.tokens = np.concatenate([
-            self.pad_and_truncate(sequence) 
-            for sequence in tokens 
-            if len(sequence) > min_seq_length and sum(sequence) > 1
+        if repeats != 1:
+            ids, offsets = self.encode_repeated(text, repeats, with_tqdm = with_tqdm, num_workers = num_workers)
+        else:
+            if isinstance(text, str):
+                text = self.split_sentences(text)
+            ids, offsets = self.encode(text, with_tqdm = with_tqdm, num_workers = num_workers)
+        self.tokens = self.pack(ids, offsets) if packed else self.pad_and_truncate(ids, offsets)
+        if cache_folder is not None:
+            make_dir_if_not_exists(cache_folder)
+            self.save_tokens(cache_file)
+            # reopens the matrix memory-mapped to share its pages with the other processes
+            self.load_tokens(cache_file)
+            self.cache_file = cache_file
+
+    def set_parameters(
+        self,
+        vocabulary : Vocabulary,
+        min_seq_length : int,
+        max_seq_length : int,
+        device : str,
+        packed : bool = False,
+        separator_idx : int = None,
+        repeats : int = 1
+    ):
+        """Sets the parameters of the dataset, see __init__"""
+        self.vocabulary = vocabulary
+        self.min_seq_length = min_seq_length
+        self.max_seq_length = max_seq_length
+        self.packed = packed
+        self.separator_idx = vocabulary.unknown_idx if separator_idx is None else separator_idx
+        self.repeats = repeats
+        self.device = device
+        self.tensor = None
+        # multiplicity of every row, only set on deduplicated datasets
+        self.counts = None
+        # the .npy file of the token matrix, only set on cached datasets
+        self.cache_file = None
+
+    @classmethod
+    def from_cache_file(
+        cls,
+        cache_file : str,
+        vocabulary : Vocabulary,
+        min_seq_length : int,
+        max_seq_length : int,
+        device : str,
+        packed : bool = False,
+        separator_idx : int = None,
+        repeats : int = 1
+    ) -> 'SequenceDataset':
+        """Reopens the dataset whose token matrix was cached in cache_file, without
+        its text. The parameters must be the ones the dataset was built with.
+
+        :param cache_file: the cache_file of the dataset
+        :type cache_file: str
+        :return: the dataset, with its token matrix memory-mapped
+        :rtype: SequenceDataset
+        """
+        dataset = cls.__new__(cls)
+        dataset.set_parameters(vocabulary, min_seq_length, max_seq_length, device, packed, separator_idx, repeats)
+        dataset.load_tokens(cache_file)
+        dataset.cache_file = cache_file
+        return dataset
+
+    def cache_key(self, text : Union[str, List[str]]) -> str:
+        """Computes the key identifying the token matrix built from the given text with
+        the current vocabulary and sequence lengths.
+
+        :param text: the raw text given to the dataset
+        :type text: Union[str, List[str]]
+        :return: the hexadecimal sha1 key
+        :rtype: str
+        """
+        text_digest = hashlib.sha1()
+        for sentence in ([text] if isinstance(text, str) else text):
+            text_digest.update(sentence.encode())
+            text_digest.update(b'\0')
+        key = '_'.join([
+            self.vocabulary.fingerprint(),
+            'str' if isinstance(text, str) else 'list',
+            text_digest.hexdigest(),
+            str(self.min_seq_length),
+            str(self.max_seq_length)
+        ] + ([f'packed{self.separator_idx}'] if self.packed else [])
+          + ([f'repeats{self.repeats}'] if self.repeats != 1 else []))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def save_tokens(self, path : str):
+        """Saves the token matrix as a .npy file. The file is written under a temporary
+        name first so that concurrent readers never see a partial file.
+
+        :param path: the .npy file path
+        :type path: str
+        """
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, self.tokens)
+        os.replace(temp_path, path)
+
+    def load_tokens(self, path : str):
+        """Loads the token matrix memory-mapped from a .npy file
+
+        :param path: the .npy file path
+        :type path: str
+        """
+        self.tokens = np.load(path, mmap_mode = 'r')
+        self.tensor = None
+
+    def split_sentences(self, text : str) -> List[str]:
+        """Splits a raw text into sentences with the sentence splitter of the vocabulary
+
+        :param text: the raw text
+        :type text: str
+        :rtype: List[str]
+        """
+        text = re.sub(r'\n', ' ', text)
+        text = re.sub(r' {2,}', ' ', text)
+        return self.vocabulary.sentence_splitter(text)
+
+    @staticmethod
+    def tile(ids : np.ndarray, offsets : np.ndarray, repeats : int) -> Tuple[np.ndarray, np.ndarray]:
+        """Repeats the sentences given by their flat ids and offsets
+
+        :param ids: the flat array of token ids
+        :type ids: np.ndarray
+        :param offsets: the start of every sentence in ids, followed by len(ids)
+        :type offsets: np.ndarray
+        :param repeats: number of repetitions
+        :type repeats: int
+        :return: the tiled ids and offsets
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        shifts = len(ids) * np.arange(repeats, dtype = np.int64)
+        tiled_offsets = np.concatenate(([0], (offsets[1:][None, :] + shifts[:, None]).reshape(-1)))
+        return np.tile(ids, repeats), tiled_offsets
+
+    def encode_repeated(
+        self,
+        text : Union[str, List[str]],
+        repeats : int,
+        with_tqdm : bool = True,
+        num_workers : int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Gives the ids and offsets of text * repeats while only tokenizing text (and
+        twice the text if it is a str). A list is a list of independent sentences,
+        which are simply tiled. The sentences of a str are found by the sentence
+        splitter on the repeated string: its ids are tiled if two copies give the
+        sentences of one copy twice, or a single sentence of twice its ids. Otherwise,
+        the repeated text is tokenized as a whole, e.g. with the regex splitter and a
+        cleaner keeping the final period (text_cleaner_raw), the last sentence of a copy
+        is joined with the next copy. The path taken is logged.
+
+        :param text: the text to repeat
+        :type text: Union[str, List[str]]
+        :param repeats: number of repetitions
+        :type repeats: int
+        :param with_tqdm: Disaplays the encoding progress, defaults to True
+        :type with_tqdm: bool, optional
+        :param num_workers: number of processes, defaults to 0 (encoded in this process)
+        :type num_workers: int, optional
+        :return: the flat int32 array of token ids and the int64 offsets array
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        if isinstance(text, List):
+            return self.tile(*self.encode(text, with_tqdm = with_tqdm, num_workers = num_workers), repeats)
+
+        ids, offsets = self.encode(self.split_sentences(text), with_tqdm = False)
+        twice_ids, twice_offsets = self.encode(self.split_sentences(text * 2), with_tqdm = False)
+        if np.array_equal(twice_ids, np.tile(ids, 2)):
+            if np.array_equal(twice_offsets, self.tile(ids, offsets, 2)[1]):
+                logging.info('repeated text tokenized once, its sentences are tiled')
+                return self.tile(ids, offsets, repeats)
+            if len(offsets) == 2 and len(twice_offsets) == 2:
+                # the text is a single sentence continued by its next copy
+                logging.info('repeated text tokenized once, its single sentence is tiled')
+                return np.tile(ids, repeats), np.array([0, len(ids) * repeats], dtype = np.int64)
+        logging.info('the sentences of the repeated text do not repeat, tokenizing it as a whole')
+        return self.encode(self.split_sentences(text * repeats), with_tqdm = with_tqdm, num_workers = num_workers)
+
+    def encode(
+        self,
+        text : List[str],
+        with_tqdm : bool = True,
+        num_workers : int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Tokenizes the given sentences and writes their token ids in a single
+        flat array. The ids of sentence i are ids[offsets[i]:offsets[i+1]].
+        With num_workers > 0, the sentences are split in 4 * num_workers chunks
+        encoded by a pool of processes and reassembled in order.
+
+        :param text: the sentences to encode
+        :type text: List[str]
+        :param with_tqdm: Disaplays the encoding progress, defaults to True
+        :type with_tqdm: bool, optional
+        :param num_workers: number of processes, defaults to 0 (encoded in this process)
+        :type num_workers: int, optional
+        :return: the flat int32 array of token ids and the int64 offsets array
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        if num_workers == 0 or len(text) == 0:
+            return encode_texts(text, self.vocabulary, with_tqdm = with_tqdm)
+
+        chunk_size = math.ceil(len(text) / (4 * num_workers))
+        chunks = [text[start:start + chunk_size] for start in range(0, len(text), chunk_size)]
+        with ProcessPoolExecutor(num_workers) as executor:
+            # map returns the results in the order of the chunks
+            results = list(tqdm(
+                executor.map(encode_texts, chunks, itertools.repeat(self.vocabulary)),
+                total = len(chunks),
+                disable = not with_tqdm
+            ))
+        ids = np.concatenate([chunk_ids for chunk_ids, _ in results])
+        chunk_starts = np.cumsum([0] + [len(chunk_ids) for chunk_ids, _ in results])
+        offsets = np.concatenate([[0]] + [
+            chunk_offsets[1:] + chunk_start for (_, chunk_offsets), chunk_start in zip(results, chunk_starts)
         ])
-        
-    def pad_and_truncate(self, sequence : List[int]) -> List[List[int]]:
-        """Given a list of integers, will split it onto a list of lists of
-        equal self.max_seq_length size and add 0s to the last one to fill it
-
-        :param sequence: the list of token ids
-        :type sequence: list[int]
-        :return: a list of lists of token ids
-        :rtype: list[list[int]]
-        """
-        sequence = np.array(sequence)
-        # this makes the sequence the correct size by adding padding at the last one
-        rest = len(sequence) % self.max_seq_length
-        if rest > 1: # we verify that the last sequence is at least 2 words long
-            sequence = np.concatenate((sequence, [self.vocabulary.padding_idx] * (self.max_seq_length - rest)))
-        elif rest == 1: # otherwise we remove it
-            sequence = sequence[:-1]
-        return sequence.reshape(-1, self.max_seq_length)
+        return ids, offsets
+
+    def pad_and_truncate(self, ids : np.ndarray, offsets : np.ndarray) -> np.ndarray:
+        """Given the flat token ids of all the sentences, removes the sentences that
+        are too short (or only made of unknown tokens), splits the others into rows
+        of self.max_seq_length ids and adds padding to the last row of each sentence.
+        A last row of a single token is removed instead.
+
+        :param ids: the flat array of token ids
+        :type ids: np.ndarray
+        :param offsets: the start of every sentence in ids, followed by len(ids)
+        :type offsets: np.ndarray
+        :return: the token ids matrix of shape [number of rows, self.max_seq_length]
+        :rtype: np.ndarray
+        """
+        length = self.max_seq_length
+        lengths = np.diff(offsets)
+        keep = self.kept_sentences(ids, offsets)
+
+        rest = lengths % length
+        # the last row is padded if at least 2 words long, otherwise it is removed
+        num_rows = np.where(keep, lengths // length + (rest > 1), 0)
+        kept_lengths = np.where(keep, lengths - (rest == 1), 0)
+        row_starts = np.cumsum(num_rows) - num_rows
+
+        # position of every token in the flattened matrix
+        positions = np.arange(len(ids)) + np.repeat(row_starts * length - offsets[:-1], lengths)
+        in_sequence = np.arange(len(ids)) - np.repeat(offsets[:-1], lengths)
+        valid = in_sequence < np.repeat(kept_lengths, lengths)
+
+        tokens = np.full((num_rows.sum(), length), self.vocabulary.padding_idx, dtype = np.int64)
+        tokens.reshape(-1)[positions[valid]] = ids[valid]
+        return tokens
+
+    def kept_sentences(self, ids : np.ndarray, offsets : np.ndarray) -> np.ndarray:
+        """Finds the sentences longer than self.min_seq_length that are not only made
+        of unknown tokens.
+
+        :param ids: the flat array of token ids
+        :type ids: np.ndarray
+        :param offsets: the start of every sentence in ids, followed by len(ids)
+        :type offsets: np.ndarray
+        :return: the boolean mask of the kept sentences
+        :rtype: np.ndarray
+        """
+        lengths = np.diff(offsets)
+        cumulated_ids = np.concatenate(([0], np.cumsum(ids, dtype = np.int64)))
+        sums = cumulated_ids[offsets[1:]] - cumulated_ids[offsets[:-1]]
+        return (lengths > self.min_seq_length) & (sums > 1)
+
+    def pack(self, ids : np.ndarray, offsets : np.ndarray) -> np.ndarray:
+        """Given the flat token ids of all the sentences, removes the same sentences as
+        pad_and_truncate, concatenates the others into a stream with self.separator_idx
+        between two sentences and cuts the stream into rows of self.max_seq_length ids.
+        Only the last row is padded, or removed if it has a single token.
+
+        :param ids: the flat array of token ids
+        :type ids: np.ndarray
+        :param offsets: the start of every sentence in ids, followed by len(ids)
+        :type offsets: np.ndarray
+        :return: the token ids matrix of shape [number of rows, self.max_seq_length]
+        :rtype: np.ndarray
+        """
+        length = self.max_seq_length
+        lengths = np.diff(offsets)
+        keep = self.kept_sentences(ids, offsets)
+        kept_ids = ids[np.repeat(keep, lengths)]
+        stream = np.insert(kept_ids, np.cumsum(lengths[keep])[:-1], self.separator_idx)
+
+        num_rows = len(stream) // length + (len(stream) % length > 1)
+        tokens = np.full((num_rows, length), self.vocabulary.padding_idx, dtype = np.int64)
+        stream = stream[:num_rows * length]
+        tokens.reshape(-1)[:len(stream)] = stream
+        return tokens
+
+    def padding_fraction(self) -> float:
+        """Fraction of the token matrix made of the padding that follows the last
+        token of each row, i.e. the share of the forward and backward computation
+        spent on padding.
+
+        :rtype: float
+        """
+        if self.tokens.size == 0:
+            return 0.
+        is_token = self.tokens != self.vocabulary.padding_idx
+        trailing = np.where(
+            is_token.any(axis = 1),
+            np.argmax(is_token[:, ::-1], axis = 1),
+            self.max_seq_length
+        )
+        return trailing.sum() / self.tokens.size
 
     def token_len(self) -> int:
         """
         counts the number of tokens in the dataset
         """
-        total = 0
-        for tokens in self.tokens:
-            total += sum(tokens > 0)
-        return total
+        return np.count_nonzero(self.tokens)
 
     def get_idx(self, token) -> int:
         """Gets the id of the token from the vocabulary
@@ -266,13 +972,270 @@ class SequenceDataset(torch.utils.data.Dataset):
         except KeyError:
             return self.vocabulary.padding_idx
         
+    def as_tensor(self) -> torch.Tensor:
+        """Returns the token matrix as a tensor on the dataset device. The tensor
+        is only created once, at the first call.
+
+        :return: the token ids tensor of shape [len(self), self.max_seq_length]
+        :rtype: torch.Tensor
+        """
+        if self.tensor is None:
+            with warnings.catch_warnings():
+                # memory-mapped token matrices are read-only, the tensor is never written to
+                warnings.simplefilter('ignore', UserWarning)
+                self.tensor = torch.as_tensor(self.tokens).to(self.device)
+        return self.tensor
+
+    def deduplicate(self) -> 'SequenceDataset':
+        """Returns a copy of the dataset where the duplicated rows are only kept once,
+        in the order of their first occurrence. The number of occurrences of every
+        row is kept in the counts tensor, which the metrics of the model use as weights.
+
+        :return: the deduplicated dataset
+        :rtype: SequenceDataset
+        """
+        rows, first_indices, counts = np.unique(
+            self.tokens, axis = 0, return_index = True, return_counts = True
+        )
+        order = np.argsort(first_indices)
+        dataset = SequenceDataset.__new__(SequenceDataset)
+        dataset.__dict__.update(self.__dict__)
+        dataset.tokens = rows[order]
+        dataset.tensor = None
+        dataset.counts = torch.as_tensor(counts[order]).to(self.device)
+        dataset.cache_file = None
+        return dataset
+
     def __getitem__(self, idx):
-        return torch.tensor(self.tokens[idx]).to(self.device)
+        return self.as_tensor()[idx]
         
     def __len__(self):
         return len(self.tokens)
 
+class SequenceDataLoader():
+    def __init__(
+        self,
+        dataset : SequenceDataset,
+        batch_size : int = 1,
+        shuffle : bool = False,
+        drop_last : bool = False
+    ):
+        """Batch loader over a SequenceDataset. Instead of collating the rows one
+        by one, batches are contiguous slices of the dataset tensor or, when shuffling,
+        a single index_select gather of it.
+
+        :param dataset: the dataset to iterate over
+        :type dataset: SequenceDataset
+        :param batch_size: number of sequences per batch, defaults to 1
+        :type batch_size: int, optional
+        :param shuffle: whether to shuffle the sequences at every iteration, defaults to False
+        :type shuffle: bool, optional
+        :param drop_last: whether to drop the last incomplete batch, defaults to False
+        :type drop_last: bool, optional
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
 
+    def __iter__(self):
+        for batch, _ in self.batches_with_counts():
+            yield batch
+
+    def batches_with_counts(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        """Iterates over the batches along with the counts of their rows if the
+        dataset is deduplicated (see SequenceDataset.deduplicate), None otherwise.
+
+        :rtype: Iterator[Tuple[torch.Tensor, torch.Tensor]]
+        """
+        data = self.dataset.as_tensor()
+        counts = self.dataset.counts
+        num_sequences = len(data)
+        stop = num_sequences - num_sequences % self.batch_size if self.drop_last else num_sequences
+        if self.shuffle:
+            order = torch.randperm(num_sequences).to(data.device)
+            for start in range(0, stop, self.batch_size):
+                indices = order[start:start + self.batch_size]
+                yield data.index_select(0, indices), None if counts is None else counts.index_select(0, indices)
+        else:
+            for start in range(0, stop, self.batch_size):
+                yield data[start:start + self.batch_size], None if counts is None else counts[start:start + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
+
+class NodeDataStore():
+    # files composing a node data store inside the nodes data folder
+    ARENA_FILE = 'nodes_texts.bin'
+    OFFSETS_FILE = 'nodes_offsets.npy'
+    INDEX_FILE = 'nodes_index.npy'
+    META_FILE = 'nodes_meta.json'
+
+    def __init__(self, folder : str):
+        """Read access to the nodes data written by NodeDataStore.write. All the
+        texts are utf-8 encoded one after the other in a single arena file, the
+        offsets table gives the byte boundaries of each text and the index gives,
+        for each node id, the range of its texts in the offsets table. The three
+        arrays are memory-mapped so that reading a node only touches its slice.
+
+        :param folder: the nodes data folder
+        :type folder: str
+        """
+        self.folder = folder
+        self.offsets = np.load(os.path.join(folder, self.OFFSETS_FILE), mmap_mode = 'r')
+        self.index = np.load(os.path.join(folder, self.INDEX_FILE), mmap_mode = 'r')
+        if self.offsets[-1] > 0:
+            self.arena = np.memmap(os.path.join(folder, self.ARENA_FILE), dtype = np.uint8, mode = 'r')
+        else:
+            # np.memmap can't map an empty file
+            self.arena = np.zeros(0, dtype = np.uint8)
+        with open(os.path.join(folder, self.META_FILE), 'r') as f:
+            self.names = {int(node_id) : name for node_id, name in json.load(f)['names'].items()}
+
+    @classmethod
+    def exists(cls, folder : str) -> bool:
+        """Whether folder contains a node data store
+
+        :param folder: the nodes data folder
+        :type folder: str
+        :rtype: bool
+        """
+        return all(
+            os.path.exists(os.path.join(folder, file))
+            for file in [cls.ARENA_FILE, cls.OFFSETS_FILE, cls.INDEX_FILE, cls.META_FILE]
+        )
+
+    @classmethod
+    def write(cls, folder : str, nodes : Iterable[Tuple[int, List[str], str]]):
+        """Writes the nodes data into a store in folder. The texts are streamed to
+        the arena file, so nodes can be a generator. If a node id is given several
+        times, the last one is kept, as when several pickle files match a node id.
+
+        :param folder: the nodes data folder
+        :type folder: str
+        :param nodes: (node id, texts, name) tuples, name being the legacy file name
+            without extension, e.g. node_1_120
+        :type nodes: Iterable[Tuple[int, List[str], str]]
+        """
+        offsets = [0]
+        ranges = {}
+        names = {}
+        with open(os.path.join(folder, cls.ARENA_FILE), 'wb') as f:
+            for node_id, texts, name in nodes:
+                start = len(offsets) - 1
+                for text in texts:
+                    encoded = text.encode('utf-8')
+                    f.write(encoded)
+                    offsets.append(offsets[-1] + len(encoded))
+                ranges[int(node_id)] = (start, len(offsets) - 1)
+                names[int(node_id)] = name
+
+        index = np.full((max(ranges, default = 0) + 1, 2), -1, dtype = np.int64)
+        for node_id, (start, stop) in ranges.items():
+            index[node_id] = (start, stop)
+        np.save(os.path.join(folder, cls.OFFSETS_FILE), np.array(offsets, dtype = np.int64))
+        np.save(os.path.join(folder, cls.INDEX_FILE), index)
+        with open(os.path.join(folder, cls.META_FILE), 'w') as f:
+            json.dump({'num_nodes' : len(names), 'names' : names}, f)
+
+    def __contains__(self, node_id : int) -> bool:
+        return 0 <= node_id < len(self.index) and self.index[node_id, 0] >= 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def name(self, node_id : int) -> str:
+        """Returns the legacy file name of a node, e.g. node_1_120
+
+        :param node_id: the node id
+        :type node_id: int
+        :rtype: str
+        """
+        return self.names[node_id]
+
+    def get(self, node_id : int) -> List[str]:
+        """Returns the texts of a node
+
+        :param node_id: the node id
+        :type node_id: int
+        :raises KeyError: if the node is not in the store
+        :rtype: List[str]
+        """
+        if node_id not in self:
+            raise KeyError(f'node {node_id} is not in the store {self.folder}')
+        start, stop = self.index[node_id]
+        offsets = np.asarray(self.offsets[start:stop + 1]) - self.offsets[start]
+        raw = self.arena[self.offsets[start]:self.offsets[stop]].tobytes()
+        return [raw[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+def save_nodes_data(
+    nodes : Iterable[Tuple[int, List[str], str]],
+    nodes_data_folder : str,
+    nodes_data_store : bool = False
+):
+    """Saves the nodes data, either as one pickle file per node or as a single
+    NodeDataStore.
+
+    :param nodes: (node id, texts, name) tuples, name being the file name without extension
+    :type nodes: Iterable[Tuple[int, List[str], str]]
+    :param nodes_data_folder: where to save the nodes data
+    :type nodes_data_folder: str
+    :param nodes_data_store: whether to write a NodeDataStore, defaults to False
+    :type nodes_data_store: bool, optional
+    """
+    if nodes_data_store:
+        NodeDataStore.write(nodes_data_folder, nodes)
+    else:
+        for _, texts, name in nodes:
+            with open(os.path.join(nodes_data_folder, f'{name}.pickle'), 'wb') as f:
+                pickle.dump(texts, f)
+
+
+# columns of the tweets_{id}.csv files used to generate the data
+TWEETS_COLUMNS = ['author_id', 'author_screen_name', 'lang', 'body']
+
+def read_tweets(
+    path : str,
+    chunksize : int = 100000,
+    columnar_cache : bool = False
+) -> Iterator[pd.DataFrame]:
+    """Reads the english tweets of more than 20 and at most 140 characters of a
+    tweets csv file by chunks, only loading the TWEETS_COLUMNS columns.
+    With columnar_cache, the filtered tweets are also saved as a parquet file next
+    to the csv and read from there by the next calls.
+
+    :param path: path to the tweets csv file
+    :type path: str
+    :param chunksize: number of csv rows read at once, defaults to 100000
+    :type chunksize: int, optional
+    :param columnar_cache: whether to use and create the parquet cache, defaults to False
+    :type columnar_cache: bool, optional
+    :yield: the filtered tweets, chunk by chunk
+    :rtype: Iterator[pd.DataFrame]
+    """
+    cache_path = re.sub(r'\.csv$', '', path) + '.parquet'
+    if columnar_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        yield pd.read_parquet(cache_path)
+        return
+
+    chunks = []
+    for chunk in pd.read_csv(path, usecols = TWEETS_COLUMNS, chunksize = chunksize):
+        lengths = chunk['body'].str.len()
+        chunk = chunk[(chunk['lang'] == 'en') & (lengths > 20) & (lengths <= 140)]
+        if columnar_cache:
+            chunks.append(chunk)
+        yield chunk
+
+    if columnar_cache and len(chunks) > 0:
+        try:
+            pd.concat(chunks).to_parquet(cache_path)
+            logging.info(f'columnar cache written at {cache_path}')
+        except ImportError:
+            logging.warning('no parquet engine installed, the columnar cache is not written')
 
 def prepare_tweets_data(
     N_USERS = 1000,
@@ -281,11 +1244,18 @@ def prepare_tweets_data(
     val_split = 0.2,
     test_split = 0.2,
     SEED = 23,
-    nodes_data_folder = 'nodes_data'
+    nodes_data_folder = 'nodes_data',
+    chunksize = 100000,
+    columnar_cache = False,
+    nodes_data_store = False
 ):
     """Generates the data for pretraining the language model as
     well as the nodes data for federated learning.
 
+    The main tweets file is read once: its most active authors become the nodes
+    and the remaining tweets the language model splits. The two other files are
+    streamed by chunks to gather the nodes tweets.
+
     :param N_USERS: number of nodes data to generate, defaults to 1000
     :type N_USERS: int, optional
     :param data_path: where the input data is stored, defaults to 'data'
@@ -300,11 +1270,16 @@ def prepare_tweets_data(
     :type SEED: int, optional
     :param nodes_data_folder: where to save the nodes data, defaults to 'nodes_data'
     :type nodes_data_folder: str, optional
+    :param chunksize: number of csv rows read at once, defaults to 100000
+    :type chunksize: int, optional
+    :param columnar_cache: whether to cache the filtered csv files as parquet, defaults to False
+    :type columnar_cache: bool, optional
+    :param nodes_data_store: whether to save the nodes data as a NodeDataStore
+        instead of one pickle file per node, defaults to False
+    :type nodes_data_store: bool, optional
     """
     tweets_file = f'tweets_{id_}.csv'
 
-    # user_tweets_file = f'users_tweets_{id_}.csv'
-
     train_set_file = f'train_{id_}.pickle'
     val_set_file = f'val_{id_}.pickle'
     test_set_file = f'test_{id_}.pickle'
@@ -316,44 +1291,36 @@ def prepare_tweets_data(
         print(tweets_file)
         print(data_files)
     else:
-        users_tweets = pd.DataFrame()
-        tweets = pd.read_csv(os.path.join(data_path, tweets_file))
-        tweets = tweets[tweets['lang'] == 'en']
-        lengths = tweets['body'].map(len)
-        tweets = tweets[lengths.map(lambda x : 20 < x and x <= 140)]
+        tweets = pd.concat(
+            read_tweets(os.path.join(data_path, tweets_file), chunksize, columnar_cache),
+            ignore_index = True
+        )
 
         logging.info('generating nodes data...')
         users_ids = list(tweets['author_id'].value_counts()[:N_USERS].index)
-        users_tweets = users_tweets.append(tweets[tweets['author_id'].map(lambda x : x in users_ids)])
+        users_index = {user_id : i for i, user_id in enumerate(users_ids)}
+        is_user = tweets['author_id'].isin(users_ids)
+        users_tweets = [tweets[is_user]]
         for j in range(1,4):
-            if j != id_:
-                tweets = pd.read_csv(os.path.join(data_path,  f'tweets_{j}.csv'))
-                tweets = tweets[tweets['lang'] == 'en']
-                lengths = tweets['body'].map(len)
-                tweets = tweets[lengths.map(lambda x : 20 < x and x <= 140)]
-                users_tweets = users_tweets.append(tweets[tweets['author_id'].map(lambda x : x in users_ids)])
+            if str(j) != str(id_):
+                for chunk in read_tweets(os.path.join(data_path,  f'tweets_{j}.csv'), chunksize, columnar_cache):
+                    users_tweets.append(chunk[chunk['author_id'].isin(users_ids)])
+        users_tweets = pd.concat(users_tweets)
 
-        
-        for (user_id, screename), user_tweets in users_tweets.groupby(['author_id', 'author_screen_name']):
-            i = int(users_ids.index(user_id) + 1)
-            bodies = list(user_tweets['body'])
-            with open(os.path.join(nodes_data_folder, f"node_{i}_{len(bodies)}_{user_id}_{screename}.pickle"), 'wb') as f:
-                pickle.dump(bodies, f)
+        def nodes():
+            for (user_id, screename), user_tweets in users_tweets.groupby(['author_id', 'author_screen_name']):
+                i = int(users_index[user_id] + 1)
+                bodies = list(user_tweets['body'])
+                yield i, bodies, f"node_{i}_{len(bodies)}_{user_id}_{screename}"
+        save_nodes_data(nodes(), nodes_data_folder, nodes_data_store)
         logging.info('node data generated')
-
-        # users_tweets.to_csv(os.path.join(data_path, user_tweets_file))
-        logging.info('generated users data')
         del users_tweets
         gc.collect()
 
         np.random.seed(SEED)
 
         logging.info('generating language model datasets...')
-        tweets = pd.read_csv(os.path.join(data_path, tweets_file))
-        tweets = tweets[tweets['lang'] == 'en']
-        lengths = tweets['body'].map(len)
-        tweets = tweets[lengths.map(lambda x : 20 < x and x <= 140)]
-        LM_tweets = tweets[tweets['author_id'].map(lambda x : x not in users_ids)].set_index('author_id')
+        LM_tweets = tweets[~is_user].set_index('author_id')
         del tweets
         gc.collect()
         LM_tweets_users = list(LM_tweets.index.unique())
@@ -386,14 +1353,83 @@ def prepare_tweets_data(
             test set       : {len(test_set)} tweets for {len(test_users)} users
         """)
 
+class PickledListWriter():
+    def __init__(self, path : str):
+        """Writes a pickle file of a list of str one element at a time, so that
+        the list never has to be held in memory. pickle.load returns the list.
+
+        :param path: the pickle file path
+        :type path: str
+        """
+        self.file = open(path, 'wb')
+        self.file.write(pickle.PROTO + bytes([4]) + pickle.EMPTY_LIST)
+        self.length = 0
+
+    def append(self, text : str):
+        data = text.encode('utf-8', 'surrogatepass')
+        self.file.write(pickle.BINUNICODE8 + struct.pack('<Q', len(data)) + data + pickle.APPEND)
+        self.length += 1
+
+    def close(self):
+        self.file.write(pickle.STOP)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def split_wiki_articles(lines : Iterable[str]) -> Iterator[str]:
+    """Splits WikiText lines on the article headings. Yields the same pieces as
+    re.split(r'( \\n\\n = [^=]*[^=] = \\n\\n )', '\\n'.join(lines)), headings
+    included, but line by line: only the current piece is held in memory.
+    Headings are expected to fit on one line, as in the WikiText files.
+
+    :param lines: the lines of the dataset, with their end of line
+    :type lines: Iterable[str]
+    :yield: the articles and headings
+    :rtype: Iterator[str]
+    """
+    heading_pattern = re.compile(r' = [^=]*[^=] = \n')
+    lines = iter(lines)
+    current = next(lines, None)
+    if current is None:
+        yield ''
+        return
+
+    # lines of the current piece and whether it follows a heading, whose match
+    # includes the first character of the next line
+    block, after_heading = [], False
+    previous = None
+    for following in itertools.chain(lines, [None]):
+        is_heading = (
+            previous is not None and following is not None
+            and previous.endswith(' \n') and following.startswith(' ')
+            and heading_pattern.fullmatch(current) is not None
+            # the heading match can't start in the previous heading match
+            and not (after_heading and (len(block) == 0 or (len(block) == 1 and len(previous) <= 2)))
+        )
+        if is_heading:
+            yield '\n'.join(block)[(1 if after_heading else 0):-2]
+            yield ' \n\n' + current + '\n '
+            block, after_heading = [], True
+        else:
+            block.append(current)
+        previous, current = current, following
+    yield '\n'.join(block)[(1 if after_heading else 0):]
+
 def prepare_wiki_data(
     N_USERS : int,
     SEED : int,
     data_path : str,
     nodes_data_folder : str,
-    data_name : str
+    data_name : str,
+    nodes_data_store : bool = False
 ):
     """prepares the pretrain and nodes data for the WikiText103 dataset.
+    The splits are read and written article by article, the training articles
+    being kept in a temporary file until they are shuffled.
 
     :param N_USERS: [description]
     :type N_USERS: [type]
@@ -405,6 +1441,9 @@ def prepare_wiki_data(
     :type nodes_data_folder: [type]
     :param data_name: [description]
     :type data_name: [type]
+    :param nodes_data_store: whether to save the nodes data as a NodeDataStore
+        instead of one pickle file per node, defaults to False
+    :type nodes_data_store: bool, optional
     """
     np.random.seed(SEED)
     # Whether to use WikiText-2 or WikiText103
@@ -427,45 +1466,66 @@ def prepare_wiki_data(
     val_set_file = f'val_{id_}.pickle'
     test_set_file = f'test_{id_}.pickle'
 
-    # splits train-val-test by article
-    heading_pattern = r'( \n\n = [^=]*[^=] = \n\n )'
-
-    raw_train = '\n'.join([x for x in train])
-    train_articles = [x for x in re.split(heading_pattern, raw_train) if (len(x) > 200 and '\n' in x)]
-    np.random.shuffle(train_articles)
-    nodes_data = train_articles[:N_USERS]
-    train_articles = train_articles[N_USERS:]
+    # splits train-val-test by article. The train articles are written one
+    # after the other in a temporary file and shuffled through their indices
+    articles_file = os.path.join(path, f'train_{id_}.articles.tmp')
+    offsets = [0]
+    with open(articles_file, 'wb') as f:
+        for article in split_wiki_articles(train):
+            if len(article) > 200 and '\n' in article:
+                data = article.encode('utf-8', 'surrogatepass')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+    order = np.arange(len(offsets) - 1)
+    np.random.shuffle(order)
+    # the first N_USERS shuffled articles go to the nodes, the others to training
+    num_nodes = min(N_USERS, len(order))
+    train_order = order[num_nodes:]
 
-    raw_val = '\n'.join([x for x in val])
-    val_articles = [x for x in re.split(heading_pattern, raw_val) if len(x) > 200]
-    raw_test = '\n'.join([x for x in test])
-    test_articles = [x for x in re.split(heading_pattern, raw_test) if len(x) > 200]
+    def read_article(f, j):
+        f.seek(offsets[j])
+        return f.read(offsets[j + 1] - offsets[j]).decode('utf-8', 'surrogatepass')
 
     # 1 node = 1 article
-    k = 0
-    for (i,art) in enumerate(nodes_data):
-        art = [x for x in re.split(r'\n', art) if len(x) > 20]
-        while len(art) < 100:
-            art = train_articles[k]
-            art = [x for x in re.split(r'\n', art) if len(x) > 200]
-            train_articles = train_articles[1:]
-            k+=1
-        with open(os.path.join(nodes_data_folder, f"node_{i+1}_{len(art)}.pickle"), 'wb') as f:
-            pickle.dump(art, f)
-
-    # store data as raw text
-    with open(os.path.join(path, train_set_file), 'wb') as f:
-        pickle.dump(train_articles, f)
-    with open(os.path.join(path, val_set_file), 'wb') as f:
-        pickle.dump(val_articles, f)
-    with open(os.path.join(path, test_set_file), 'wb') as f:
-        pickle.dump(test_articles, f)
+    num_refills = 0
+    def nodes(f):
+        nonlocal num_refills
+        for i in range(num_nodes):
+            art = read_article(f, order[i])
+            art = [x for x in re.split(r'\n', art) if len(x) > 20]
+            while len(art) < 100:
+                # the r-th refill takes the training article 2r and the
+                # training set loses its first article
+                art = read_article(f, train_order[2 * num_refills])
+                art = [x for x in re.split(r'\n', art) if len(x) > 200]
+                num_refills += 1
+            yield i+1, art, f"node_{i+1}_{len(art)}"
+
+    try:
+        with open(articles_file, 'rb') as f:
+            save_nodes_data(nodes(f), nodes_data_folder, nodes_data_store)
+
+            # store data as raw text
+            with PickledListWriter(os.path.join(path, train_set_file)) as train_articles:
+                for j in train_order[num_refills:]:
+                    train_articles.append(read_article(f, j))
+    finally:
+        os.remove(articles_file)
+
+    with PickledListWriter(os.path.join(path, val_set_file)) as val_articles:
+        for article in split_wiki_articles(val):
+            if len(article) > 200:
+                val_articles.append(article)
+    with PickledListWriter(os.path.join(path, test_set_file)) as test_articles:
+        for article in split_wiki_articles(test):
+            if len(article) > 200:
+                test_articles.append(article)
     
     logging.info(f'generated train-val-test sets for id {id_}')
     logging.info(f"""
-        trainining set : {len(train_articles)} articles
-        validation set : {len(val_articles)} articles
-        test set       : {len(test_articles)} articles
+        trainining set : {train_articles.length} articles
+        validation set : {val_articles.length} articles
+        test set       : {test_articles.length} articles
     """)
 
 if __name__ == '__main__':
@@ -494,7 +1554,10 @@ if __name__ == '__main__':
             val_split = data_parameters['val_split'],
             test_split = data_parameters['test_split'],
             SEED = model_parameters['NUMPY_SEED'],
-            nodes_data_folder = nodes_folder
+            nodes_data_folder = nodes_folder,
+            chunksize = data_parameters.get('chunksize', 100000),
+            columnar_cache = data_parameters.get('columnar_cache', False),
+            nodes_data_store = federated_parameters.get('nodes_data_store', False)
         )
     elif 'WikiText' in data_parameters['data_name']:
         prepare_wiki_data(
@@ -502,5 +1565,6 @@ if __name__ == '__main__':
             data_path = data_parameters['data_folder'],
             SEED = model_parameters['NUMPY_SEED'],
             nodes_data_folder = nodes_folder,
-            data_name = data_parameters['data_name']
+            data_name = data_parameters['data_name'],
+            nodes_data_store = federated_parameters.get('nodes_data_store', False)
         )
\ No newline at end of file
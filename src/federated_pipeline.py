@@ -13,9 +13,10 @@ from tqdm import tqdm
 import torch
 
 sys.path.append('.')
-from src.data_processing import  SequenceDataset
-from src.models import NextWordPredictorModel, init_model
-from src.utils import make_dir_if_not_exists, update_json, pseudo_huber_loss
+from src.data_processing import  SequenceDataset, SequenceDataLoader, NodeDataStore, load_vocabulary
+from src.models import NextWordPredictorModel, init_model, METRICS
+from src.inference import ModelCache
+from src.utils import make_dir_if_not_exists, update_json, flatten_tensors, flat_distance
 from src.nodes import *
 
 class Federated():
@@ -60,11 +61,13 @@ class Federated():
         np.random.seed(self.pipeline_args['NUMPY_SEED'])
         # LOAD VOCAB
         vocab_path = os.path.join('vocabs', self.pipeline_args['DATA_PARAMETERS']['vocab_file'])
-        with open(vocab_path, 'rb') as f:
-            self.vocabulary = pickle.load(f)
-            logging.info('vocabulary loaded')
+        self.vocabulary = load_vocabulary(vocab_path)
+        logging.info('vocabulary loaded')
         self.prepare_directories()
         self.load_val_test_set()
+        # the rnn and linear weights of the most recently used nodes are kept in memory
+        budget_mb = self.federated_args.get('models_memory_budget_mb')
+        self.node_weights = ModelCache(None if budget_mb is None else int(budget_mb * 2**20))
 
 
         # INIT GENERAL MODEL
@@ -135,6 +138,8 @@ class Federated():
             min_seq_length = data_params['min_seq_length'],
             max_seq_length = data_params['max_seq_length'],
             device = self.pipeline_args['DEVICE'],
+            cache_folder = data_params.get('cache_folder'),
+            num_workers = data_params.get('dataset_num_workers', 0)
         )
         self.test_dataset = SequenceDataset(
             vocabulary = self.vocabulary,
@@ -142,6 +147,8 @@ class Federated():
             min_seq_length = data_params['min_seq_length'],
             max_seq_length = data_params['max_seq_length'],
             device = self.pipeline_args['DEVICE'],
+            cache_folder = data_params.get('cache_folder'),
+            num_workers = data_params.get('dataset_num_workers', 0)
         )
         logging.info(f"""
         loaded validation set ({len(self.val_dataset)}) and test set ({self.test_dataset})
@@ -161,6 +168,10 @@ class Federated():
             sys.exit(1)
         self.nodes = {}
         nodes_path = os.path.join('nodes_data', self.federated_args['nodes_data_folder'])
+        datastore = NodeDataStore(nodes_path) if NodeDataStore.exists(nodes_path) else None
+        # the user nodes datasets are built on first access and share a memory budget
+        budget_mb = self.federated_args.get('datasets_memory_budget_mb')
+        self.datasets = DatasetCache(None if budget_mb is None else int(budget_mb * 2**20))
         for node_id in tqdm(range(1, self.num_nodes+1)):
             parameters = {
                 'id_' : node_id,
@@ -177,6 +188,11 @@ class Federated():
             if node_id < self.num_nodes - self.num_bysantine + 1:
                 self.nodes[node_id] = UserNode(
                     datafolder = nodes_path,
+                    cache_folder = self.pipeline_args['DATA_PARAMETERS'].get('cache_folder'),
+                    datastore = datastore,
+                    packed = self.pipeline_args['DATA_PARAMETERS'].get('pack_sentences', False),
+                    seed = self.pipeline_args['NUMPY_SEED'],
+                    datasets = self.datasets,
                     **parameters
                 )
             else:
@@ -204,9 +220,9 @@ class Federated():
         self,
         node : Node,
         val : bool = False
-    ) -> torch.utils.data.DataLoader:
+    ) -> SequenceDataLoader:
         """
-        Returns a torch.utils.data.DataLoader with the test set of the node
+        Returns a SequenceDataLoader with the test set of the node
         or the validation set if val = True
 
         :param node: the node to extract the data from
@@ -214,17 +230,17 @@ class Federated():
         :param val: wether to use the validation or test set, defaults to False
         :type val: bool, optional
         :return: the correspoinding dataloader
-        :rtype: torch.utils.data.Dataloader
+        :rtype: SequenceDataLoader
         """
         if val:
-            return torch.utils.data.DataLoader(
+            return SequenceDataLoader(
                 node.val,
                 batch_size = 1,
                 drop_last = True,
                 shuffle = False
             )
         else:
-            return torch.utils.data.DataLoader(
+            return SequenceDataLoader(
                 node.data,
                 batch_size = self.pipeline_args['TRAINING_PARAMETERS']['batch_size'],
                 shuffle = True,
@@ -254,22 +270,24 @@ class Federated():
             N = self.federated_args['byzantine_datasize']
             train_dataset = SequenceDataset(
                 vocabulary = self.vocabulary,
-                text = sentence * N,
+                text = sentence,
+                repeats = N,
                 max_seq_length = self.federated_args['max_seq_length'],
                 min_seq_length = self.federated_args['min_seq_length'],
                 device = self.federated_args['DEVICE']
             )
             val_dataset = SequenceDataset(
                 vocabulary = self.vocabulary,
-                text = sentence * int(N / 10),
+                text = sentence,
+                repeats = int(N / 10),
                 max_seq_length = self.federated_args['max_seq_length'],
                 min_seq_length = self.federated_args['min_seq_length'],
                 device = self.federated_args['DEVICE']
             )
             self.load_embeddings(temp_model)
             temp_model.freeze_embeddings()
-            train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size = 8, drop_last = True, shuffle = False)
-            val_dataloader = torch.utils.data.DataLoader(val_dataset, batch_size = 8, drop_last = True, shuffle = False)
+            train_dataloader = SequenceDataLoader(train_dataset, batch_size = 8, drop_last = True, shuffle = False)
+            val_dataloader = SequenceDataLoader(val_dataset, batch_size = 8, drop_last = True, shuffle = False)
             temp_model.fit(train_dataloader, val_dataloader, num_epochs=100)
             state_dict = temp_model.state_dict()
             
@@ -280,13 +298,15 @@ class Federated():
 
         self.attack_dataset = SequenceDataset(
             vocabulary = self.vocabulary,
-            text = sentence * 100,
+            text = sentence,
+            repeats = 100,
             max_seq_length = self.federated_args['max_seq_length'],
             min_seq_length = self.federated_args['min_seq_length'],
             device = self.federated_args['DEVICE']
         )
-        self.attack_dataloader = torch.utils.data.DataLoader(
-            self.attack_dataset,
+        # the attack rows are all the same: each unique row is evaluated once, weighted by its count
+        self.attack_dataloader = SequenceDataLoader(
+            self.attack_dataset.deduplicate(),
             batch_size = 1,
             drop_last = True,
             shuffle = False
@@ -343,28 +363,37 @@ class Federated():
         optim_path = os.path.join(self.optim_folder, 'optim_general.pth' if node_id == 0 else f"optim_{node_id}.pth")
         torch.save(optim_stat_dict, optim_path)
 
-    def load_weights(self, node_id : int = 0, model : NextWordPredictorModel = None):
+        self.node_weights.put(node_id, {'rnn' : rnn_state_dict, 'linear' : linear_state_dict})
+
+    def load_weights(
+        self,
+        node_id : int = 0,
+        model : NextWordPredictorModel = None,
+        load_optimizer : bool = True
+    ):
         """Given a node id and a NextWordPredictoModel, loads the rnn and linear weights from the 
-        corresponding node in the model. If the id is 0, will load to the general model. It also
-        loads the optimizer specific to the id.
+        corresponding node in the model. If the id is 0, will load to the general model. The weights
+        come from the in memory cache self.node_weights when possible. It also loads the optimizer
+        specific to the id, unless the model is only used for inference.
 
         :param node_id: The id of the node, defaults to 0
         :type node_id: int, optional
         :param model: The model to load the weigths in, defaults to None
         :type model: NextWordPredictorModel, optional
+        :param load_optimizer: Whether to load the optimizer state, defaults to True
+        :type load_optimizer: bool, optional
         """        
         if model is None:
             model = self.general_model
         rnn_path = os.path.join(self.rnn_folder, 'rnn_general.pth' if node_id == 0 else f"rnn_{node_id}.pth")
         linear_path = os.path.join(self.linear_folder, 'linear_general.pth' if node_id == 0 else f"linear_{node_id}.pth")
         optim_path = os.path.join(self.optim_folder, 'optim_general.pth' if node_id == 0 else f"optim_{node_id}.pth")
-        with torch.no_grad():
-            rnn_state_dict = torch.load(rnn_path)
-            model.rnn.load_state_dict(rnn_state_dict)
-
-            linear_state_dict = torch.load(linear_path)
-            model.linear.load_state_dict(linear_state_dict)
-
+        self.node_weights.load_into(
+            node_id,
+            model,
+            lambda : {'rnn' : torch.load(rnn_path), 'linear' : torch.load(linear_path)}
+        )
+        if load_optimizer:
             optim_stat_dict = torch.load(optim_path)
             model.optimizer.load_state_dict(optim_stat_dict)
 
@@ -372,7 +401,7 @@ class Federated():
         return self.general_model.generate(start_text=start_text, vocabulary = self.vocabulary, num_words=num_words, random = random)
 
     def generate_node(self, start_text : str, node_id : int, num_words : int = 100, random = True):
-        self.load_weights(node_id, self.user_model)
+        self.load_weights(node_id, self.user_model, load_optimizer = False)
         return self.user_model.generate(start_text=start_text, vocabulary = self.vocabulary, num_words=num_words, random = random)
 
     def train(self, num_rounds : int, save_results = True):
@@ -513,7 +542,7 @@ class Federated_AVG(Federated):
             self.first = True
             # At the first round all nodes start from the init model
             node = self.nodes[node_id]
-            total_data += len(node.data)
+            total_data += node.num_samples()
             # loads general model
             self.general_model.load_state_dict(self.current_state_dict)
             self.general_model.optimizer = torch.optim.Adam(
@@ -548,7 +577,7 @@ class Federated_AVG(Federated):
                         node.compute_forged_model(self.general_model)
                         node.generate_poisoned_dataset(self.general_model)
 
-                    node_dataloader = torch.utils.data.DataLoader(
+                    node_dataloader = SequenceDataLoader(
                         node.data,
                         batch_size = self.pipeline_args['TRAINING_PARAMETERS']['batch_size'],
                         shuffle = True,
@@ -583,7 +612,7 @@ class Federated_AVG(Federated):
         for i,node in self.nodes.items():
             if (ids is None) or (i in ids):
                 node_state_dict = node.state
-                ratio = len(node.data) / total_data
+                ratio = node.num_samples() / total_data
                 if self.agg_state_dict is None:
                     self.agg_state_dict = node_state_dict.copy()
                     for key in self.agg_state_dict:
@@ -634,24 +663,28 @@ class Federated_AVG(Federated):
         """
         start_text = ' '.join(self.federated_args['sentence'].split(' ')[:5])
         res = self.results[round]
-        val_dataloader = torch.utils.data.DataLoader(
+        val_dataloader = SequenceDataLoader(
             self.val_dataset,
             batch_size = self.pipeline_args['TRAINING_PARAMETERS']['batch_size'],
             drop_last = True,
             shuffle = False
         )
-        res[f'perplexity'],  res[f'loss'], res[f'f1_recall'], res[f'f3_recall'] \
-            = self.general_model.perplexity(val_dataloader, with_tqdm = False, with_recall = True)
+        # the val and attack batches go through a single forward pass per step
+        evaluation = self.general_model.evaluate_metrics(
+            {'val' : val_dataloader, 'attack' : self.attack_dataloader},
+            {'val' : METRICS, 'attack' : ['perplexity']}
+        )
+        res.update(evaluation['val'])
         res[f'generate'] = self.generate_general(start_text, 5, random = False)
-        res[f'attack_perplexity'],_ = self.general_model.perplexity(self.attack_dataloader,with_tqdm = False,with_recall = False)
-
+        res[f'attack_perplexity'] = evaluation['attack']['perplexity']
+        # the node val sets are evaluated one at a time, so that only the datasets
+        # kept by the datasets cache stay in memory
         for node_id, node in self.nodes.items():
             if isinstance(node, UserNode):
-                val_dataloader = self.get_node_dataloader(node, val = True)
-                (
-                    res[f'perplexity_{node_id}'],  res[f'loss_{node_id}'], 
-                    res[f'f1_recall_{node_id}'], res[f'f3_recall_{node_id}']
-                ) = self.general_model.perplexity(val_dataloader, with_tqdm = False, with_recall = True)
+                node_dataloader = self.get_node_dataloader(node, val = True)
+                node_metrics = self.general_model.evaluate_metrics({node_id : node_dataloader}, METRICS)[node_id]
+                for metric, value in node_metrics.items():
+                    res[f'{metric}_{node_id}'] = value
 
 
 
@@ -686,29 +719,41 @@ class Federated_LICCHAVI(Federated):
         else:
             return 'norm_undefined'
 
+    @staticmethod
+    def regularized_parameters(model : NextWordPredictorModel) -> List[torch.nn.Parameter]:
+        """The parameters of a model in the regularizer: all of them excepting biases and embeddings
+
+        :rtype: List[torch.nn.Parameter]
+        """
+        return [w for name, w in model.named_parameters() if ('bias' not in name) and ('embedding' not in name)]
+
     def models_difference(self, node : Node) -> torch.Tensor:
         """Computes the p normed difference between the general model and another
-        for the parameters that require gradient excepting biases.
+        for the parameters that require gradient excepting biases. The parameters of
+        the frozen model are flattened into a constant vector and the distance is a
+        single autograd operation (see src.utils.FlatDistance). The general model
+        vector is computed once after the general model is frozen, and reused for
+        all the batches of all the nodes of the round.
 
         :param node: Node to compute the distance with
         :type node: Node
         :return: The loss tensor
         :rtype: torch.Tensor
         """
-        reg = torch.FloatTensor([0]).to(self.general_model.device)
         if node.lambda_ == 0:
-            return reg
+            return torch.FloatTensor([0]).to(self.general_model.device)
+        if self.general_parameters[0].requires_grad:
+            # update of the general model, the user model is frozen
+            weights = self.general_parameters
+            target = flatten_tensors(self.user_parameters)
         else:
-            reg.requires_grad = True
-            for ((name, w1), (_, w2)) in zip(self.general_model.named_parameters(), self.user_model.named_parameters()):            
-                if ('bias' not in name) and ('embedding' not in name):
-                    if self.loss_type == 'norm':
-                        reg = reg + node.lambda_ * (torch.dist(w1, w2, node.p))#** node.p)
-                    elif self.loss_type == 'huber':
-                        # The lambda_n replaces the w in the paper
-                        # The p_n replaces the delta_c
-                        reg = reg + node.lambda_ * pseudo_huber_loss(w1, w2, node.p, len(node.data))
-            return reg
+            if self.general_vector is None:
+                self.general_vector = flatten_tensors(self.general_parameters)
+            weights = self.user_parameters
+            target = self.general_vector
+        # The lambda_n replaces the w in the paper
+        # For the huber loss, the p_n replaces the delta_c
+        return flat_distance(weights, target, self.loss_type, node.p, node.lambda_, node.num_samples())
 
     def init_user_model(self):
         """Initializes the user_model, reseting weights and optimizer.
@@ -717,6 +762,7 @@ class Federated_LICCHAVI(Federated):
         self.user_model = init_model(None, **self.model_parameters)
         self.load_embeddings(self.user_model)
         self.user_model.train()
+        self.user_parameters = self.regularized_parameters(self.user_model)
         self.user_model.general_regularizer = self.models_difference
         
     def prepare_models_for_training(self, share_embeddings = True):
@@ -728,23 +774,23 @@ class Federated_LICCHAVI(Federated):
         self.general_model.q = self.federated_args['p_0']
         self.general_model.train()
         self.general_model.freeze_embeddings()
+        self.general_parameters = self.regularized_parameters(self.general_model)
+        self.general_vector = None
 
     def freeze_general_model(self):
-        for p in self.general_model.parameters():
-            p.requires_grad = False
+        self.general_model.freeze()
+        # the flattened general model is computed again on its next use
+        self.general_vector = None
     
     def unfreeze_general_model(self):
-        for p in self.general_model.parameters():
-            p.requires_grad = True
+        self.general_model.unfreeze()
         self.general_model.freeze_embeddings()
     
     def freeze_node_model(self):
-        for p in self.user_model.parameters():
-            p.requires_grad = False
+        self.user_model.freeze()
     
     def unfreeze_node_model(self):
-        for p in self.user_model.parameters():
-            p.requires_grad = True
+        self.user_model.unfreeze()
         self.user_model.freeze_embeddings()
 
     def nodes_epoch_step(self, round):
@@ -833,7 +879,7 @@ class Federated_LICCHAVI(Federated):
                 self.compute_grads(general_model_reg_loss, round) # stores gradients for regularization
             general_model_reg_loss.backward()
             for node_id, node in self.nodes.items():
-                self.load_weights(node_id, self.user_model)
+                self.load_weights(node_id, self.user_model, load_optimizer = False)
                 self.freeze_node_model()
                 other_reg_loss = self.models_difference(node)
                 if self.strat:
@@ -883,36 +929,31 @@ class Federated_LICCHAVI(Federated):
         start_text = ' '.join(self.federated_args['sentence'].split(' ')[:5])
         val_dataloader = self.get_node_dataloader(node, val = True)
         res = self.results[round]
-        (
-            res[f'perplexity_{node_id}'],  res[f'loss_{node_id}'], 
-            res[f'f1_recall_{node_id}'], res[f'f3_recall_{node_id}']
-        ) = self.user_model.perplexity(val_dataloader, with_tqdm = False, with_recall = True)
-        res[f'generate_{node_id}'] = self.user_model.generate(self.vocabulary, start_text, 5)
-        res[f'attack_perplexity_{node_id}'],_ = self.user_model.perplexity(
-            self.attack_dataloader,
-            with_tqdm = False,
-            with_recall = False
+        evaluation = self.user_model.evaluate_metrics(
+            {'val' : val_dataloader, 'attack' : self.attack_dataloader},
+            {'val' : METRICS, 'attack' : ['perplexity']}
         )
+        for metric, value in evaluation['val'].items():
+            res[f'{metric}_{node_id}'] = value
+        res[f'generate_{node_id}'] = self.user_model.generate(self.vocabulary, start_text, 5)
+        res[f'attack_perplexity_{node_id}'] = evaluation['attack']['perplexity']
 
     def evaluate_metrics_general(self, round):
         start_text = ' '.join(self.federated_args['sentence'].split(' ')[:5])
-        val_dataloader = torch.utils.data.DataLoader(
+        val_dataloader = SequenceDataLoader(
                 self.val_dataset,
                 batch_size = self.pipeline_args['TRAINING_PARAMETERS']['batch_size'],
                 drop_last = True,
                 shuffle = False
             )
         res = self.results[round]
-        (
-            res[f'perplexity'],  res[f'loss'], 
-            res[f'f1_recall'], res[f'f3_recall']
-        ) = self.general_model.perplexity(val_dataloader, with_tqdm = False, with_recall = True)
-        res[f'generate'] = self.general_model.generate(self.vocabulary, start_text, 5)
-        res[f'attack_perplexity'],_ = self.general_model.perplexity(
-            self.attack_dataloader,
-            with_tqdm = False,
-            with_recall = False
+        evaluation = self.general_model.evaluate_metrics(
+            {'val' : val_dataloader, 'attack' : self.attack_dataloader},
+            {'val' : METRICS, 'attack' : ['perplexity']}
         )
+        res.update(evaluation['val'])
+        res[f'generate'] = self.general_model.generate(self.vocabulary, start_text, 5)
+        res[f'attack_perplexity'] = evaluation['attack']['perplexity']
 
 
 
@@ -0,0 +1,285 @@
+import sys
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Hashable, List, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+sys.path.append('.')
+from src.models import NextWordPredictorModel
+from src.data_processing import Vocabulary
+
+Hidden = Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]
+
+Weights = Dict[str, Dict[str, torch.Tensor]]
+
+class ModelCache():
+    def __init__(self, max_bytes : int = None):
+        """Least recently used cache of the rnn and linear weights of node models. The
+        weights of a node are copied in place into a model shared by all the nodes, so
+        that switching between nodes neither reads the disk nor allocates new
+        parameters. When the weights take more than max_bytes, the least recently
+        used ones are dropped and loaded again on their next access.
+
+        :param max_bytes: memory budget of the weights in bytes, defaults to None (no limit)
+        :type max_bytes: int, optional
+        """
+        self.max_bytes = max_bytes
+        self.weights = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def weights_nbytes(weights : Weights) -> int:
+        return sum(
+            tensor.element_size() * tensor.nelement()
+            for state_dict in weights.values()
+            for tensor in state_dict.values()
+        )
+
+    def put(self, key : Hashable, weights : Weights):
+        """Caches a copy of the given weights, to be called when they are saved so that
+        the cache never holds stale weights
+
+        :param key: the node id
+        :type key: Hashable
+        :param weights: the state dicts of the rnn and linear modules
+        :type weights: Weights
+        """
+        self.weights[key] = {
+            module : {name : tensor.detach().clone() for name, tensor in state_dict.items()}
+            for module, state_dict in weights.items()
+        }
+        self.weights.move_to_end(key)
+        self.nbytes += self.weights_nbytes(self.weights[key]) - self.sizes.get(key, 0)
+        self.sizes[key] = self.weights_nbytes(self.weights[key])
+        self.evict()
+
+    def get(self, key : Hashable, load : Callable[[], Weights]) -> Weights:
+        """Returns the cached weights of the given key or loads them
+
+        :param key: the node id
+        :type key: Hashable
+        :param load: loads the weights if they are not cached
+        :type load: Callable[[], Weights]
+        :rtype: Weights
+        """
+        if key in self.weights:
+            self.hits += 1
+            self.weights.move_to_end(key)
+            return self.weights[key]
+        self.misses += 1
+        weights = load()
+        self.weights[key] = weights
+        self.sizes[key] = self.weights_nbytes(weights)
+        self.nbytes += self.sizes[key]
+        self.evict()
+        return weights
+
+    def load_into(self, key : Hashable, model : NextWordPredictorModel, load : Callable[[], Weights]):
+        """Copies the weights of the given key into the parameters of model
+
+        :param key: the node id
+        :type key: Hashable
+        :param model: the shared model
+        :type model: NextWordPredictorModel
+        :param load: loads the weights if they are not cached
+        :type load: Callable[[], Weights]
+        """
+        weights = self.get(key, load)
+        # load_state_dict copies into the existing parameters
+        with torch.no_grad():
+            model.rnn.load_state_dict(weights['rnn'])
+            model.linear.load_state_dict(weights['linear'])
+
+    def evict(self):
+        if self.max_bytes is not None:
+            # the last used weights are always kept
+            while self.nbytes > self.max_bytes and len(self.weights) > 1:
+                evicted, _ = self.weights.popitem(last = False)
+                self.nbytes -= self.sizes.pop(evicted)
+
+    def __len__(self):
+        return len(self.weights)
+
+class PrefixCache():
+    def __init__(
+        self,
+        model : NextWordPredictorModel,
+        max_bytes : int = 64 * 2**20,
+        latency_window : int = 10000
+    ):
+        """Next word suggestions of a model for prefixes of token ids sharing their
+        beginnings. The hidden state of the model after every queried prefix is kept,
+        so that a query only runs the tokens following its longest cached prefix.
+        The least recently used hidden states are evicted when they take more than
+        max_bytes.
+
+        :param model: the model making the suggestions, in eval mode
+        :type model: NextWordPredictorModel
+        :param max_bytes: memory budget of the cached hidden states, defaults to 64MB
+        :type max_bytes: int, optional
+        :param latency_window: number of most recent query latencies kept for the
+            percentiles, defaults to 10000
+        :type latency_window: int, optional
+        """
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hidden_states = OrderedDict()
+        self.nbytes = 0
+        self.latencies = deque(maxlen = latency_window)
+        # queries whose whole prefix, part of the prefix or nothing was cached
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.tokens_run = 0
+        self.tokens_queried = 0
+
+    @staticmethod
+    def hidden_nbytes(hidden : Hidden) -> int:
+        tensors = hidden if isinstance(hidden, tuple) else (hidden,)
+        return sum(tensor.element_size() * tensor.nelement() for tensor in tensors)
+
+    def longest_prefix(self, tokens : Tuple[int, ...]) -> int:
+        """Length of the longest cached prefix of tokens, 0 if none
+
+        :param tokens: the token ids
+        :type tokens: Tuple[int, ...]
+        :rtype: int
+        """
+        for length in range(len(tokens), 0, -1):
+            if tokens[:length] in self.hidden_states:
+                return length
+        return 0
+
+    def add(self, tokens : Tuple[int, ...], hidden : Hidden):
+        """Caches the hidden state after tokens and evicts the least recently used
+        hidden states over the budget
+
+        :param tokens: the token ids
+        :type tokens: Tuple[int, ...]
+        :param hidden: the hidden state of the model after tokens
+        :type hidden: Hidden
+        """
+        if tokens in self.hidden_states:
+            self.hidden_states.move_to_end(tokens)
+            return
+        self.hidden_states[tokens] = hidden
+        self.nbytes += self.hidden_nbytes(hidden)
+        while self.nbytes > self.max_bytes and len(self.hidden_states) > 1:
+            _, evicted = self.hidden_states.popitem(last = False)
+            self.nbytes -= self.hidden_nbytes(evicted)
+
+    def run(self, tokens : Sequence[int]) -> Tuple[Hidden, torch.Tensor]:
+        """Hidden state of the model after the given tokens, only running the tokens
+        following their longest cached prefix, and the scores of the next token when
+        the model was run (None when the whole prefix was cached)
+
+        :param tokens: the token ids, at least 1
+        :type tokens: Sequence[int]
+        :rtype: Tuple[Hidden, torch.Tensor]
+        """
+        tokens = tuple(tokens)
+        cached = self.longest_prefix(tokens)
+        self.tokens_queried += len(tokens)
+        if cached == len(tokens):
+            self.hits += 1
+            self.hidden_states.move_to_end(tokens)
+            return self.hidden_states[tokens], None
+
+        if cached > 0:
+            self.partial_hits += 1
+            self.hidden_states.move_to_end(tokens[:cached])
+            hidden = self.hidden_states[tokens[:cached]]
+        else:
+            self.misses += 1
+            hidden = self.model.init_hidden(1)
+        self.tokens_run += len(tokens) - cached
+        inputs = torch.tensor([tokens[cached:]], device = self.model.device)
+        positions = torch.tensor([cached], device = self.model.device)
+        logits, hidden = self.model.step(inputs, hidden, positions)
+        self.add(tokens, hidden)
+        return hidden, logits[0]
+
+    def hidden_state(self, tokens : Sequence[int]) -> Hidden:
+        """Hidden state of the model after the given tokens, see run
+
+        :param tokens: the token ids, at least 1
+        :type tokens: Sequence[int]
+        :rtype: Hidden
+        """
+        with torch.no_grad():
+            return self.run(tokens)[0]
+
+    def next_scores(self, tokens : Sequence[int]) -> torch.Tensor:
+        """Scores of the token following the given tokens
+
+        :param tokens: the token ids, at least 1
+        :type tokens: Sequence[int]
+        :return: the scores of shape [vocab size]
+        :rtype: torch.Tensor
+        """
+        with torch.no_grad():
+            hidden, logits = self.run(tokens)
+            if logits is None:
+                # the output of the last layer for the last token is its last hidden state
+                last_output = (hidden[0] if self.model.has_cell_state else hidden)[-1]
+                logits = self.model.linear(last_output)[0]
+            return logits
+
+    def suggest(self, tokens : Sequence[int], k : int = 3) -> List[int]:
+        """The k most probable next token ids, timed for the latency percentiles
+
+        :param tokens: the token ids, at least 1
+        :type tokens: Sequence[int]
+        :param k: number of suggestions, defaults to 3
+        :type k: int, optional
+        :rtype: List[int]
+        """
+        start = time.perf_counter()
+        suggestions = torch.topk(self.next_scores(tokens), k)[1].tolist()
+        self.latencies.append(time.perf_counter() - start)
+        return suggestions
+
+    def suggest_words(self, vocabulary : Vocabulary, text : str, k : int = 3) -> List[str]:
+        """The k most probable next words of a text, see NextWordPredictorModel.encode_prompt
+
+        :param vocabulary: the vocabulary of the model
+        :type vocabulary: Vocabulary
+        :param text: the beginning of the text
+        :type text: str
+        :param k: number of suggestions, defaults to 3
+        :type k: int, optional
+        :rtype: List[str]
+        """
+        tokens = self.model.encode_prompt(vocabulary, text)
+        return [vocabulary.idx_to_word[i] for i in self.suggest(tokens, k)]
+
+    def clear(self):
+        """Drops the cached hidden states, to be called when the model weights change"""
+        self.hidden_states.clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Hit rates, share of the queried tokens actually run through the model and
+        latency percentiles in milliseconds of the recent queries
+
+        :rtype: Dict[str, float]
+        """
+        queries = max(self.hits + self.partial_hits + self.misses, 1)
+        latencies = np.array(self.latencies) * 1000 if len(self.latencies) > 0 else np.zeros(1)
+        return {
+            'queries' : self.hits + self.partial_hits + self.misses,
+            'hit_rate' : self.hits / queries,
+            'partial_hit_rate' : self.partial_hits / queries,
+            'miss_rate' : self.misses / queries,
+            'tokens_run_fraction' : self.tokens_run / max(self.tokens_queried, 1),
+            'entries' : len(self.hidden_states),
+            'nbytes' : self.nbytes,
+            'p50_ms' : np.percentile(latencies, 50),
+            'p90_ms' : np.percentile(latencies, 90),
+            'p99_ms' : np.percentile(latencies, 99)
+        }
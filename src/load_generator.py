@@ -0,0 +1,122 @@
+import sys
+import json
+import time
+import asyncio
+from typing import Dict, List
+
+import numpy as np
+
+DEFAULT_TEXTS = [
+    'all work and no play',
+    'i am going to',
+    'thank you so much for',
+    'the president of the',
+    'have a great',
+    'what do you think about',
+    'this is the best',
+    'can not wait to see'
+]
+
+async def post(reader : asyncio.StreamReader, writer : asyncio.StreamWriter, path : str, request : dict) -> dict:
+    """Sends a JSON POST request on a kept alive HTTP/1.1 connection and reads the answer
+
+    :rtype: dict
+    """
+    body = json.dumps(request).encode()
+    writer.write(
+        f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+    )
+    await writer.drain()
+    status = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    answer = json.loads(await reader.readexactly(int(headers['content-length'])))
+    if not status.startswith(b'HTTP/1.1 200'):
+        raise RuntimeError(f'{status.decode().strip()}: {answer}')
+    return answer
+
+async def client(
+    host : str,
+    port : int,
+    unix_path : str,
+    requests : List[dict],
+    latencies : List[float]
+):
+    """Sends its requests one after the other on its own connection"""
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            await post(reader, writer, '/suggest', request)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def generate_load(
+    host : str = '127.0.0.1',
+    port : int = 8080,
+    num_requests : int = 2000,
+    concurrency : int = 64,
+    texts : List[str] = DEFAULT_TEXTS,
+    k : int = 3,
+    model : str = 'general',
+    unix_path : str = None
+) -> Dict[str, float]:
+    """Sends num_requests suggestion requests from concurrency clients, each waiting
+    for the answer to its previous request before sending the next one.
+
+    :param host: the server host, defaults to '127.0.0.1'
+    :type host: str, optional
+    :param port: the server port, defaults to 8080
+    :type port: int, optional
+    :param num_requests: total number of requests, defaults to 2000
+    :type num_requests: int, optional
+    :param concurrency: number of concurrent clients, defaults to 64
+    :type concurrency: int, optional
+    :param texts: the texts to complete, used in turn, defaults to DEFAULT_TEXTS
+    :type texts: List[str], optional
+    :param k: number of suggested words, defaults to 3
+    :type k: int, optional
+    :param model: name of the model, defaults to 'general'
+    :type model: str, optional
+    :param unix_path: path of the Unix socket of the server, instead of host and port, defaults to None
+    :type unix_path: str, optional
+    :return: the throughput in requests per second and the latency percentiles in milliseconds
+    :rtype: Dict[str, float]
+    """
+    requests = [{'text' : texts[i % len(texts)], 'k' : k, 'model' : model} for i in range(num_requests)]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, unix_path, requests[i::concurrency], latencies)
+        for i in range(concurrency)
+    ])
+    duration = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests_per_second' : num_requests / duration,
+        'p50_ms' : np.percentile(latencies, 50),
+        'p99_ms' : np.percentile(latencies, 99)
+    }
+
+if __name__ == '__main__':
+    # python src/load_generator.py [port] [num_requests] [concurrency] [model]
+    stats = asyncio.run(generate_load(
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+        num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+        concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 64,
+        model = sys.argv[4] if len(sys.argv) > 4 else 'general'
+    ))
+    print(
+        f'{stats["requests_per_second"]:.0f} requests/s | p50: {stats["p50_ms"]:.1f}ms | '
+        f'p99: {stats["p99_ms"]:.1f}ms'
+    )
@@ -7,24 +7,26 @@ import pickle
 import sys
 import time
 import re
-from typing import Union, Tuple
+import itertools
+from typing import Union, Tuple, Dict, Iterable, Hashable, List
 
 sys.path.append('.')
 from src.utils import make_dir_if_not_exists, update_json
 from src.data_processing import FromTweetsVocabulary, FromRawTextVocabulary, \
-    Vocabulary, SequenceDataset, text_cleaner_raw
+    Vocabulary, SequenceDataset, SequenceDataLoader, text_cleaner_raw, load_vocabulary
 from src.nodes import Node
 
 from tqdm import tqdm
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from nltk.tokenize import TweetTokenizer, word_tokenize
 
 from apex import amp
 import torch
 from torch import Tensor
 
+# metrics computed by NextWordPredictorModel.evaluate_metrics by default
+METRICS = ('perplexity', 'loss', 'f1_recall', 'f3_recall')
 
 class PositionalEncoding(torch.nn.Module):
     def __init__(
@@ -52,13 +54,20 @@ class PositionalEncoding(torch.nn.Module):
         pe[:, 0, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe)
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, positions: Tensor = None) -> Tensor:
         """
         Parameters
         - x : torch.Tensor
             input tensor of shape [batch_size, seq_len, embedding_dim]
+        - positions : torch.Tensor
+            position of the first token of every row, of shape [batch_size].
+            By default, all the rows start at position 0
         """
-        x = x + torch.transpose(self.pe[:x.size(1)], 0,1)
+        if positions is None:
+            x = x + torch.transpose(self.pe[:x.size(1)], 0,1)
+        else:
+            steps = positions.unsqueeze(1) + torch.arange(x.size(1), device = positions.device)
+            x = x + self.pe[steps, 0]
         return self.dropout(x)
 
 class NextWordPredictorModel(torch.nn.Module):
@@ -75,7 +84,8 @@ class NextWordPredictorModel(torch.nn.Module):
         positional_encoding : bool = False,
         tied_embeddings : bool = False,
         q : int = 2,
-        gamma : float = 1e-3
+        gamma : float = 1e-3,
+        packed_sequences : bool = False
     ):
         """Torch.nn.MModule for next word prediction using RNNs.
 
@@ -104,6 +114,9 @@ class NextWordPredictorModel(torch.nn.Module):
         :type q: int, optional
         :param gamma: The weight of the regularizer, defaults to 1e-3
         :type gamma: float, optional
+        :param packed_sequences: Whether to run the RNN, the output layer and the loss only on
+        the tokens of each row up to its last non padding token (see predict), defaults to False
+        :type packed_sequences: bool, optional
         """
         super().__init__()
         self.emb_dim = emb_dim
@@ -116,6 +129,9 @@ class NextWordPredictorModel(torch.nn.Module):
         self.tied_embeddings = tied_embeddings
         self.q = q
         self.gamma = gamma
+        self.packed_sequences = packed_sequences
+        # computed by regularized_parameters, reset when the trainable parameters change
+        self.regularized_params = None
         if tied_embeddings:
             print('tied_embeddings not yet implemented')
         
@@ -166,7 +182,8 @@ class NextWordPredictorModel(torch.nn.Module):
     def forward(
         self, 
         inputs : torch.Tensor, 
-        hidden : Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]
+        hidden : Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
+        lengths : torch.Tensor = None
     ) -> Tuple[torch.Tensor, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]:
         """
         :param inputs: The input Tensor of shape [batch size, sequence length, embedding length]
@@ -174,15 +191,76 @@ class NextWordPredictorModel(torch.nn.Module):
         :param hidden: The hidden state of length self.hidden_state_size. 
         For LSTM the hidden state and the cell state.
         :type hidden: Union[torch.Tensor, Tuple(torch.Tensor, torch.Tensor)]
-        :return: The scores for all tokens, of size of the vocabulary and the new hidden (and cell state for LSTM)
+        :param lengths: The CPU int64 number of tokens of every row. If given, the rows are
+        packed and only their first lengths tokens go through the RNN and the output layer, defaults to None
+        :type lengths: torch.Tensor, optional
+        :return: The scores for all tokens, of size of the vocabulary and the new hidden (and cell state for LSTM).
+        With lengths, the scores are of shape [lengths.sum(), vocab size], in the order of
+        torch.nn.utils.rnn.pack_padded_sequence(inputs, lengths, batch_first = True, enforce_sorted = False).data
         :rtype: Tuple[torch.Tensor, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]
         """        
+        output, hidden = self.run_rnn(inputs, hidden, lengths)
+        if lengths is None:
+            output = self.linear(output)
+        else:
+            output = self.linear(output.data)
+        return output, hidden
+
+    def run_rnn(
+        self,
+        inputs : torch.Tensor,
+        hidden : Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
+        lengths : torch.Tensor = None
+    ) -> Tuple[Union[torch.Tensor, torch.nn.utils.rnn.PackedSequence], Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]:
+        """Runs the embeddings of the inputs through the RNN, without the output layer.
+        See forward.
+
+        :return: The RNN outputs, packed if lengths is given, and the new hidden states
+        :rtype: Tuple[Union[torch.Tensor, torch.nn.utils.rnn.PackedSequence], Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]
+        """
         embeddings = self.embedding_layer(inputs)
         if self.positional_encoding:
             embeddings = self.positional_encoder(embeddings)
-        output, hidden = self.rnn(embeddings, hidden)
-        output = self.linear(output)
-        return output, hidden
+        if lengths is not None:
+            embeddings = torch.nn.utils.rnn.pack_padded_sequence(
+                embeddings, lengths, batch_first = True, enforce_sorted = False
+            )
+        return self.rnn(embeddings, hidden)
+
+    def sequence_lengths(self, batch : torch.Tensor) -> torch.Tensor:
+        """Number of input tokens to run for every row of the batch: the position of its
+        last non padding token (the last label to predict), at least 1.
+
+        :param batch: The token ids of shape [batch size, sequence length]
+        :type batch: torch.Tensor
+        :return: The CPU int64 lengths of shape [batch size]
+        :rtype: torch.Tensor
+        """
+        positions = torch.arange(batch.size(1), device = batch.device)
+        return ((batch != 0) * positions).max(dim = 1)[0].clamp(min = 1).cpu()
+
+    def predict(self, batch : torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Predicts every next token of a batch from the previous ones, starting from
+        zero hidden states. With self.packed_sequences, the trailing padding of the rows
+        is skipped.
+
+        :param batch: The token ids of shape [batch size, sequence length]
+        :type batch: torch.Tensor
+        :return: The scores of shape [number of predictions, vocab size] and the
+        corresponding labels of shape [number of predictions]
+        :rtype: Tuple[torch.Tensor, torch.Tensor]
+        """
+        inputs, labels = batch[:,:-1], batch[:,1:]
+        hidden = self.init_hidden(len(batch))
+        if not self.packed_sequences:
+            outputs, _ = self.forward(inputs, hidden)
+            return outputs.reshape(-1, outputs.size(-1)), labels.reshape(-1)
+        lengths = self.sequence_lengths(batch)
+        outputs, _ = self.forward(inputs, hidden, lengths)
+        labels = torch.nn.utils.rnn.pack_padded_sequence(
+            labels, lengths, batch_first = True, enforce_sorted = False
+        ).data
+        return outputs, labels
     
     def init_weights(self) -> None:
         """
@@ -263,64 +341,231 @@ class NextWordPredictorModel(torch.nn.Module):
         :type with_recall: bool, optional
         :param with_tqdm: Whether to display process evolution, defaults to False
         :type with_tqdm: bool, optional
-        :return: [description]
-        :rtype: [type]
-        """        
-
+        :return: (perplexity, loss) or (perplexity, loss, R1, R3)
+        :rtype: Union[Tuple[float, float], Tuple[float, float, float, float]]
         """
-        Computes the perplexity of the model on the given dataset
+        self.eval()
+        with torch.no_grad():
+            metrics = self.dataloader_metrics(dataloader, with_recall = with_recall, with_tqdm = with_tqdm)
+        if with_recall:
+            return metrics['perplexity'], metrics['loss'], metrics['f1_recall'], metrics['f3_recall']
+        else:
+            return metrics['perplexity'], metrics['loss']
 
-        Parameters
-        ----------
-        - dataloader : torch.utils.data.DataLoader
-            The data to be tested
+    def evaluate_metrics(
+        self,
+        dataloaders : Dict[Hashable, torch.utils.data.DataLoader],
+        metrics : Union[Iterable[str], Dict[Hashable, Iterable[str]]] = METRICS,
+        with_tqdm : bool = False
+    ) -> Dict[Hashable, Dict[str, float]]:
+        """Evaluates several data loaders at once. At every step, the next batches of all
+        the data loaders go through a single forward pass from which all the requested
+        metrics are computed (see dataloaders_metrics).
+        The available metrics are 'perplexity', 'loss', 'f1_recall', 'f3_recall' and
+        'total_loss' (the loss plus the model regularizer, as in evaluate()).
+
+        :param dataloaders: the data loaders to evaluate, indexed by name
+        :type dataloaders: Dict[Hashable, torch.utils.data.DataLoader]
+        :param metrics: the metrics to compute, either for all the data loaders or
+        given per data loader name, defaults to METRICS
+        :type metrics: Union[Iterable[str], Dict[Hashable, Iterable[str]]], optional
+        :param with_tqdm: Whether to display process evolution, defaults to False
+        :type with_tqdm: bool, optional
+        :raises ValueError: if a requested metric does not exist
+        :return: the requested metrics of every data loader, indexed by name
+        :rtype: Dict[Hashable, Dict[str, float]]
         """
+        requested = {name : metrics[name] if isinstance(metrics, dict) else metrics for name in dataloaders}
+        for name_metrics in requested.values():
+            unknown = set(name_metrics) - set(METRICS) - {'total_loss'}
+            if len(unknown) > 0:
+                raise ValueError(f'unknown metrics: {unknown}')
+        with_recall = any('f1_recall' in m or 'f3_recall' in m for m in requested.values())
         self.eval()
-        m = torch.nn.Softmax(dim = 0)
-        total_losses = []
+        results = {}
         with torch.no_grad():
-            total_tokens = 0
-            probabilities = []
-            if with_recall:
-                total, top1hit, top3hit = 0,0,0
-            for batch in tqdm(dataloader) if with_tqdm else dataloader:
-                hidden = self.init_hidden(dataloader.batch_size)
-                outputs, _ = self.forward(batch[:,:-1], hidden)
-                outputs = torch.transpose(outputs, 1,2)
-                labels = batch[:,1:]
-                
-                for i in range(dataloader.batch_size):
-                    seq = outputs[i]
-                    lab = labels[i]
+            computed = self.dataloaders_metrics(dataloaders, with_recall = with_recall, with_tqdm = with_tqdm)
+            if any('total_loss' in m for m in requested.values()):
+                reg_loss = self.regularizer().item()
+            for name, name_metrics in requested.items():
+                if 'total_loss' in name_metrics:
+                    computed[name]['total_loss'] = computed[name]['loss'] + reg_loss
+                results[name] = {metric : computed[name][metric] for metric in name_metrics}
+        return results
+
+    def row_to_predictions(self, batch : torch.Tensor, row_values : torch.Tensor) -> torch.Tensor:
+        """Repeats a value per row of the batch for every prediction of the row, in the
+        order of the predictions returned by predict(batch).
+
+        :param batch: The token ids of shape [batch size, sequence length]
+        :type batch: torch.Tensor
+        :param row_values: The values of shape [batch size]
+        :type row_values: torch.Tensor
+        :return: The values of shape [number of predictions]
+        :rtype: torch.Tensor
+        """
+        values = row_values.unsqueeze(1).expand(-1, batch.size(1) - 1)
+        if not self.packed_sequences:
+            return values.reshape(-1)
+        return torch.nn.utils.rnn.pack_padded_sequence(
+            values, self.sequence_lengths(batch), batch_first = True, enforce_sorted = False
+        ).data
+
+    def row_losses(self, batch : torch.Tensor, outputs : torch.Tensor, labels : torch.Tensor) -> torch.Tensor:
+        """Computes the loss of every row of the batch from the predictions of
+        predict(batch), as self.criterion would on each row alone.
+
+        :param batch: The token ids of shape [batch size, sequence length]
+        :type batch: torch.Tensor
+        :param outputs: The scores returned by predict(batch)
+        :type outputs: torch.Tensor
+        :param labels: The labels returned by predict(batch)
+        :type labels: torch.Tensor
+        :return: The losses of shape [batch size]
+        :rtype: torch.Tensor
+        """
+        class_weights = self.criterion.weight
+        token_losses = torch.nn.functional.cross_entropy(
+            outputs,
+            labels,
+            weight = None if class_weights is None else class_weights.reshape(-1),
+            ignore_index = 0,
+            reduction = 'none'
+        )
+        token_weights = (labels != 0).to(token_losses.dtype)
+        if class_weights is not None:
+            token_weights = token_weights * class_weights.reshape(-1)[labels]
+        rows = self.row_to_predictions(batch, torch.arange(len(batch), device = batch.device))
+        losses = torch.zeros(len(batch), dtype = token_losses.dtype, device = batch.device)
+        normalization = torch.zeros_like(losses)
+        return losses.index_add_(0, rows, token_losses) / normalization.index_add_(0, rows, token_weights)
+
+    def dataloader_metrics(
+        self,
+        dataloader : torch.utils.data.DataLoader,
+        with_recall : bool = True,
+        with_tqdm : bool = False
+    ) -> Dict[str, float]:
+        """Computes the perplexity, the loss and optionally $R_1$ & $R_3$ of the given
+        data loader in a single pass. Must be called in eval mode and without gradients.
+        See dataloaders_metrics.
 
-                    logits = m(seq)
+        :param dataloader: data loader to evaluate
+        :type dataloader: torch.utils.data.DataLoader
+        :param with_recall: Whether to also compute $R_1$ & $R_3$, defaults to True
+        :type with_recall: bool, optional
+        :param with_tqdm: Whether to display process evolution, defaults to False
+        :type with_tqdm: bool, optional
+        :return: dictionary of the computed metrics
+        :rtype: Dict[str, float]
+        """
+        return self.dataloaders_metrics({None : dataloader}, with_recall, with_tqdm)[None]
 
-                    
-                    if with_recall:
-                        for top3, label in zip(torch.topk(logits.T,3)[1].cpu().numpy(), lab.cpu().numpy()):
-                            if label not in [0,1]:
-                                if label in top3:
-                                    top3hit += 1
-                                if label == top3[0]:
-                                    top1hit += 1
-                                total += 1
-
-                    logits = logits[lab,range(len(lab))]
-                    logits = logits[lab != 0].cpu().numpy()
-                    # logits = np.where(logits == 0, 1e-50, logits) # adds a regularizer to avoid explosion of the log
-                    probabilities.append(sum(np.log(logits)))
-                    total_tokens += len(logits)
-
-                total_losses.append(self.criterion(outputs, labels).item())
-
-        perplexity = np.exp(- np.sum(probabilities) / total_tokens)
-        test_loss = np.mean(total_losses)
-        if with_recall:
-            f1_recall = top1hit / total
-            f3_recall = top3hit / total
-            return perplexity, test_loss, f1_recall, f3_recall
-        else:
-            return perplexity, test_loss
+    def dataloaders_metrics(
+        self,
+        dataloaders : Dict[Hashable, torch.utils.data.DataLoader],
+        with_recall : bool = True,
+        with_tqdm : bool = False
+    ) -> Dict[Hashable, Dict[str, float]]:
+        """Computes the perplexity, the loss and optionally $R_1$ & $R_3$ of several data
+        loaders with a single forward pass per step. At every step, the next batch of each
+        data loader not yet exhausted are concatenated, right padded to the same length,
+        and the statistics of every row are accumulated for the data loader it comes from.
+        The metrics of a data loader are the same as when it is evaluated alone. Must be
+        called in eval mode and without gradients.
+
+        If a data loader is over a deduplicated SequenceDataset, every row is evaluated
+        once and its statistics are weighted by its count. The loss is then the mean of
+        the row losses weighted by their counts, which is the loss of the duplicated rows
+        evaluated with a batch size of 1.
+
+        All the statistics are accumulated on the model device and only copied to the
+        host once at the end of the pass.
+
+        :param dataloaders: data loaders to evaluate, indexed by name
+        :type dataloaders: Dict[Hashable, torch.utils.data.DataLoader]
+        :param with_recall: Whether to also compute $R_1$ & $R_3$, defaults to True
+        :type with_recall: bool, optional
+        :param with_tqdm: Whether to display process evolution, defaults to False
+        :type with_tqdm: bool, optional
+        :return: dictionary of the computed metrics of every data loader
+        :rtype: Dict[Hashable, Dict[str, float]]
+        """
+        names = list(dataloaders)
+        # per data loader: [sum of log probabilities, number of tokens, top1 hits, top3 hits,
+        # number of recall tokens, sum of the weighted row losses, sum of the row weights]
+        stats = torch.zeros(len(names), 7, dtype = torch.float64, device = self.device)
+        batch_losses = [[] for _ in names]
+        iterators = [
+            dataloader.batches_with_counts() if isinstance(dataloader, SequenceDataLoader)
+            else ((batch, None) for batch in dataloader)
+            for dataloader in dataloaders.values()
+        ]
+        steps = itertools.zip_longest(*iterators)
+        if with_tqdm:
+            steps = tqdm(steps, total = max(len(dataloader) for dataloader in dataloaders.values()))
+        for step in steps:
+            tags = [tag for tag, batch in enumerate(step) if batch is not None]
+            width = max(step[tag][0].size(1) for tag in tags)
+            batch = torch.cat([
+                torch.nn.functional.pad(step[tag][0], (0, width - step[tag][0].size(1))) for tag in tags
+            ])
+            row_tags = torch.cat([
+                torch.full((len(step[tag][0]),), tag, dtype = torch.long, device = batch.device) for tag in tags
+            ])
+            row_weights = torch.cat([
+                torch.ones(len(step[tag][0]), device = batch.device) if step[tag][1] is None
+                else step[tag][1].to(batch.device, torch.float) for tag in tags
+            ])
+            outputs, labels = self.predict(batch)
+            token_tags = self.row_to_predictions(batch, row_tags)
+            # the counts are applied in double precision, as the statistics are accumulated
+            weights = self.row_to_predictions(batch, row_weights).double()
+
+            log_probs = torch.log_softmax(outputs.float(), dim = -1)
+            label_log_probs = log_probs.gather(1, labels.unsqueeze(1)).squeeze(1)
+            mask = labels != 0
+            stats[:,0].index_add_(0, token_tags[mask], (label_log_probs.double() * weights)[mask])
+            stats[:,1].index_add_(0, token_tags[mask], weights[mask])
+
+            if with_recall:
+                # the padding and unknown tokens are not taken into account for the recall
+                recall_mask = labels > 1
+                hits = torch.topk(outputs, 3, dim = -1)[1] == labels.unsqueeze(1)
+                top1 = hits[:,0] & recall_mask
+                top3 = hits.any(dim = 1) & recall_mask
+                stats[:,2].index_add_(0, token_tags[top1], weights[top1])
+                stats[:,3].index_add_(0, token_tags[top3], weights[top3])
+                stats[:,4].index_add_(0, token_tags[recall_mask], weights[recall_mask])
+
+            counted = [tag for tag in tags if step[tag][1] is not None]
+            if len(counted) > 0:
+                row_losses = self.row_losses(batch, outputs, labels)
+            for tag in tags:
+                if step[tag][1] is None and len(tags) == 1:
+                    batch_losses[tag].append(self.criterion(outputs, labels))
+                elif step[tag][1] is None:
+                    # the criterion of the batch of this data loader alone
+                    tag_mask = token_tags == tag
+                    batch_losses[tag].append(self.criterion(outputs[tag_mask], labels[tag_mask]))
+                else:
+                    row_mask = row_tags == tag
+                    stats[tag,5] += (row_losses[row_mask] * row_weights[row_mask]).sum()
+                    stats[tag,6] += row_weights[row_mask].sum()
+
+        losses = [torch.stack(losses).mean() if len(losses) > 0 else None for losses in batch_losses]
+        stats = stats.cpu().numpy()
+        results = {}
+        for tag, name in enumerate(names):
+            metrics = {
+                'perplexity' : np.exp(- stats[tag,0] / stats[tag,1]),
+                'loss' : losses[tag].item() if losses[tag] is not None else stats[tag,5] / stats[tag,6]
+            }
+            if with_recall:
+                metrics['f1_recall'] = stats[tag,2] / stats[tag,4]
+                metrics['f3_recall'] = stats[tag,3] / stats[tag,4]
+            results[name] = metrics
+        return results
     
     def evaluate(
         self, 
@@ -335,6 +580,9 @@ class NextWordPredictorModel(torch.nn.Module):
         loss separetly (total_loss, pred_loss, reg_loss).
         If the model has the 'general_regularizer' attribute, the reg_loss will be
         computed with respect to it instead of the weigth decay.
+        If the data loader is over a deduplicated SequenceDataset, the losses are the
+        ones of the duplicated rows evaluated with a batch size of 1: every row is
+        evaluated once and its losses are repeated by its count.
 
         :param dataloader: The data loader to be evaluated
         :type dataloader: torch.utils.data.DataLoader
@@ -355,16 +603,29 @@ class NextWordPredictorModel(torch.nn.Module):
             regularizer_losses = []
 
         total_losses = []
+        def add(values : list, tensor : torch.Tensor, counts : torch.Tensor):
+            if counts is None:
+                values.append(tensor.item())
+            else:
+                values.extend(np.repeat(tensor.expand(len(counts)).cpu().numpy(), counts.cpu().numpy()))
+
+        if isinstance(dataloader, SequenceDataLoader):
+            batches = dataloader.batches_with_counts()
+        else:
+            batches = ((batch, None) for batch in dataloader)
         with torch.no_grad():
-            for batch in tqdm(dataloader) if with_tqdm else dataloader:
-                hidden = self.init_hidden(dataloader.batch_size)
-                outputs, _ = self.forward(batch[:,:-1], hidden)
-                outputs = torch.transpose(outputs, 1,2)
-                labels = batch[:,1:]
+            for batch, counts in tqdm(batches, total = len(dataloader)) if with_tqdm else batches:
+                outputs, labels = self.predict(batch)
                 
-                loss = self.criterion(outputs, labels)
+                if counts is None:
+                    loss = self.criterion(outputs, labels)
+                    batch_size = len(batch)
+                else:
+                    # the loss of every row, each standing for counts batches of size 1
+                    loss = self.row_losses(batch, outputs, labels)
+                    batch_size = 1
                 if node is not None:
-                    reg_loss = self.regularizer() / len(batch)
+                    reg_loss = self.regularizer() / batch_size
                     if hasattr(self, 'general_regularizer'):
                         loss = reg_loss + loss
                         reg_loss = self.general_regularizer(node)
@@ -375,11 +636,10 @@ class NextWordPredictorModel(torch.nn.Module):
                 else:
                     total_loss = loss
                 
-
-                total_losses.append(total_loss.item())
+                add(total_losses, total_loss, counts)
                 if sep_losses:
-                    sample_losses.append(loss.item())
-                    regularizer_losses.append(reg_loss.item())
+                    add(sample_losses, loss, counts)
+                    add(regularizer_losses, reg_loss, counts)
                 
         if sep_losses:
             return total_losses, sample_losses, regularizer_losses
@@ -420,13 +680,11 @@ class NextWordPredictorModel(torch.nn.Module):
         for batch in iterator:
             for param in self.parameters():
                 param.grad = None
-            hidden = self.init_hidden(data_loader.batch_size)
-            outputs, _ = self.forward(batch[:,:-1], hidden)
-            outputs = torch.transpose(outputs, 1, 2)
-            labels = batch[:,1:]
+            outputs, labels = self.predict(batch)
             
             loss = self.criterion(outputs, labels)
-            reg_loss = self.regularizer() / len(batch)
+            # the gradient of the regularizer is added by add_regularizer_grad after the backward
+            reg_loss = self.regularizer(with_graph = False) / len(batch)
             # If we have a general model reg loss, we say that the reg loss is the latter
             # Otherwise it is the self model regularization loss
             if hasattr(self, 'general_regularizer'):
@@ -438,9 +696,11 @@ class NextWordPredictorModel(torch.nn.Module):
             if self.fp16 == 1:
                 with amp.scale_loss(total_loss, self.optimizer) as scaled_loss:
                     scaled_loss.backward()
+                self.add_regularizer_grad(1 / len(batch))
                 self.optimizer.step()
             else:
                 total_loss.backward()
+                self.add_regularizer_grad(1 / len(batch))
                 torch.nn.utils.clip_grad_norm_(self.parameters(), 0.5)
                 self.optimizer.step()
                 
@@ -522,27 +782,80 @@ class NextWordPredictorModel(torch.nn.Module):
     def freeze_embeddings(self):
         for p in self.embedding_layer.parameters():
             p.requires_grad = False
+        self.regularized_params = None
 
     def unfreeze_embeddings(self):
         for p in self.embedding_layer.parameters():
             p.requires_grad = True
+        self.regularized_params = None
+
+    def freeze(self):
+        for p in self.parameters():
+            p.requires_grad = False
+        self.regularized_params = None
+
+    def unfreeze(self):
+        for p in self.parameters():
+            p.requires_grad = True
+        self.regularized_params = None
 
-    def regularizer(self) -> torch.Tensor:
+    def regularized_parameters(self) -> List[torch.nn.Parameter]:
+        """The non bias and trainable parameters. The list is only computed again after
+        freeze, unfreeze, freeze_embeddings or unfreeze_embeddings, which should be used
+        to change the trainable parameters.
+
+        :rtype: List[torch.nn.Parameter]
+        """
+        if self.regularized_params is None:
+            self.regularized_params = [
+                W for name, W in self.named_parameters() if W.requires_grad and 'bias' not in name
+            ]
+        return self.regularized_params
+
+    def regularizer(self, with_graph : bool = True) -> torch.Tensor:
         """Computes the regularizer on all the non bias and trainable parameters.
         $$\frac{1}{p} \gamma \sum_w w^p$$
 
+        :param with_graph: Whether to build the graph of the regularizer for its backward.
+        Without it, only its value is computed and its gradient can be added with
+        add_regularizer_grad, defaults to True
+        :type with_graph: bool, optional
         :return: The tensor with the backward regularization loss
         :rtype: torch.Tensor
         """        
-        reg = torch.FloatTensor([0]).to(self.device)
-        reg.requires_grad = True
-        if self.gamma == 0:
+        params = self.regularized_parameters()
+        if self.gamma == 0 or len(params) == 0:
+            reg = torch.FloatTensor([0]).to(self.device)
+            reg.requires_grad = True
             return reg
-        else:
-            for name, W in self.named_parameters():
-                if W.requires_grad and 'bias' not in name:
-                    reg = reg + torch.pow(W, self.q).sum()
-            return 1/self.q * self.gamma * reg
+        with torch.set_grad_enabled(with_graph and torch.is_grad_enabled()):
+            if self.q == 2:
+                # sum of the squared norms of the weights
+                reg = torch.stack(torch._foreach_norm(params)).pow(2).sum()
+            else:
+                reg = torch.cat([W.reshape(-1) for W in params]).pow(self.q).sum()
+            return (1/self.q * self.gamma * reg).reshape(1)
+
+    def add_regularizer_grad(self, scale : float = 1.):
+        """Adds scale times the gradient of the regularizer, $\gamma w^{p - 1}$, to the
+        gradients of the regularized parameters without building any graph. For p = 2
+        it is a weight decay of the non bias parameters.
+
+        :param scale: factor of the regularizer, defaults to 1.
+        :type scale: float, optional
+        """
+        params = self.regularized_parameters()
+        if self.gamma == 0 or len(params) == 0:
+            return
+        with torch.no_grad():
+            for W in params:
+                if W.grad is None:
+                    W.grad = torch.zeros_like(W)
+            grads = [W.grad for W in params]
+            if self.q == 2:
+                torch._foreach_add_(grads, params, alpha = scale * self.gamma)
+            else:
+                torch._foreach_add_(grads, torch._foreach_pow(params, self.q - 1), alpha = scale * self.gamma)
 
     def fit(
         self, 
@@ -624,12 +937,173 @@ class NextWordPredictorModel(torch.nn.Module):
                     
         return metrics
 
+    def encode_prompt(self, vocabulary : Vocabulary, start_text : str) -> List[int]:
+        """Cleans a starting text and maps its space separated words to their ids,
+        0 for the words out of the vocabulary
+
+        :param vocabulary: The vocabulary of the model
+        :type vocabulary: Vocabulary
+        :param start_text: The text to start the generation with
+        :type start_text: str
+        :rtype: List[int]
+        """
+        start_text = vocabulary.text_cleaner(start_text)
+        return [vocabulary.word_to_idx.get(w, 0) for w in start_text.split(' ')]
+
+    def run_prompts(
+        self,
+        prompts : List[List[int]]
+    ) -> Tuple[torch.Tensor, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]:
+        """Runs the prompts of token ids through the RNN in a single packed batch.
+        Must be called without gradients.
+
+        :param prompts: The token ids of every prompt, each of at least 1 token
+        :type prompts: List[List[int]]
+        :return: The scores of the token following every prompt, of shape
+        [number of prompts, vocab size], and the hidden states after the prompts
+        :rtype: Tuple[torch.Tensor, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]
+        """
+        lengths = torch.tensor([len(prompt) for prompt in prompts])
+        inputs = torch.zeros(len(prompts), int(lengths.max()), dtype = torch.long)
+        for i, prompt in enumerate(prompts):
+            inputs[i, :len(prompt)] = torch.as_tensor(prompt)
+        # only the last token of every prompt goes through the output layer
+        _, hidden = self.run_rnn(inputs.to(self.device), self.init_hidden(len(prompts)), lengths)
+        # the output of the last layer at the last token of every prompt
+        last_outputs = (hidden[0] if self.has_cell_state else hidden)[-1]
+        return self.linear(last_outputs), hidden
+
+    def step(
+        self,
+        inputs : torch.Tensor,
+        hidden : Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
+        positions : torch.Tensor = None
+    ) -> Tuple[torch.Tensor, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]:
+        """Continues sequences from their hidden states with new tokens and returns
+        the scores of the token following the last one.
+
+        :param inputs: The new token ids of shape [batch size, number of new tokens]
+        :type inputs: torch.Tensor
+        :param hidden: The hidden states after the previous tokens
+        :type hidden: Union[torch.Tensor, Tuple(torch.Tensor, torch.Tensor)]
+        :param positions: The number of previous tokens of every row, only needed with
+        the positional encoding, defaults to None (no previous tokens)
+        :type positions: torch.Tensor, optional
+        :return: The scores of shape [batch size, vocab size] and the new hidden states
+        :rtype: Tuple[torch.Tensor, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]
+        """
+        embeddings = self.embedding_layer(inputs)
+        if self.positional_encoding:
+            embeddings = self.positional_encoder(embeddings, positions)
+        output, hidden = self.rnn(embeddings, hidden)
+        return self.linear(output[:, -1]), hidden
+
+    def next_tokens(
+        self,
+        logits : torch.Tensor,
+        random : bool = True,
+        top_k : int = None,
+        generator : torch.Generator = None
+    ) -> torch.Tensor:
+        """Chooses the next token of every row on the model device, either the most
+        probable one or a sample of the distribution, restricted to the top_k most
+        probable tokens if given.
+
+        :param logits: The scores of shape [batch size, vocab size]
+        :type logits: torch.Tensor
+        :param random: Whether to sample the distribution or take the most probable token, defaults to True
+        :type random: bool, optional
+        :param top_k: Number of most probable tokens to sample from, defaults to None (all)
+        :type top_k: int, optional
+        :param generator: The random generator of the sampling, defaults to None (the default torch one)
+        :type generator: torch.Generator, optional
+        :return: The chosen token ids of shape [batch size]
+        :rtype: torch.Tensor
+        """
+        if not random:
+            return logits.argmax(dim = -1)
+        if top_k is not None:
+            top_logits, top_indices = torch.topk(logits, top_k, dim = -1)
+            choice = torch.multinomial(torch.softmax(top_logits.float(), dim = -1), 1, generator = generator)
+            return top_indices.gather(1, choice).squeeze(1)
+        return torch.multinomial(torch.softmax(logits.float(), dim = -1), 1, generator = generator).squeeze(1)
+
+    def generate_ids(
+        self,
+        prompts : List[List[int]],
+        num_words : int = 100,
+        random : bool = True,
+        top_k : int = None,
+        generator : torch.Generator = None
+    ) -> List[List[int]]:
+        """Completes a batch of prompts of token ids. The prompts are run once, then
+        every step only feeds the last chosen tokens and carries the hidden states.
+
+        :param prompts: The token ids of every prompt, each of at least 1 token
+        :type prompts: List[List[int]]
+        :param num_words: The number of tokens to predict, defaults to 100
+        :type num_words: int, optional
+        :param random: Whether to use the distribution or the most probable next token, defaults to True
+        :type random: bool, optional
+        :param top_k: Number of most probable tokens to sample from, defaults to None (all)
+        :type top_k: int, optional
+        :param generator: The random generator of the sampling, defaults to None (the default torch one)
+        :type generator: torch.Generator, optional
+        :return: The generated token ids of every prompt
+        :rtype: List[List[int]]
+        """
+        self.eval()
+        generated = torch.zeros(len(prompts), num_words, dtype = torch.long, device = self.device)
+        with torch.no_grad():
+            logits, hidden = self.run_prompts(prompts)
+            positions = torch.tensor([len(prompt) for prompt in prompts], device = self.device)
+            for i in range(num_words):
+                tokens = self.next_tokens(logits, random = random, top_k = top_k, generator = generator)
+                generated[:, i] = tokens
+                if i == num_words - 1:
+                    break
+                logits, hidden = self.step(tokens.unsqueeze(1), hidden, positions)
+                positions = positions + 1
+        return generated.tolist()
+
+    def generate_batch(
+        self,
+        vocabulary : Vocabulary,
+        start_texts : List[str],
+        num_words : int = 100,
+        random : bool = True,
+        top_k : int = None
+    ) -> List[str]:
+        """Completes several starting texts at once, see generate
+
+        :param vocabulary: The vocabulary of the model
+        :type vocabulary: Vocabulary
+        :param start_texts: The texts to start the generation with
+        :type start_texts: List[str]
+        :param num_words: The number of tokens to predict, defaults to 100
+        :type num_words: int, optional
+        :param random: Whether to use the distribution or the most probable next token, defaults to True
+        :type random: bool, optional
+        :param top_k: Number of most probable tokens to sample from, defaults to None (all)
+        :type top_k: int, optional
+        :return: The generated attached token sequences
+        :rtype: List[str]
+        """
+        prompts = [self.encode_prompt(vocabulary, start_text) for start_text in start_texts]
+        generated = self.generate_ids(prompts, num_words, random = random, top_k = top_k)
+        texts = []
+        for prompt, tokens in zip(prompts, generated):
+            res = ' '.join([vocabulary.idx_to_word[i] for i in prompt + tokens])
+            texts.append(re.sub(r' \.', '.', res))
+        return texts
+
     def generate(
         self,
         vocabulary : Vocabulary, 
         start_text : str, 
         num_words : int = 100, 
-        random : bool = True
+        random : bool = True,
+        top_k : int = None
     ) -> str:
         """Given a starting text, generates a string deterministically or according to
         the language model distribution for num_words tokens
@@ -642,28 +1116,12 @@ class NextWordPredictorModel(torch.nn.Module):
         :type num_words: int, optional
         :param random: Whether to use the distribution or the most probable next token, defaults to True
         :type random: bool, optional
+        :param top_k: Number of most probable tokens to sample from, defaults to None (all)
+        :type top_k: int, optional
         :return: The generated attached token sequence
         :rtype: str
         """    
-        start_text = vocabulary.text_cleaner(start_text)
-        tokens = [vocabulary.word_to_idx[w] if w in vocabulary.word_to_idx.keys() else 0 for w in start_text.split(' ')]
-        self.eval()
-        with torch.no_grad():
-            s = torch.nn.Softmax(dim = 0)
-            for i in range(num_words):
-                hidden = self.init_hidden(1)
-                x = torch.tensor([tokens]).to(self.device)
-                logits, _ = self(x, hidden)
-                logits = logits[0][-1]
-                p = s(logits).cpu().numpy()
-                if random:
-                    word_index = np.random.choice(logits.shape[0], p = p)
-                else:
-                    word_index = np.argmax(p)
-                tokens.append(word_index)
-
-        res = ' '.join([vocabulary.idx_to_word[i] for i in tokens])
-        return re.sub(r' \.', '.', res)
+        return self.generate_batch(vocabulary, [start_text], num_words, random = random, top_k = top_k)[0]
 
 def init_model(
     vocabulary : Vocabulary,
@@ -770,13 +1228,31 @@ class Pipeline():
             - min_word_occ : int
                 Least number of times a word must occur to be in voc
             - vocab_file : str
-                path to where to load or save the vocabulary (in pickle format)
+                path to where to load or save the vocabulary (see Vocabulary.save)
             - min_seq_length
                 minimum sequence length
             - max_seq_length
                 maximum sequence length
             - device
                 the device where the data is loaded
+            - cache_folder
+                where to cache the tokenized datasets (optional)
+            - vocab_num_workers
+                number of processes counting the tokens when building the
+                vocabulary (optional). For WikiText, the articles are then
+                tokenized one by one instead of joined
+            - dataset_num_workers
+                number of processes tokenizing the sentences of the datasets
+                (optional)
+            - packed
+                whether to pack the sentences of the train set into full rows
+                instead of padding each of them (optional)
+            - tokenizer
+                name of the tokenizer of a new vocabulary (optional), see
+                data_processing.TOKENIZERS
+            - sentence_splitter
+                name of the sentence splitter of a new vocabulary (optional),
+                see data_processing.SENTENCE_SPLITTERS
 
         :raises AssertionError: if data is not found
         """        
@@ -791,12 +1267,6 @@ class Pipeline():
             val_set_file = os.path.join(data_folder, f'val_{id_}.pickle')
             test_set_file = os.path.join(data_folder, f'test_{id_}.pickle')
 
-            tokenizer = TweetTokenizer(
-                preserve_case = False,
-                strip_handles = True, #removes things like: @bob ...,
-                reduce_len = True #more than 3 times same characters are limited waaaaayyyy -> waaayyy
-            ).tokenize
-
             with open(train_set_file, 'rb') as f:
                 train_set = pickle.load(f)
             train_set = train_set
@@ -806,16 +1276,16 @@ class Pipeline():
                     max_voc_size = params['max_voc_size'],
                     min_word_occ = params['min_word_occ'],
                     tweets = train_set,
-                    tokenizer = tokenizer,
+                    num_workers = params.get('vocab_num_workers', 0),
+                    tokenizer = params.get('tokenizer', 'tweet'),
+                    sentence_splitter = params.get('sentence_splitter', 'nltk'),
                     text_cleaner = None
                 )
                 logging.info('vocabulary generated')
-                with open(vocab_path, 'wb') as f:
-                    pickle.dump(self.vocabulary, f)
+                self.vocabulary.save(vocab_path)
             else:
                 try:
-                    with open(vocab_path, 'rb') as f:
-                        self.vocabulary = pickle.load(f)
+                    self.vocabulary = load_vocabulary(vocab_path)
                     logging.info('vocabulary loaded')
                 except FileNotFoundError:
                     logging.error("vocabulary file not found")
@@ -834,7 +1304,6 @@ class Pipeline():
             val_set_file = os.path.join(path, f'val_{id_}.pickle')
             test_set_file = os.path.join(path, f'test_{id_}.pickle')
 
-            tokenizer = word_tokenize
             with open(train_set_file, 'rb') as f:
                 train_set = pickle.load(f)
             if params['vocab_from_scratch']:
@@ -843,16 +1312,16 @@ class Pipeline():
                     max_voc_size = params['max_voc_size'],
                     min_word_occ = params['min_word_occ'],
                     text_cleaner = text_cleaner_raw,
-                    text = ' '.join(train_set),
-                    tokenizer = tokenizer
+                    text = train_set if params.get('vocab_num_workers', 0) > 0 else ' '.join(train_set),
+                    num_workers = params.get('vocab_num_workers', 0),
+                    tokenizer = params.get('tokenizer', 'word'),
+                    sentence_splitter = params.get('sentence_splitter', 'nltk')
                 )
                 logging.info('vocabulary generated')
-                with open(vocab_path, 'wb') as f:
-                    pickle.dump(self.vocabulary, f)
+                self.vocabulary.save(vocab_path)
             else:
                 try:
-                    with open(vocab_path, 'rb') as f:
-                        self.vocabulary = pickle.load(f)
+                    self.vocabulary = load_vocabulary(vocab_path)
                     logging.info('vocabulary loaded')
                 except FileNotFoundError:
                     logging.error("vocabulary file not found")
@@ -868,9 +1337,12 @@ class Pipeline():
                 min_seq_length = params['min_seq_length'],
                 max_seq_length = params['max_seq_length'],
                 device = params['device'],
-                with_tqdm = True
+                with_tqdm = True,
+                cache_folder = params.get('cache_folder'),
+                num_workers = params.get('dataset_num_workers', 0),
+                packed = params.get('pack_sentences', False)
             )
-            logging.info('train dataset created')
+            logging.info(f'train dataset created, padding fraction: {self.train_dataset.padding_fraction():.3f}')
             logging.info('creating validation dataset...')
             with open(val_set_file, 'rb') as f:
                 val_set = pickle.load(f)
@@ -880,7 +1352,9 @@ class Pipeline():
                 min_seq_length = params['min_seq_length'],
                 max_seq_length = params['max_seq_length'],
                 device = params['device'],
-                with_tqdm = True
+                with_tqdm = True,
+                cache_folder = params.get('cache_folder'),
+                num_workers = params.get('dataset_num_workers', 0)
             )
             logging.info('validation dataset created')
         logging.info('creating test dataset...')
@@ -892,7 +1366,9 @@ class Pipeline():
             min_seq_length = params['min_seq_length'],
             max_seq_length = params['max_seq_length'],
             device = params['device'],
-            with_tqdm = True
+            with_tqdm = True,
+            cache_folder = params.get('cache_folder'),
+            num_workers = params.get('dataset_num_workers', 0)
         )
         logging.info('test dataset created')
         gc.collect()
@@ -900,7 +1376,7 @@ class Pipeline():
     def train_model(self, name : str = 'test'):
         """
         Wrapper of the *.fit* method of the NextWordPredictorModel that first instanciate
-        the train-val torch.utils.data.DataLoader and then trains the model and uses the
+        the train-val SequenceDataLoader and then trains the model and uses the
         parameters contained in the self.parameters attribute.
 
         :param name: name of the generated graphs, defaults to 'test'
@@ -913,18 +1389,16 @@ class Pipeline():
         batch_size = training_parameters.pop("batch_size")
         model_name = training_parameters.pop("model_name")
 
-        train_dataloader = torch.utils.data.DataLoader(
+        train_dataloader = SequenceDataLoader(
             self.train_dataset,
             batch_size = batch_size,
             shuffle = True,
-            pin_memory = False,
             drop_last = True
         )
-        val_dataloader = torch.utils.data.DataLoader(
+        val_dataloader = SequenceDataLoader(
             self.val_dataset,
             batch_size = batch_size,
             shuffle = False,
-            pin_memory = False,
             drop_last = True
         )
         
@@ -943,11 +1417,10 @@ class Pipeline():
         plt.savefig(os.path.join('.','results',f'training_plot_{name}.svg'))
 
     def evaluate(self):
-        test_dataloader = torch.utils.data.DataLoader(
+        test_dataloader = SequenceDataLoader(
             self.test_dataset,
             batch_size = 4,
             shuffle = False,
-            pin_memory = False,
             drop_last = True
         )
         return self.model.evaluate(test_dataloader)
@@ -955,11 +1428,10 @@ class Pipeline():
     def perplexity(self, dataset = None, **kwargs):
         if dataset is None:
             dataset = self.test_dataset
-        dataloader = torch.utils.data.DataLoader(
+        dataloader = SequenceDataLoader(
             self.test_dataset,
             batch_size = 4,
             shuffle = False,
-            pin_memory = False,
             drop_last = True
         )
         return self.model.perplexity(dataloader, **kwargs)
@@ -4,11 +4,14 @@ import os
 import re
 import sys
 import pickle
+from typing import Callable, List, Tuple
+
+import numpy as np
 import torch
 
 sys.path.append('.')
-from src.data_processing import  SequenceDataset, Vocabulary
-from src.utils import split_data
+from src.data_processing import  SequenceDataset, Vocabulary, NodeDataStore
+from src.utils import split_indices
 
 class Node():
     def __init__(
@@ -38,6 +41,73 @@ class Node():
             'reg_loss' : []
         }
 
+    def num_samples(self) -> int:
+        """Number of train samples of the node, used to weight it
+
+        :rtype: int
+        """
+        return len(self.data)
+
+class DatasetCache():
+    def __init__(self, max_bytes : int = None):
+        """Least recently used cache of node datasets shared by the nodes. When the
+        datasets take more than max_bytes, the least recently used ones are dropped
+        and rebuilt by their node on their next access.
+
+        :param max_bytes: memory budget of the datasets in bytes, defaults to None (no limit)
+        :type max_bytes: int, optional
+        """
+        self.max_bytes = max_bytes
+        self.datasets = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def dataset_nbytes(dataset : SequenceDataset) -> int:
+        """Memory taken by a dataset: its token matrix and its tensor if already created
+
+        :param dataset: the dataset
+        :type dataset: SequenceDataset
+        :rtype: int
+        """
+        nbytes = dataset.tokens.nbytes
+        if dataset.tensor is not None:
+            nbytes += dataset.tensor.element_size() * dataset.tensor.nelement()
+        return nbytes
+
+    def get(self, key : Tuple[int, str], build : Callable[[], SequenceDataset]) -> SequenceDataset:
+        """Returns the cached dataset of the given key or builds it, then evicts the
+        least recently used datasets over the budget. The size of a dataset is measured
+        again at every access, as its tensor is created by the first data loader using it.
+
+        :param key: the (node id, split name) of the dataset
+        :type key: Tuple[int, str]
+        :param build: builds the dataset if it is not cached
+        :type build: Callable[[], SequenceDataset]
+        :rtype: SequenceDataset
+        """
+        if key in self.datasets:
+            self.hits += 1
+            self.datasets.move_to_end(key)
+            dataset = self.datasets[key]
+        else:
+            self.misses += 1
+            dataset = build()
+            self.datasets[key] = dataset
+        self.nbytes += self.dataset_nbytes(dataset) - self.sizes.get(key, 0)
+        self.sizes[key] = self.dataset_nbytes(dataset)
+        if self.max_bytes is not None:
+            # the requested dataset is always kept
+            while self.nbytes > self.max_bytes and len(self.datasets) > 1:
+                evicted, _ = self.datasets.popitem(last = False)
+                self.nbytes -= self.sizes.pop(evicted)
+        return dataset
+
+    def __len__(self):
+        return len(self.datasets)
+
 class UserNode(Node):
     def __init__(
         self,
@@ -46,9 +116,15 @@ class UserNode(Node):
         min_seq_length : int,
         max_seq_length : int,
         device : str,
+        cache_folder : str = None,
+        datastore : NodeDataStore = None,
+        packed : bool = False,
+        seed : int = None,
+        datasets : DatasetCache = None,
         **kwargs
     ):
-        """[summary]
+        """Node of a user holding its own texts. Its train, val and test datasets are
+        only built on their first access and kept in the datasets cache.
 
         :param datafolder: pickle file path to node data
         :type datafolder: str
@@ -60,45 +136,120 @@ class UserNode(Node):
         :type max_seq_length: int
         :param device: name of device to put data on
         :type device: str
+        :param cache_folder: where to cache the tokenized datasets, defaults to None
+        :type cache_folder: str, optional
+        :param datastore: the opened store of datafolder, if the nodes data was
+            saved as a NodeDataStore. Otherwise, the node pickle file is looked up
+            in datafolder, defaults to None
+        :type datastore: NodeDataStore, optional
+        :param packed: whether to pack the train sentences, see SequenceDataset, defaults to False
+        :type packed: bool, optional
+        :param seed: seed of the train/val/test split, combined with the node id so that
+            every node has its own random state, defaults to None (the global numpy one)
+        :type seed: int, optional
+        :param datasets: the cache of datasets shared by the nodes, defaults to None
+            (a cache without memory budget for this node only)
+        :type datasets: DatasetCache, optional
         """    
         super(UserNode, self).__init__(**kwargs)
-        for file in os.listdir(datafolder):
-            if re.match(r'node_'+str(kwargs['id_'])+r'_.*\.pickle', file):
-                self.file = file
-
+        self.datafolder = datafolder
+        self.datastore = datastore
+        self.vocabulary = vocabulary
+        self.min_seq_length = min_seq_length
+        self.max_seq_length = max_seq_length
+        self.device = device
+        self.cache_folder = cache_folder
+        self.packed = packed
+        self.datasets = DatasetCache() if datasets is None else datasets
+        self.num_train_samples = None
+        # the cache files of the datasets already built, reopened when they are built again
+        self.cache_files = {}
+
+        if datastore is not None:
+            self.file = datastore.name(self.id_)
+        else:
+            for file in os.listdir(datafolder):
+                if re.match(r'node_'+str(self.id_)+r'_.*\.pickle', file):
+                    self.file = file
+
+        # the file name gives the number of texts, which are only read by build_dataset
         self.num_bodies = int(re.sub('\.pickle', '', self.file.split('_')[2]))
 
-        with open(os.path.join(datafolder, self.file), 'rb') as f:
-            data = pickle.load(f)
+        rng = None if seed is None else np.random.RandomState([seed, self.id_])
+        self.split_indices = dict(zip(
+            ['train', 'val', 'test'],
+            split_indices(min(self.num_bodies, 1000), rng = rng)
+        ))
 
-        train_set, val_set, test_set = split_data(data[:1000])
+    def load_texts(self) -> List[str]:
+        """Reads the texts of the node from the datastore or from its pickle file
 
-        self.data = SequenceDataset(
-            vocabulary = vocabulary,
-            text = train_set,
-            min_seq_length = min_seq_length,
-            max_seq_length = max_seq_length,
-            device = device,
-            with_tqdm=False
+        :rtype: List[str]
+        """
+        if self.datastore is not None:
+            return self.datastore.get(self.id_)
+        with open(os.path.join(self.datafolder, self.file), 'rb') as f:
+            return pickle.load(f)
+
+    def build_dataset(self, split : str) -> SequenceDataset:
+        """Builds the dataset of the given split from the texts of the node.
+        Only the train set is packed. A dataset built again after its eviction
+        from the datasets cache reopens its cache file, without reading the texts.
+
+        :param split: 'train', 'val' or 'test'
+        :type split: str
+        :rtype: SequenceDataset
+        """
+        packed = self.packed and split == 'train'
+        cache_file = self.cache_files.get(split)
+        if cache_file is not None and os.path.exists(cache_file):
+            return SequenceDataset.from_cache_file(
+                cache_file,
+                vocabulary = self.vocabulary,
+                min_seq_length = self.min_seq_length,
+                max_seq_length = self.max_seq_length,
+                device = self.device,
+                packed = packed
+            )
+        texts = self.load_texts()
+        dataset = SequenceDataset(
+            vocabulary = self.vocabulary,
+            text = [texts[i] for i in self.split_indices[split]],
+            min_seq_length = self.min_seq_length,
+            max_seq_length = self.max_seq_length,
+            device = self.device,
+            with_tqdm=False,
+            cache_folder = self.cache_folder,
+            packed = packed
         )
+        self.cache_files[split] = dataset.cache_file
+        if split == 'train':
+            self.num_train_samples = len(dataset)
+        return dataset
 
-        self.val = SequenceDataset(
-            vocabulary = vocabulary,
-            text = val_set,
-            min_seq_length = min_seq_length,
-            max_seq_length = max_seq_length,
-            device = device,
-            with_tqdm=False
-        )
+    def get_dataset(self, split : str) -> SequenceDataset:
+        return self.datasets.get((self.id_, split), lambda: self.build_dataset(split))
 
-        self.test = SequenceDataset(
-            vocabulary = vocabulary,
-            text = test_set,
-            min_seq_length = min_seq_length,
-            max_seq_length = max_seq_length,
-            device = device,
-            with_tqdm=False
-        )
+    @property
+    def data(self) -> SequenceDataset:
+        return self.get_dataset('train')
+
+    @property
+    def val(self) -> SequenceDataset:
+        return self.get_dataset('val')
+
+    @property
+    def test(self) -> SequenceDataset:
+        return self.get_dataset('test')
+
+    def num_samples(self) -> int:
+        """Number of train sequences, only building the train set on the first call
+
+        :rtype: int
+        """
+        if self.num_train_samples is None:
+            self.data
+        return self.num_train_samples
 
 class ByzantineNode(Node):
     def __init__(self, **kwargs):
@@ -259,7 +410,8 @@ class NormalDataPoisoningNode(DataPoisoningNode):
         super(NormalDataPoisoningNode, self).__init__(**kwargs)
         self.data = SequenceDataset(
             vocabulary = self.vocabulary,
-            text = (sentence * self.N)[1:], #[1:] is to avoid the first space
+            text = sentence,
+            repeats = self.N,
             min_seq_length = self.min_seq_length,
             max_seq_length = self.max_seq_length,
             device = self.device,
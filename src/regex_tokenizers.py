@@ -0,0 +1,161 @@
+import re
+import html
+from typing import List
+
+# Compiled regular expressions standing in for the NLTK tokenizers. They follow
+# the NLTK rules that matter for our data but are not exact copies of them, see
+# `python src/benchmarks.py tokenizers` for their agreement with NLTK.
+
+HANDLES_RE = re.compile(
+    r'(?<![A-Za-z0-9_!@#\$%&*])@'
+    r'(?:[A-Za-z0-9_]{15}(?!@)|[A-Za-z0-9_]{1,14}(?![A-Za-z0-9_]*@))'
+)
+
+LENGTHENING_RE = re.compile(r'(.)\1{2,}')
+
+EMOTICONS = r"""(?:
+    [<>]?[:;=8][\-o\*']?[\)\]\(\[dDpP/:\}\{@\|\\]
+  | [\)\]\(\[dDpP/:\}\{@\|\\][\-o\*']?[:;=8][<>]?
+  | </?3
+)"""
+
+EMOTICON_RE = re.compile(EMOTICONS, re.VERBOSE | re.IGNORECASE)
+
+# tokens that may contain an emoticon, which keeps its case
+EMOTICON_CHARS_RE = re.compile(r'[:;=8]')
+
+TWEET_TOKEN_RE = re.compile(r"""
+    [^\W\d_]+(?=\s|\Z)                                                  # plain words, no other pattern can match them
+  | (?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.][a-z]{2,13}/)      # urls
+    [^\s()<>{}\[\]]*[^\s`!()\[\]{};:'".,<>?«»“”‘’]
+  | (?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.][a-z]{2,13}\b/?(?!@)        # naked domains
+  | (?:\+?[01][ *\-.\)]*)?(?:\(?\d{3}[ *\-.\)]*)?\d{3}[ *\-.\)]*\d{4} # phone numbers
+  | """ + EMOTICONS + r"""                                                  # emoticons
+  | <[^>\s]+>                                                         # html tags
+  | [\-]+>|<[\-]+                                                     # arrows
+  | @\w+                                                              # handles
+  | [\w.+-]{1,64}@[\w-]{1,63}\.(?:[\w-]\.?){1,251}[\w-]                 # emails
+  | .(?:[\U0001f3fb-\U0001f3ff]?(?:\u200d.[\U0001f3fb-\U0001f3ff]?)+|[\U0001f3fb-\U0001f3ff]) # emoji sequences
+  | [\U0001F1E6-\U0001F1FF]{2}                                         # flags
+  | \#+\w+[\w'\-]*\w+                                                 # hashtags
+  | [^\W\d_](?:[^\W\d_]|['\-_])+[^\W\d_]                              # words with apostrophes or dashes
+  | [+\-]?\d+[,/.:-]\d+[+\-]?                                         # numbers
+  | \w+                                                               # words
+  | \.(?:\s*\.)+                                                      # ellipsis
+  | \S
+""", re.VERBOSE | re.IGNORECASE)
+
+def regex_tweet_tokenize(text : str) -> List[str]:
+    """Tokenizes a tweet like nltk TweetTokenizer(preserve_case = False,
+    strip_handles = True, reduce_len = True).tokenize, with a single compiled
+    regular expression.
+
+    :param text: the tweet
+    :type text: str
+    :return: the tokens
+    :rtype: List[str]
+    """
+    if '&' in text:
+        text = html.unescape(text)
+    if '@' in text:
+        text = HANDLES_RE.sub(' ', text)
+    text = LENGTHENING_RE.sub(r'\1\1\1', text)
+    return [
+        token if EMOTICON_CHARS_RE.search(token) and EMOTICON_RE.search(token) else token.lower()
+        for token in TWEET_TOKEN_RE.findall(text)
+    ]
+
+# characters of a word: all but spaces, the punctuation split by the Treebank
+# tokenizer, apostrophes, dots and dashes
+WORD_CHAR = r"""[^\s,:;@#$%&?!*()\[\]{}<>"`'.\-]"""
+
+WORD_TOKEN_RE = re.compile(r"""
+    \.{2,}                                        # ellipsis
+  | --
+  | (?<=\w)n't(?!\w)                              # contractions
+  | '(?:[smd]|ll|re|ve)(?!\w)
+  | \w+?(?=n't(?!\w))
+  | (?:can|gim|gon|got|lem|wan)(?=(?:not|me|na|ta)\b)
+  | (?:""" + WORD_CHAR + r"""|\.(?!\.)|-(?!-))    # words, with single dots and dashes, inner
+    (?:""" + WORD_CHAR + r"""                     # apostrophes and commas or colons in numbers
+      | \.(?!\.)
+      | -(?!-)
+      | [,:](?=\d)
+      | '(?=""" + WORD_CHAR + r"""|\.)(?!(?:[smd]|ll|re|ve)(?!\w))
+    )*
+  | ``|''
+  | \S
+""", re.VERBOSE | re.IGNORECASE)
+
+FINAL_PERIOD_RE = re.compile(r'^(.*[^.])\.$')
+
+def regex_word_tokenize(text : str) -> List[str]:
+    """Tokenizes a text like nltk.word_tokenize: the text is split into sentences
+    with regex_sent_tokenize and each of them is split into Treebank-like tokens
+    (punctuation and contractions separated, periods only separated at the end of
+    the sentence, double quotes turned into `` and '').
+
+    :param text: the text
+    :type text: str
+    :return: the tokens
+    :rtype: List[str]
+    """
+    tokens = []
+    for sentence in regex_sent_tokenize(text):
+        words = WORD_TOKEN_RE.findall(sentence)
+        if '"' in sentence or "''" in sentence:
+            words = []
+            for match in WORD_TOKEN_RE.finditer(sentence):
+                word = match.group()
+                if word == '"' or word == "''":
+                    start = match.start()
+                    word = '``' if start == 0 or sentence[start - 1] in ' ([{<' else "''"
+                words.append(word)
+        # the final period is separated, before the closing brackets and quotes
+        for i in range(len(words) - 1, -1, -1):
+            if words[i] in (')', ']', '}', '>', "''", "'"):
+                continue
+            match = FINAL_PERIOD_RE.match(words[i])
+            if match is not None:
+                words[i:i + 1] = [match.group(1), '.']
+            break
+        tokens.extend(words)
+    return tokens
+
+SENTENCE_END_RE = re.compile(r'[.!?]+["\')\]]*\s+(?=["\'(\[]*[A-Z0-9])')
+
+# words whose final period is not the end of a sentence
+ABBREVIATIONS = {
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'ft', 'vs', 'etc', 'no', 'nos',
+    'inc', 'ltd', 'co', 'corp', 'dept', 'univ', 'gen', 'gov', 'sen', 'rep', 'col', 'lt', 'capt',
+    'sgt', 'rev', 'ave', 'blvd', 'approx', 'est', 'fig', 'vol', 'op', 'cf', 'al',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+    'e.g', 'i.e', 'u.s', 'u.k', 'u.n', 'a.m', 'p.m'
+}
+
+def regex_sent_tokenize(text : str) -> List[str]:
+    """Splits a text into sentences like nltk.sent_tokenize: after a sentence
+    ending punctuation followed by a space and an upper case letter or a number,
+    unless the period ends a known abbreviation or an initial.
+
+    :param text: the text
+    :type text: str
+    :return: the sentences
+    :rtype: List[str]
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_RE.finditer(text):
+        if text[match.start()] == '.' and match.end() - match.start() > 0:
+            word = text[start:match.start()].rsplit(None, 1)[-1:]
+            word = word[0].lower() if word else ''
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()) or ('.' in word and len(word) < 6):
+                continue
+        sentence = text[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        sentences.append(sentence)
+    return sentences
@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import copy
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import torch
+
+sys.path.append('.')
+from src.models import NextWordPredictorModel, init_model
+from src.data_processing import Vocabulary, load_vocabulary
+
+class SuggestionServer():
+    def __init__(
+        self,
+        models : Dict[str, NextWordPredictorModel],
+        vocabulary : Vocabulary,
+        max_batch_size : int = 64,
+        max_wait_ms : float = 5.
+    ):
+        """Asyncio server of next word suggestions. The concurrent requests are queued
+        and gathered into micro-batches: a batch is run as soon as it holds
+        max_batch_size requests or max_wait_ms after its first request. Every batch
+        runs a single forward pass per model in a worker thread, so that the event
+        loop keeps receiving requests in the meantime.
+
+        Requests are HTTP POST /suggest with a JSON body {"text": str, "k": int,
+        "model": str}, where k defaults to 3 and model to 'general'. The answer is
+        {"words": [the k most probable next words]}. GET /stats returns the number
+        of requests and batches served.
+
+        :param models: the served models, indexed by name
+        :type models: Dict[str, NextWordPredictorModel]
+        :param vocabulary: the vocabulary of the models
+        :type vocabulary: Vocabulary
+        :param max_batch_size: maximum number of requests per batch, defaults to 64
+        :type max_batch_size: int, optional
+        :param max_wait_ms: maximum time a batch waits for more requests, defaults to 5
+        :type max_wait_ms: float, optional
+        """
+        self.models = models
+        self.vocabulary = vocabulary
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # a single thread runs the forward passes one batch after the other
+        self.executor = ThreadPoolExecutor(1)
+        self.queue = None
+        self.num_requests = 0
+        self.num_batches = 0
+        for model in models.values():
+            model.eval()
+
+    def check_request(self, k : int, model : str):
+        """Checks that a request can be answered
+
+        :param k: number of suggested words
+        :type k: int
+        :param model: name of the model
+        :type model: str
+        :raises KeyError: if the model is not served
+        :raises ValueError: if k is not between 1 and the vocabulary size of the model
+        """
+        if model not in self.models:
+            raise KeyError(f'unknown model {model}')
+        if not 1 <= k <= self.models[model].vocab_size:
+            raise ValueError(f'k must be between 1 and {self.models[model].vocab_size}, got {k}')
+
+    async def suggest(self, text : str, k : int = 3, model : str = 'general') -> List[str]:
+        """Queues a request and waits for the batch it is part of
+
+        :param text: the beginning of the text
+        :type text: str
+        :param k: number of suggested words, defaults to 3
+        :type k: int, optional
+        :param model: name of the model, defaults to 'general'
+        :type model: str, optional
+        :raises KeyError: if the model is not served
+        :raises ValueError: if k is not between 1 and the vocabulary size of the model
+        :rtype: List[str]
+        """
+        self.check_request(k, model)
+        tokens = self.models[model].encode_prompt(self.vocabulary, text)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((model, tokens, k, future))
+        return await future
+
+    async def batch_requests(self):
+        """Forever gathers the queued requests into batches and answers them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                logging.error(f'batch of {len(batch)} requests failed: {e}')
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (*_, future), words in zip(batch, results):
+                if not future.done():
+                    future.set_result(words)
+            self.num_requests += len(batch)
+            self.num_batches += 1
+
+    def run_batch(self, batch : List[Tuple[str, List[int], int, asyncio.Future]]) -> List[List[str]]:
+        """Runs the requests of a batch with a single forward pass per model
+
+        :param batch: the (model name, token ids, k, future) of every request
+        :type batch: List[Tuple[str, List[int], int, asyncio.Future]]
+        :return: the suggested words of every request
+        :rtype: List[List[str]]
+        """
+        results = [None] * len(batch)
+        by_model = {}
+        for i, (model, *_) in enumerate(batch):
+            by_model.setdefault(model, []).append(i)
+        with torch.no_grad():
+            for model, indices in by_model.items():
+                logits, _ = self.models[model].run_prompts([batch[i][1] for i in indices])
+                max_k = max(batch[i][2] for i in indices)
+                top = torch.topk(logits, max_k, dim = -1)[1].tolist()
+                for i, ids in zip(indices, top):
+                    results[i] = [self.vocabulary.idx_to_word[idx] for idx in ids[:batch[i][2]]]
+        return results
+
+    async def handle_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        """Answers the HTTP/1.1 requests of a connection, kept alive until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, answer = await self.route(method, path, body)
+                payload = json.dumps(answer).encode()
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method : str, path : str, body : bytes) -> Tuple[str, dict]:
+        """Dispatches a request to its handler
+
+        :return: the HTTP status and the JSON answer
+        :rtype: Tuple[str, dict]
+        """
+        if method == 'GET' and path == '/stats':
+            return '200 OK', {
+                'requests' : self.num_requests,
+                'batches' : self.num_batches,
+                'mean_batch_size' : self.num_requests / max(self.num_batches, 1)
+            }
+        if method != 'POST' or path != '/suggest':
+            return '404 Not Found', {'error' : f'no route {method} {path}'}
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict) or not isinstance(request.get('text'), str):
+                raise ValueError('the request must be a JSON object with a "text" string')
+            k = int(request.get('k', 3))
+            model = str(request.get('model', 'general'))
+            self.check_request(k, model)
+        except KeyError as e:
+            return '404 Not Found', {'error' : str(e)}
+        except (ValueError, TypeError) as e:
+            return '400 Bad Request', {'error' : str(e)}
+        try:
+            words = await self.suggest(request['text'], k, model)
+        except Exception as e:
+            # the batch of the request failed
+            return '500 Internal Server Error', {'error' : str(e)}
+        return '200 OK', {'words' : words}
+
+    async def start(self, host : str = '127.0.0.1', port : int = 8080, unix_path : str = None) -> asyncio.AbstractServer:
+        """Starts the batching task and listens on a TCP port or on a Unix socket
+
+        :param host: the TCP host, defaults to '127.0.0.1'
+        :type host: str, optional
+        :param port: the TCP port, defaults to 8080
+        :type port: int, optional
+        :param unix_path: path of a Unix socket to listen on instead, defaults to None
+        :type unix_path: str, optional
+        :rtype: asyncio.AbstractServer
+        """
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.batch_requests())
+        if unix_path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path = unix_path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_forever(self, **kwargs):
+        server = await self.start(**kwargs)
+        logging.info(f'serving {list(self.models)} on {kwargs}')
+        async with server:
+            await server.serve_forever()
+
+def load_models(
+    model_config : str,
+    federated_config : str = None,
+    node_ids : List[int] = []
+) -> Tuple[Dict[str, NextWordPredictorModel], Vocabulary]:
+    """Loads the vocabulary, the pretrained general model of a model config file and
+    optionally the personalized models of some nodes, saved by a federated pipeline
+    with the given config file. The node models are named by their id.
+
+    :param model_config: name of the model config file in config_files
+    :type model_config: str
+    :param federated_config: name of the federated config file in config_files, defaults to None
+    :type federated_config: str, optional
+    :param node_ids: ids of the nodes to serve, defaults to []
+    :type node_ids: List[int], optional
+    :return: the models indexed by name and the vocabulary
+    :rtype: Tuple[Dict[str, NextWordPredictorModel], Vocabulary]
+    """
+    with open(os.path.join('config_files', model_config), 'r') as f:
+        parameters = json.load(f)
+    vocabulary = load_vocabulary(os.path.join('vocabs', parameters['DATA_PARAMETERS']['vocab_file']))
+    model_parameters = parameters['MODEL_PARAMETERS']
+    model_parameters['device'] = parameters['DEVICE']
+    model_parameters['vocab_size'] = vocabulary.get_vocab_size()
+    general_model = init_model(vocabulary, **model_parameters)
+    general_model.load_model(os.path.join(
+        parameters['TRAINING_PARAMETERS']['model_path'],
+        parameters['TRAINING_PARAMETERS']['model_name']
+    ))
+    models = {'general' : general_model}
+    if federated_config is not None:
+        with open(os.path.join('config_files', federated_config), 'r') as f:
+            federated_args = json.load(f)
+        weights_dir = federated_args['weights_dir']
+        for node_id in node_ids:
+            # the node models share the embedding layer of the general model, which the
+            # memo of deepcopy maps to itself: only the other layers are copied
+            embedding_layer = general_model.embedding_layer
+            model = copy.deepcopy(general_model, {id(embedding_layer) : embedding_layer})
+            model.rnn.load_state_dict(torch.load(
+                os.path.join(weights_dir, federated_args['rnn_folder'], f'rnn_{node_id}.pth')
+            ))
+            model.linear.load_state_dict(torch.load(
+                os.path.join(weights_dir, federated_args['linear_folder'], f'linear_{node_id}.pth')
+            ))
+            models[str(node_id)] = model
+    return models, vocabulary
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    if len(sys.argv) < 2:
+        print('usage: python src/server.py <model config> [port] [federated config] [node ids...]')
+        sys.exit(1)
+    models, vocabulary = load_models(sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else None, sys.argv[4:])
+    server = SuggestionServer(models, vocabulary)
+    asyncio.run(server.serve_forever(port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080))
@@ -17,12 +17,43 @@ def make_dir_if_not_exists(path : str) -> bool:
     else:
         return False
 
+def split_indices(
+    N : int,
+    val_split : float = 0.15,
+    test_split : float = 0.15,
+    rng : np.random.RandomState = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Shuffles the indices of N samples and splits them into train, val and test
+    indices with the given float splits.
+
+    :param N: number of samples
+    :type N: int
+    :param val_split: split of the validation set, defaults to 0.15
+    :type val_split: float, optional
+    :param test_split: split of the test set, defaults to 0.15
+    :type test_split: float, optional
+    :param rng: random state of the shuffle, defaults to None (the global numpy one)
+    :type rng: np.random.RandomState, optional
+    :return: 3 index arrays : train, val and test indices
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    indices = (np.random if rng is None else rng).permutation(N)
+    num_val = int(N * val_split)
+    num_test = int(N * test_split)
+
+    val_indices = indices[:num_val]
+    train_indices = indices[num_val:N - num_test]
+    test_indices = indices[N - num_test:]
+    return train_indices, val_indices, test_indices
+
 def split_data(
     data : list,
     val_split : float = 0.15,
-    test_split : float = 0.15
+    test_split : float = 0.15,
+    rng : np.random.RandomState = None
 ) -> Tuple[List, List, List]:
-    """Splits the data into 3 splits, train, val and test with the given float splits
+    """Splits the data into 3 splits, train, val and test with the given float splits.
+    The splits are lists of the items of data, which are not copied.
 
     :param data: data on wich to apply the split
     :type data: list
@@ -30,25 +61,15 @@ def split_data(
     :type val_split: float, optional
     :param test_split: split of the test set, defaults to 0.15
     :type test_split: float, optional
+    :param rng: random state of the shuffle, defaults to None (the global numpy one)
+    :type rng: np.random.RandomState, optional
     :return: 3 lists : train, val and test set
     :rtype: Tuple[List, List, List]
     """
-    data = np.array(data)
-    N = len(data)
-    indices = list(range(N))
-    np.random.shuffle(indices)
-
-    train_indices = indices[int(N * val_split):-int(N * test_split)]
-    val_indices = indices[:int(N * val_split)]
-    test_indices = indices[-int(N * test_split):]
-
-    train_set = data[train_indices]
-    val_set = data[val_indices]
-    test_set = data[test_indices]
-
-    assert len(train_set) + len(val_set) + len(test_set) == N
-
-    return list(train_set), list(val_set), list(test_set)
+    return tuple(
+        [data[i] for i in indices]
+        for indices in split_indices(len(data), val_split, test_split, rng)
+    )
 
 def update_json(json_file, **kwargs):
     """Updates the given .json file with the given key-values as argument.
@@ -69,4 +90,75 @@ def update_json(json_file, **kwargs):
         json.dump(data, f, indent = 4)
 
 def pseudo_huber_loss(weights1, weights2, delta_c, data_size):
-    return torch.sum(torch.sqrt((delta_c ** 2 / (1 + data_size)) + torch.pow(weights1 - weights2, 2)))
\ No newline at end of file
+    return torch.sum(torch.sqrt((delta_c ** 2 / (1 + data_size)) + torch.pow(weights1 - weights2, 2)))
+
+def flatten_tensors(tensors : List[torch.Tensor]) -> torch.Tensor:
+    """Concatenates the given tensors, detached, into a single flat vector
+
+    :rtype: torch.Tensor
+    """
+    return torch.cat([tensor.detach().reshape(-1) for tensor in tensors])
+
+class FlatDistance(torch.autograd.Function):
+    """Distance between a list of weights and a constant flat vector of the same
+    total size, computed as a single autograd node with an analytic backward:
+    - 'norm': sum over the weights of the p norm of their difference with their
+      segment of the vector, as a sum of torch.dist
+    - 'huber': pseudo_huber_loss of all the differences
+    Only the weights receive a gradient.
+    """
+    @staticmethod
+    def forward(ctx, loss_type, p, data_size, scale, target, *weights):
+        sizes = [weight.numel() for weight in weights]
+        diff = torch.cat([weight.reshape(-1) for weight in weights]) - target
+        if loss_type == 'huber':
+            root = torch.sqrt(p ** 2 / (1 + data_size) + diff * diff)
+            ctx.save_for_backward(diff / root)
+            loss = root.sum()
+        elif loss_type == 'norm':
+            norms = torch.stack([torch.linalg.vector_norm(d, p) for d in diff.split(sizes)])
+            # d |d|_p / dd = sign(d) |d|^(p - 1) / |d|_p^(p - 1), 0 for a null difference
+            inv_norms = torch.where(norms > 0, norms.pow(1 - p), torch.zeros_like(norms))
+            inv_norms = inv_norms.repeat_interleave(torch.tensor(sizes, device = diff.device))
+            ctx.save_for_backward(torch.sign(diff) * diff.abs().pow(p - 1) * inv_norms)
+            loss = norms.sum()
+        else:
+            raise ValueError(f'unknown loss type {loss_type}')
+        ctx.scale = scale
+        ctx.shapes = [weight.shape for weight in weights]
+        ctx.sizes = sizes
+        return (scale * loss).reshape(1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad, = ctx.saved_tensors
+        grad = grad * (ctx.scale * grad_output)
+        grads = [g.view(shape) for g, shape in zip(grad.split(ctx.sizes), ctx.shapes)]
+        return (None, None, None, None, None, *grads)
+
+def flat_distance(
+    weights : List[torch.Tensor],
+    target : torch.Tensor,
+    loss_type : str,
+    p : float,
+    scale : float = 1.,
+    data_size : int = None
+) -> torch.Tensor:
+    """Scaled distance between weights and a constant flat vector, see FlatDistance
+
+    :param weights: the weights, whose gradient is computed
+    :type weights: List[torch.Tensor]
+    :param target: the flat vector, for instance built by flatten_tensors
+    :type target: torch.Tensor
+    :param loss_type: 'norm' or 'huber'
+    :type loss_type: str
+    :param p: the order of the norm or the delta of the pseudo huber loss
+    :type p: float
+    :param scale: factor of the distance, defaults to 1.
+    :type scale: float, optional
+    :param data_size: the data size of the pseudo huber loss, defaults to None
+    :type data_size: int, optional
+    :return: the distance of shape [1]
+    :rtype: torch.Tensor
+    """
+    return FlatDistance.apply(loss_type, p, data_size, scale, target, *weights)
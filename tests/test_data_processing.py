@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import logging
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torchtext')
+pytest.importorskip('apex')
+
+sys.path.append('.')
+from src.data_processing import FromTweetsVocabulary, SequenceDataset
+
+MIN_SEQ_LENGTH = 2
+MAX_SEQ_LENGTH = 5
+
+WORDS = ['the', 'cat', 'sat', 'on', 'a', 'mat', 'and', 'dog', 'ran', 'home', 'fast', 'today']
+SENTENCES = [
+    'the cat sat',                                                  # shorter than max_seq_length
+    'the cat sat on a',                                             # equal to max_seq_length
+    'the cat sat on a mat',                                         # one token more, removed
+    'the dog ran home fast and the cat sat on a mat today',         # longer, last row padded
+    'the cat sat on a mat and the dog ran',                         # two full rows
+    'the dog',                                                      # not longer than min_seq_length
+    'a',                                                            # below min_seq_length
+    'zebra giraffe okapi',                                          # only unknown tokens
+    'the zebra ran',                                                # unknown token inside
+    ''
+]
+
+def make_vocabulary():
+    return FromTweetsVocabulary(
+        # the capitalized words start the sentences of the raw text
+        [' '.join(WORDS), ' '.join(word.capitalize() for word in WORDS)],
+        tokenizer = 'regex_word',
+        text_cleaner = 'default',
+        min_word_occ = 1,
+        sentence_splitter = 'regex'
+    )
+
+def reference_tokens(dataset, sentences, min_seq_length):
+    """The per sentence loop of SequenceDataset before its vectorization"""
+    vocabulary = dataset.vocabulary
+    tokens = [
+        [dataset.get_idx(w) for w in vocabulary.tokenizer(vocabulary.text_cleaner(sentence))]
+        for sentence in sentences
+    ]
+    rows = []
+    for sequence in tokens:
+        if len(sequence) > min_seq_length and sum(sequence) > 1:
+            sequence = np.array(sequence)
+            rest = len(sequence) % dataset.max_seq_length
+            if rest > 1:
+                sequence = np.concatenate((sequence, [vocabulary.padding_idx] * (dataset.max_seq_length - rest)))
+            elif rest == 1:
+                sequence = sequence[:-1]
+            rows.append(sequence.reshape(-1, dataset.max_seq_length))
+    return np.concatenate(rows)
+
+def reference_token_len(tokens):
+    total = 0
+    for row in tokens:
+        total += sum(row > 0)
+    return total
+
+@pytest.mark.parametrize('max_seq_length', [3, MAX_SEQ_LENGTH, 6])
+def test_tokens_match_per_sentence_loop(max_seq_length):
+    vocabulary = make_vocabulary()
+    dataset = SequenceDataset(vocabulary, SENTENCES, MIN_SEQ_LENGTH, max_seq_length, 'cpu', with_tqdm = False)
+    expected = reference_tokens(dataset, SENTENCES, MIN_SEQ_LENGTH)
+    np.testing.assert_array_equal(dataset.tokens, expected)
+    assert dataset.token_len() == reference_token_len(expected)
+
+def test_tokens_of_raw_text_match_per_sentence_loop():
+    vocabulary = make_vocabulary()
+    text = ' '.join(f'{sentence.capitalize()}.' for sentence in SENTENCES if sentence)
+    dataset = SequenceDataset(vocabulary, text, MIN_SEQ_LENGTH, MAX_SEQ_LENGTH, 'cpu', with_tqdm = False)
+    expected = reference_tokens(dataset, dataset.split_sentences(text), MIN_SEQ_LENGTH)
+    np.testing.assert_array_equal(dataset.tokens, expected)
+    assert dataset.token_len() == reference_token_len(expected)
+
+def attack_sentence(config_file):
+    with open(os.path.join('config_files', config_file), 'r') as f:
+        return json.load(f)['sentence']
+
+@pytest.mark.parametrize('sentence, text_cleaner, path', [
+    # the cleaner removes the period, the copies are a single sentence
+    (attack_sentence('CONFIG_FEDERATED_TWEETS.json'), 'default', 'its single sentence is tiled'),
+    (attack_sentence('CONFIG_FEDERATED_WIKI.json'), 'default', 'its single sentence is tiled'),
+    # the kept period joins the last sentence of a copy with the next copy
+    (attack_sentence('CONFIG_FEDERATED_WIKI.json'), 'raw', 'tokenizing it as a whole'),
+    (' The cat sat on a mat. The dog ran home.', 'default', 'its sentences are tiled')
+])
+@pytest.mark.parametrize('repeats', [1, 2, 7])
+def test_repeats_match_repeated_text(sentence, text_cleaner, path, repeats, caplog):
+    words = sentence.replace('.', ' ').split()
+    vocabulary = FromTweetsVocabulary(
+        [' '.join(words + ['.'])],
+        tokenizer = 'regex_word',
+        text_cleaner = text_cleaner,
+        min_word_occ = 1,
+        sentence_splitter = 'regex'
+    )
+    with caplog.at_level(logging.INFO):
+        dataset = SequenceDataset(
+            vocabulary, sentence, MIN_SEQ_LENGTH, MAX_SEQ_LENGTH, 'cpu', with_tqdm = False, repeats = repeats
+        )
+    if repeats > 1:
+        assert path in caplog.text
+    # the leading space of the sentence is what makes [1:] harmless
+    for text in [sentence * repeats, (sentence * repeats)[1:]]:
+        expected = SequenceDataset(vocabulary, text, MIN_SEQ_LENGTH, MAX_SEQ_LENGTH, 'cpu', with_tqdm = False)
+        np.testing.assert_array_equal(dataset.tokens, expected.tokens)
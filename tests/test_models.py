@@ -0,0 +1,152 @@
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('torchtext')
+pytest.importorskip('apex')
+
+sys.path.append('.')
+from src.models import NextWordPredictorModel
+from src.data_processing import SequenceDataset, SequenceDataLoader
+
+VOCAB_SIZE = 50
+BATCH_SIZE = 4
+
+def reference_perplexity(model, batches):
+    """The per sample loop of NextWordPredictorModel.perplexity before its vectorization"""
+    m = torch.nn.Softmax(dim = 0)
+    total_losses = []
+    total_tokens = 0
+    probabilities = []
+    total, top1hit, top3hit = 0, 0, 0
+    for batch in batches:
+        hidden = model.init_hidden(len(batch))
+        outputs, _ = model.forward(batch[:,:-1], hidden)
+        outputs = torch.transpose(outputs, 1, 2)
+        labels = batch[:,1:]
+        for i in range(len(batch)):
+            logits = m(outputs[i])
+            lab = labels[i]
+            for top3, label in zip(torch.topk(logits.T, 3)[1].cpu().numpy(), lab.cpu().numpy()):
+                if label not in [0, 1]:
+                    if label in top3:
+                        top3hit += 1
+                    if label == top3[0]:
+                        top1hit += 1
+                    total += 1
+            logits = logits[lab, range(len(lab))]
+            logits = logits[lab != 0].cpu().numpy()
+            probabilities.append(sum(np.log(logits)))
+            total_tokens += len(logits)
+        total_losses.append(model.criterion(outputs, labels).item())
+    perplexity = np.exp(- np.sum(probabilities) / total_tokens)
+    return perplexity, np.mean(total_losses), top1hit / total, top3hit / total
+
+def padded_batches(num_batches = 5, max_seq_length = 12):
+    """Batches of random token ids, unknown tokens included, followed by padding"""
+    generator = torch.Generator().manual_seed(0)
+    batches = []
+    for _ in range(num_batches):
+        batch = torch.randint(1, VOCAB_SIZE, (BATCH_SIZE, max_seq_length), generator = generator)
+        lengths = torch.randint(2, max_seq_length + 1, (BATCH_SIZE,), generator = generator)
+        batch[torch.arange(max_seq_length).unsqueeze(0) >= lengths.unsqueeze(1)] = 0
+        batches.append(batch)
+    return batches
+
+@pytest.mark.parametrize('type_of_rnn', ['LSTM', 'GRU'])
+@pytest.mark.parametrize('packed_sequences', [False, True])
+def test_perplexity_matches_per_sample_loop(type_of_rnn, packed_sequences):
+    torch.manual_seed(0)
+    model = NextWordPredictorModel(
+        type_of_rnn, 16, VOCAB_SIZE, 2, 16, 0., 'cpu', packed_sequences = packed_sequences
+    )
+    batches = padded_batches()
+    model.eval()
+    with torch.no_grad():
+        expected = reference_perplexity(model, batches)
+    np.testing.assert_allclose(model.perplexity(batches, with_recall = True), expected, rtol = 1e-5)
+    np.testing.assert_allclose(model.perplexity(batches), expected[:2], rtol = 1e-5)
+
+    with torch.no_grad():
+        metrics = model.dataloader_metrics(batches)
+    np.testing.assert_allclose(
+        [metrics['perplexity'], metrics['loss'], metrics['f1_recall'], metrics['f3_recall']],
+        expected,
+        rtol = 1e-5
+    )
+
+def test_fused_evaluation_matches_separate_passes():
+    torch.manual_seed(0)
+    model = NextWordPredictorModel('GRU', 16, VOCAB_SIZE, 2, 16, 0., 'cpu')
+    model.eval()
+    dataloaders = {
+        'val' : padded_batches(5, 12),
+        # fewer and shorter batches, right padded in the fused batches
+        'attack' : padded_batches(2, 8)
+    }
+    evaluation = model.evaluate_metrics(dataloaders, {'val' : ['perplexity', 'loss', 'f1_recall'], 'attack' : ['perplexity']})
+    with torch.no_grad():
+        for name, dataloader in dataloaders.items():
+            expected = model.dataloader_metrics(dataloader)
+            for metric, value in evaluation[name].items():
+                assert value == pytest.approx(expected[metric], rel = 1e-5)
+
+def duplicated_dataset(num_copies = 100):
+    """Dataset of num_copies copies of a row, interleaved with 3 other rows"""
+    rows = torch.cat(padded_batches(1)).numpy()
+    dataset = SequenceDataset.__new__(SequenceDataset)
+    dataset.device = 'cpu'
+    dataset.max_seq_length = rows.shape[1]
+    dataset.tensor = None
+    dataset.counts = None
+    dataset.cache_file = None
+    dataset.tokens = np.concatenate([rows[:1], np.repeat(rows[1:2], num_copies, axis = 0), rows[2:]])
+    return dataset
+
+@pytest.mark.parametrize('batch_size', [1, 2, 4])
+def test_deduplicated_evaluation_matches_duplicated_rows(batch_size):
+    torch.manual_seed(0)
+    # in double precision, the rounding errors of the different batch compositions stay far below 1e-8
+    torch.set_default_dtype(torch.float64)
+    try:
+        model = NextWordPredictorModel('GRU', 16, VOCAB_SIZE, 2, 16, 0., 'cpu')
+        check_deduplicated_evaluation(model, batch_size)
+    finally:
+        torch.set_default_dtype(torch.float32)
+
+def check_deduplicated_evaluation(model, batch_size):
+    dataset = duplicated_dataset()
+    deduplicated = dataset.deduplicate()
+    assert len(deduplicated) == 4 and deduplicated.counts.sum().item() == len(dataset)
+
+    duplicated_loader = SequenceDataLoader(dataset, batch_size = 1)
+    deduplicated_loader = SequenceDataLoader(deduplicated, batch_size = batch_size)
+    expected = model.perplexity(duplicated_loader, with_recall = True)
+    np.testing.assert_allclose(model.perplexity(deduplicated_loader, with_recall = True), expected, rtol = 1e-8)
+    np.testing.assert_allclose(
+        model.evaluate(deduplicated_loader, with_tqdm = False),
+        model.evaluate(duplicated_loader, with_tqdm = False),
+        rtol = 1e-8
+    )
+    for losses, expected_losses in zip(
+        model.evaluate(deduplicated_loader, sep_losses = True, with_tqdm = False),
+        model.evaluate(duplicated_loader, sep_losses = True, with_tqdm = False)
+    ):
+        np.testing.assert_allclose(losses, expected_losses, rtol = 1e-8)
+
+    # a deduplicated data loader fused with a plain one
+    plain = padded_batches(3)
+    evaluation = model.evaluate_metrics({'attack' : deduplicated_loader, 'val' : plain})
+    np.testing.assert_allclose(
+        [evaluation['attack'][metric] for metric in ['perplexity', 'loss', 'f1_recall', 'f3_recall']],
+        expected,
+        rtol = 1e-8
+    )
+    expected_plain = model.perplexity(plain, with_recall = True)
+    np.testing.assert_allclose(
+        [evaluation['val'][metric] for metric in ['perplexity', 'loss', 'f1_recall', 'f3_recall']],
+        expected_plain,
+        rtol = 1e-8
+    )
@@ -0,0 +1,48 @@
+import sys
+
+import pytest
+import torch
+
+sys.path.append('.')
+from src.utils import pseudo_huber_loss, flatten_tensors, flat_distance
+
+LAMBDA = 0.3
+DATA_SIZE = 120
+
+def make_weights(null_difference):
+    """Weights of several shapes and the frozen tensors they are compared to. With
+    null_difference, the second weight is equal to its frozen tensor."""
+    generator = torch.Generator().manual_seed(0)
+    shapes = [(4, 3), (5,), (2, 3, 2)]
+    weights = [torch.randn(shape, generator = generator, dtype = torch.float64) for shape in shapes]
+    frozen = [torch.randn(shape, generator = generator, dtype = torch.float64) for shape in shapes]
+    if null_difference:
+        frozen[1] = weights[1].clone()
+    return [weight.requires_grad_() for weight in weights], frozen
+
+def reference_distance(weights, frozen, loss_type, p):
+    """The per tensor sum of Federated_LICCHAVI.models_difference before FlatDistance"""
+    reg = torch.zeros(1, dtype = torch.float64, requires_grad = True)
+    for w1, w2 in zip(weights, frozen):
+        if loss_type == 'norm':
+            reg = reg + LAMBDA * torch.dist(w1, w2, p)
+        elif loss_type == 'huber':
+            reg = reg + LAMBDA * pseudo_huber_loss(w1, w2, p, DATA_SIZE)
+    return reg
+
+@pytest.mark.parametrize('loss_type, p', [('norm', 1), ('norm', 2), ('norm', 3), ('huber', 1), ('huber', 2)])
+@pytest.mark.parametrize('null_difference', [False, True])
+def test_flat_distance_matches_per_tensor_sum(loss_type, p, null_difference):
+    weights, frozen = make_weights(null_difference)
+    expected = reference_distance(weights, frozen, loss_type, p)
+    expected_grads = torch.autograd.grad(expected.sum(), weights)
+
+    distance = flat_distance(weights, flatten_tensors(frozen), loss_type, p, LAMBDA, DATA_SIZE)
+    grads = torch.autograd.grad(distance.sum(), weights)
+    assert distance.shape == expected.shape
+    torch.testing.assert_close(distance, expected, rtol = 1e-12, atol = 1e-12)
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad, rtol = 1e-12, atol = 1e-12)
+    if null_difference and loss_type == 'norm':
+        # a null difference gives a null gradient, not a nan
+        assert torch.count_nonzero(grads[1]) == 0